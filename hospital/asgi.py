@@ -3,14 +3,30 @@ ASGI config for hospital project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Requests are resolved with settings.ASGI_URLCONF, which answers GET on the views with an
+aget() on the event loop (see medical/async_views.py).
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler, ASGIRequest
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'hospital.settings')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+
+class HospitalASGIRequest(ASGIRequest):
+    urlconf = settings.ASGI_URLCONF
+
+
+class HospitalASGIHandler(ASGIHandler):
+    request_class = HospitalASGIRequest
+
+
+application = HospitalASGIHandler()
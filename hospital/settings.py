@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 import os
 from pathlib import Path
 import dj_database_url
+from django.core.exceptions import ImproperlyConfigured
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -52,6 +53,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'medical.metrics.MetricsMiddleware',  # first, so it times the whole stack
+    'medical.replicas.ReplicaMiddleware',  # before anything reads the database
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -63,6 +66,8 @@ MIDDLEWARE = [
 ]
 
 ROOT_URLCONF = 'hospital.urls'
+# hospital/asgi.py resolves with this one instead: the same URLs, read-heavy GETs on the event loop
+ASGI_URLCONF = 'hospital.urls_asgi'
 
 TEMPLATES = [
     {
@@ -99,23 +104,168 @@ DATABASES = {
     'default': dj_database_url.parse(DATABASE_URL, conn_max_age=600)
 }
 
+# A cache all the workers share (the 'shared' CACHES alias): redis://host:6379/0 (needs the
+# redis package), memcached://host:11211 (needs pymemcache), or file:///tmp/hospital-cache to
+# try several workers on one machine. The replica pins need one, the token and detail caches
+# use it when it is there.
+SHARED_CACHE_URL = os.getenv('SHARED_CACHE_URL')
+SHARED_CACHE_BACKENDS = {
+    'redis': 'django.core.cache.backends.redis.RedisCache',
+    'rediss': 'django.core.cache.backends.redis.RedisCache',
+    'memcached': 'django.core.cache.backends.memcached.PyMemcacheCache',
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',
+}
+SHARED_CACHE = None
+if SHARED_CACHE_URL:
+    scheme, _, location = SHARED_CACHE_URL.partition('://')
+    if scheme not in SHARED_CACHE_BACKENDS:
+        raise ImproperlyConfigured(f'SHARED_CACHE_URL: use one of {", ".join(SHARED_CACHE_BACKENDS)}, not {scheme}://')
+    SHARED_CACHE = {
+        'BACKEND': SHARED_CACHE_BACKENDS[scheme],
+        'LOCATION': SHARED_CACHE_URL if scheme in ('redis', 'rediss') else location,
+    }
+
+# Read replicas, comma separated URLs: replica_0, replica_1, ... serve the GET requests' reads,
+# a client that wrote reads from the primary for REPLICA_PIN_SECONDS (see medical/replicas.py).
+# Replicas more than REPLICA_MAX_LAG_SECONDS behind, measured every REPLICA_LAG_CHECK_SECONDS,
+# are skipped, so a write can take up to REPLICA_MAX_LAG_SECONDS + REPLICA_LAG_CHECK_SECONDS to
+# show on the replicas still read from: the pins last at least that long. They are kept in the
+# REPLICA_PIN_CACHE_ALIAS cache, which must be shared between the workers (manage.py check).
+DATABASE_REPLICAS = []
+for index, url in enumerate(url for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()):
+    DATABASES[f'replica_{index}'] = {**dj_database_url.parse(url.strip(), conn_max_age=600), 'TEST': {'MIRROR': 'default'}}
+    DATABASE_REPLICAS.append(f'replica_{index}')
+DATABASE_ROUTERS = ['medical.replicas.ReplicaRouter']
+REPLICA_MAX_LAG_SECONDS = int(os.getenv('REPLICA_MAX_LAG_SECONDS', 30))
+REPLICA_LAG_CHECK_SECONDS = int(os.getenv('REPLICA_LAG_CHECK_SECONDS', 5))
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', REPLICA_MAX_LAG_SECONDS + REPLICA_LAG_CHECK_SECONDS))
+REPLICA_PIN_CACHE_ALIAS = os.getenv('REPLICA_PIN_CACHE_ALIAS', 'shared' if SHARED_CACHE else 'default')
+
+# The browsable API (HTML for browsers) is only served with DEBUG; BROWSABLE_API=False turns it
+# off there too
+BROWSABLE_API = DEBUG and os.getenv('BROWSABLE_API', 'True') == 'True'
+
 REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': (
-        'rest_framework.renderers.JSONRenderer',
-        'rest_framework.renderers.BrowsableAPIRenderer',
+        'medical.renderers.ORJSONRenderer',
+        'medical.renderers.MessagePackRenderer',
+    ) + (('rest_framework.renderers.BrowsableAPIRenderer',) if BROWSABLE_API else ()),
+    'DEFAULT_PARSER_CLASSES': (
+        'medical.parsers.ORJSONParser',
+        'medical.parsers.MessagePackParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
     ),
 
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        'medical.authentication.CachedTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',  # Optional, for session-based authentication
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
     ),
     'EXCEPTION_HANDLER': 'medical.utils.custom_exception_handler',
+    # Keyset pagination for every list endpoint, clients can override with ?page_size=
+    'DEFAULT_PAGINATION_CLASS': 'medical.pagination.IdCursorPagination',
+    'PAGE_SIZE': int(os.getenv('API_PAGE_SIZE', 50)),
 }
 
 
+# Token lookups are cached (see medical/authentication.py). With SHARED_CACHE_URL they go to
+# that cache so a revoked token stops working on every worker at once, otherwise each worker
+# keeps its own and a revoked token can work on the others for up to TOKEN_CACHE_TTL seconds.
+# TOKEN_CACHE_ALIAS picks another configured CACHES alias.
+TOKEN_CACHE_MAX_SIZE = int(os.getenv('TOKEN_CACHE_MAX_SIZE', 10000))
+TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', 300))
+TOKEN_CACHE_ALIAS = os.getenv('TOKEN_CACHE_ALIAS', 'shared' if SHARED_CACHE else None)
+
+# Seconds a rendered department catalogue stays cached. Entries are keyed on the table's row
+# count and latest Department.updated_at (medical/catalogue.py), so every worker serves a change
+# on its next request: the TTL only lets superseded versions go.
+DEPARTMENT_CATALOGUE_TTL = int(os.getenv('DEPARTMENT_CATALOGUE_TTL', 3600))
+
+# Patient / doctor detail GETs are served from a cache (see medical/detail_cache.py): the shared
+# one when SHARED_CACHE_URL is set, else local memory. That one is per worker: entries of the
+# other workers are only invalidated by DETAIL_CACHE_TTL, manage.py check warns about it when
+# WEB_CONCURRENCY (gunicorn's worker count) is above 1. Who may read a patient is still decided
+# on the database (the assigned doctor), not the entry.
+DETAIL_CACHE_ALIAS = os.getenv('DETAIL_CACHE_ALIAS', 'shared' if SHARED_CACHE else 'details')
+DETAIL_CACHE_TTL = int(os.getenv('DETAIL_CACHE_TTL', 60))
+DETAIL_CACHE_MAX_ENTRIES = int(os.getenv('DETAIL_CACHE_MAX_ENTRIES', 50000))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'details': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'medical-details',
+        'OPTIONS': {'MAX_ENTRIES': DETAIL_CACHE_MAX_ENTRIES},
+    },
+}
+if SHARED_CACHE:
+    CACHES['shared'] = SHARED_CACHE
+
+# Record change feed (medical/patient_records/<pk>/changes/): log rows per page by default / at most
+RECORD_CHANGES_PAGE_SIZE = int(os.getenv('RECORD_CHANGES_PAGE_SIZE', 500))
+RECORD_CHANGES_MAX_PAGE_SIZE = int(os.getenv('RECORD_CHANGES_MAX_PAGE_SIZE', 5000))
+
+# Bulk record upload (medical/patient_records/bulk/)
+BULK_RECORDS_MAX_ITEMS = int(os.getenv('BULK_RECORDS_MAX_ITEMS', 10000))
+BULK_RECORDS_BATCH_SIZE = int(os.getenv('BULK_RECORDS_BATCH_SIZE', 500))
+
+# Bulk registration (medical/register/bulk/ and the register_users command): rows per request,
+# rows registered within the request (more go to a job), rows per insert transaction, and the
+# processes hashing the passwords in the command (requests and jobs hash inline)
+BULK_REGISTER_MAX_ITEMS = int(os.getenv('BULK_REGISTER_MAX_ITEMS', 5000))
+BULK_REGISTER_SYNC_MAX_ITEMS = int(os.getenv('BULK_REGISTER_SYNC_MAX_ITEMS', 10))
+BULK_REGISTER_BATCH_SIZE = int(os.getenv('BULK_REGISTER_BATCH_SIZE', 500))
+BULK_REGISTER_HASH_WORKERS = int(os.getenv('BULK_REGISTER_HASH_WORKERS', 4))
+
+# Login password hashing pool (medical/login.py): worker threads, logins allowed to wait for one,
+# seconds they may wait, and the Retry-After sent with the 503 when the pool is saturated
+LOGIN_HASH_WORKERS = int(os.getenv('LOGIN_HASH_WORKERS', 2))
+LOGIN_HASH_QUEUE = int(os.getenv('LOGIN_HASH_QUEUE', 32))
+LOGIN_HASH_TIMEOUT = int(os.getenv('LOGIN_HASH_TIMEOUT', 5))
+LOGIN_RETRY_AFTER = int(os.getenv('LOGIN_RETRY_AFTER', 2))
+
+# Rows fetched per round trip when streaming exports
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 2000))
+
+# Largest page the record search returns
+SEARCH_MAX_LIMIT = int(os.getenv('SEARCH_MAX_LIMIT', 100))
+
+# Department analytics (medical/department/<id>/analytics/): longest month range and largest top-N
+# served, and records per statement when backfill_rollups rebuilds the rollups
+ANALYTICS_MAX_MONTHS = int(os.getenv('ANALYTICS_MAX_MONTHS', 60))
+ANALYTICS_MAX_TOP = int(os.getenv('ANALYTICS_MAX_TOP', 50))
+ROLLUP_BACKFILL_BATCH_SIZE = int(os.getenv('ROLLUP_BACKFILL_BATCH_SIZE', 50000))
+
+# Record archival (manage.py archive_records): records created more than ARCHIVE_AFTER_DAYS ago
+# move to the archive table, ARCHIVE_BATCH_SIZE records per transaction
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 365))
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 5000))
+
+# Background jobs (medical/jobs.py, run by manage.py run_jobs): worker threads per process, seconds
+# between polls of an idle worker, attempts per job and the retry backoff (doubling from
+# JOB_RETRY_BACKOFF_SECONDS up to JOB_RETRY_BACKOFF_MAX_SECONDS). A running job without a progress
+# report for JOB_STALE_SECONDS is taken back from its worker. jobs/ lists the latest JOB_LIST_LIMIT,
+# export jobs write their files to JOB_FILES_DIR.
+JOB_WORKER_CONCURRENCY = int(os.getenv('JOB_WORKER_CONCURRENCY', 2))
+JOB_POLL_SECONDS = int(os.getenv('JOB_POLL_SECONDS', 2))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 3))
+JOB_RETRY_BACKOFF_SECONDS = int(os.getenv('JOB_RETRY_BACKOFF_SECONDS', 30))
+JOB_RETRY_BACKOFF_MAX_SECONDS = int(os.getenv('JOB_RETRY_BACKOFF_MAX_SECONDS', 3600))
+JOB_STALE_SECONDS = int(os.getenv('JOB_STALE_SECONDS', 600))
+JOB_DELETE_BATCH_SIZE = int(os.getenv('JOB_DELETE_BATCH_SIZE', 1000))
+JOB_LIST_LIMIT = int(os.getenv('JOB_LIST_LIMIT', 50))
+JOB_FILES_DIR = os.getenv('JOB_FILES_DIR', os.path.join(BASE_DIR, 'job_files'))
+
+# Prometheus metrics served on /metrics. With several gunicorn workers point METRICS_MULTIPROC_DIR
+# at a directory shared by them (and empty it on deploy). METRICS_TOKEN protects the endpoint.
+METRICS_MULTIPROC_DIR = os.getenv('METRICS_MULTIPROC_DIR')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
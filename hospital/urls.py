@@ -17,6 +17,7 @@ Including another URLconf
 from django.contrib import admin
 from django.shortcuts import render
 from django.urls import path, include
+from medical.metrics import metrics_view
 
 def root_view(request):
     return render(request, 'index.html')
@@ -25,4 +26,5 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('', root_view, name='index'),
     path('medical/', include('medical.urls')),
+    path('metrics', metrics_view, name='metrics'),
 ]
@@ -0,0 +1,16 @@
+"""
+URL configuration of the ASGI entry point (see ASGI_URLCONF): hospital.urls with
+medical.urls_async, whose read-heavy GETs run on the event loop.
+"""
+from django.contrib import admin
+from django.urls import path, include
+from medical.metrics import metrics_view
+
+from .urls import root_view
+
+urlpatterns = [
+    path('admin/', admin.site.urls),
+    path('', root_view, name='index'),
+    path('medical/', include('medical.urls_async')),
+    path('metrics', metrics_view, name='metrics'),
+]
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class MedicalConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'medical'
+
+    def ready(self):
+        from . import checks, signals  # noqa: F401  registers the system checks, connects the signal receivers
@@ -0,0 +1,99 @@
+"""
+Hot/cold split of the patient records.
+
+Records created more than ARCHIVE_AFTER_DAYS ago are moved, batch by batch, from
+medical_patientrecord to medical_archivedpatientrecord (manage.py archive_records, e.g. from
+cron). The hot table and its indexes only hold what the tablets read day to day; the archive
+has a single (patient, created_date) index and no search triggers.
+
+Each batch is one transaction: INSERT ... SELECT into the archive, DELETE from the hot table.
+The department counters and rollups have triggers on both tables, so a move leaves them
+unchanged. The change log (medical/changes.py) records the DELETE, which the batch relabels
+'archived': the feed skips those rows instead of sending tombstones.
+
+Reads of a patient's history touch the hot table only, unless ?include_archived=1 asks for the
+archive too. Archived records are read-only: PATCH / DELETE, search, the department record
+list and the export only see the hot table.
+"""
+import datetime
+
+from django.conf import settings
+from django.db import connection as default_connection
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .filters import filter_created_range, record_ordering
+from .models import ArchivedPatientRecord, PatientRecord, RecordChange
+from .serializers import PatientRecordSerializer
+
+RECORD_TABLE = PatientRecord._meta.db_table
+ARCHIVE_TABLE = ArchivedPatientRecord._meta.db_table
+CHANGE_TABLE = RecordChange._meta.db_table
+# the columns both tables share, archived_at is set by the move
+_COLUMNS = ', '.join(field.column for field in ArchivedPatientRecord._meta.concrete_fields if field.name != 'archived_at')
+
+
+def archive_records(older_than=None, batch_size=None, connection=None, progress=None):
+    """
+    Moves the records created before `older_than` (default: ARCHIVE_AFTER_DAYS ago) to the
+    archive, `batch_size` records per transaction. Returns the number of records moved.
+    """
+    connection = connection or default_connection
+    older_than = older_than or timezone.now() - datetime.timedelta(days=settings.ARCHIVE_AFTER_DAYS)
+    batch_size = batch_size or settings.ARCHIVE_BATCH_SIZE
+    cutoff = connection.ops.adapt_datetimefield_value(older_than)
+    archived_at = connection.ops.adapt_datetimefield_value(timezone.now())
+    candidates = PatientRecord.objects.using(connection.alias).filter(created_date__lt=older_than).order_by('record_id')
+    moved = 0
+    while True:
+        with transaction.atomic(using=connection.alias):
+            ids = list(candidates.values_list('record_id', flat=True)[:batch_size])
+            if not ids:
+                break
+            # the batch is the first ids matching, so the id range plus the cutoff selects exactly them
+            batch = 'record_id BETWEEN %s AND %s AND created_date < %s'
+            params = [ids[0], ids[-1], cutoff]
+            before = RecordChange.objects.using(connection.alias).aggregate(seq=Max('seq'))['seq'] or 0
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'INSERT INTO {ARCHIVE_TABLE} ({_COLUMNS}, archived_at) '
+                    f'SELECT {_COLUMNS}, %s FROM {RECORD_TABLE} WHERE {batch}',
+                    [archived_at, *params],
+                )
+                cursor.execute(f'DELETE FROM {RECORD_TABLE} WHERE {batch}', params)
+                cursor.execute(
+                    f"UPDATE {CHANGE_TABLE} SET operation = 'archived' "
+                    f"WHERE seq > %s AND operation = 'deleted' AND record_id BETWEEN %s AND %s",
+                    [before, ids[0], ids[-1]],
+                )
+        moved += len(ids)
+        if progress:
+            progress(moved)
+    return moved
+
+
+def include_archived(params):
+    return params.get('include_archived', '').lower() in ('1', 'true')
+
+
+def patient_history(patient, params, **filters):
+    """
+    A patient's history as querysets, filtered (?created_after= / ?created_before=, `filters`),
+    ordered and eager loaded: the hot table's, plus the archive's with ?include_archived=1.
+    """
+    models = [PatientRecord, ArchivedPatientRecord] if include_archived(params) else [PatientRecord]
+    ordering = record_ordering(params)
+    return [
+        PatientRecordSerializer.setup_eager_loading(filter_created_range(model.objects.filter(patient=patient, **filters), params).order_by(*ordering))
+        for model in models
+    ]
+
+
+def merge_history(results, params):
+    """The fetched results of patient_history() as one list, in the requested order."""
+    if len(results) == 1:
+        return results[0]
+    # record_ordering() always sorts both keys in the same direction
+    reverse = record_ordering(params)[0].startswith('-')
+    return sorted((record for result in results for record in result), key=lambda record: (record.created_date, record.record_id), reverse=reverse)
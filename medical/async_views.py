@@ -0,0 +1,74 @@
+"""
+GET / HEAD on the event loop for the ASGI entry point (hospital/asgi.py resolves URLs with
+hospital/urls_asgi.py -> medical/urls_async.py).
+
+A view opts in with an aget(): the async twin of its get(), calling the same helpers to decide
+and render the response, only its queries go through the async ORM. So one ASGI worker holds
+many concurrent (slow) clients without a thread each. Function views made with @api_view get
+theirs with @async_get(view).
+
+Everything else is DRF's own APIView: async_view() dispatches like APIView.dispatch(), with
+initial() (authentication, content negotiation, permissions) in one sync_to_async hop. Other
+methods are handed to the sync view.
+"""
+from asgiref.sync import sync_to_async
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.renderers import BrowsableAPIRenderer
+
+from .principal import get_principal
+
+
+def async_get(view):
+    """Registers the decorated coroutine function as the aget() of a function view made with @api_view."""
+    def register(handler):
+        view.cls.aget = lambda self, request, *args, **kwargs: handler(request, *args, **kwargs)
+        return handler
+    return register
+
+
+def _initial(view, request, *args, **kwargs):
+    view.initial(request, *args, **kwargs)
+    # loaded here, the handler's get_principal() calls never touch the database
+    get_principal(request)
+
+
+async def dispatch(view, request, *args, **kwargs):
+    """APIView.dispatch() for GET / HEAD, awaiting the view's aget()."""
+    view.args = args
+    view.kwargs = kwargs
+    request = view.initialize_request(request, *args, **kwargs)
+    view.request = request
+    view.headers = view.default_response_headers
+    # the browsable API renders its forms with the sync ORM: that page is served in a thread
+    browsable = False
+    try:
+        await sync_to_async(_initial)(view, request, *args, **kwargs)
+        browsable = isinstance(request.accepted_renderer, BrowsableAPIRenderer)
+        if browsable:
+            response = await sync_to_async(view.get)(request, *args, **kwargs)
+        else:
+            response = await view.aget(request, *args, **kwargs)
+    except Exception as exc:
+        response = view.handle_exception(exc)
+    view.response = view.finalize_response(request, response, *args, **kwargs)
+    if browsable:
+        return await sync_to_async(view.response.render)()
+    return view.response.render()
+
+
+def async_view(sync_view):
+    """The ASGI view of a DRF view whose class has an aget(). Other methods run the sync view in a thread."""
+    cls, initkwargs = sync_view.cls, sync_view.initkwargs
+    run_sync_view = sync_to_async(sync_view)
+
+    async def view(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return await run_sync_view(request, *args, **kwargs)
+        self = cls(**initkwargs)
+        self.setup(request, *args, **kwargs)
+        return await dispatch(self, request, *args, **kwargs)
+
+    view.cls = cls
+    view.initkwargs = initkwargs
+    # like DRF: CSRF is enforced by SessionAuthentication, for the unsafe methods only
+    return csrf_exempt(view)
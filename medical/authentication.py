@@ -0,0 +1,118 @@
+import copy
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from .cache import LRUCache
+from .metrics import register_collector
+
+
+class TokenCache:
+    """
+    Token key -> (user, token) lookups kept off the database.
+
+    Without TOKEN_CACHE_ALIAS entries live in a bounded in-process LRU (TOKEN_CACHE_MAX_SIZE /
+    TOKEN_CACHE_TTL). When it names a Django cache (e.g. redis/memcached) that cache is the only
+    level: a local copy would keep a token revoked on another worker working here until it
+    expires. Deleting a token must go through invalidate()/revoke_token() so it is forgotten.
+    """
+
+    def __init__(self):
+        self.local = LRUCache(
+            max_size=getattr(settings, 'TOKEN_CACHE_MAX_SIZE', 10000),
+            ttl=getattr(settings, 'TOKEN_CACHE_TTL', 300),
+            tag=lambda entry: entry[0].pk,  # the user's id, for invalidate_user()
+        )
+        self.shared_hits = 0
+        self.shared_misses = 0
+
+    @property
+    def shared(self):
+        alias = getattr(settings, 'TOKEN_CACHE_ALIAS', None)
+        return caches[alias] if alias else None
+
+    @staticmethod
+    def shared_key(key):
+        # never use the raw token as a cache key
+        return 'medical:token:' + hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key):
+        shared = self.shared
+        if shared is None:
+            return self.local.get(key)
+        entry = shared.get(self.shared_key(key))
+        if entry is None:
+            self.shared_misses += 1
+        else:
+            self.shared_hits += 1
+        return entry
+
+    def set(self, key, user, token):
+        entry = (user, token)
+        shared = self.shared
+        if shared is None:
+            self.local.set(key, entry)
+        else:
+            shared.set(self.shared_key(key), entry, self.local.ttl)
+
+    def invalidate(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(self.shared_key(key))
+
+    def invalidate_user(self, user_id):
+        """Forgets every cached token of a user, e.g. after the user was changed or deactivated."""
+        self.local.delete_tagged(user_id)
+        if self.shared is not None:
+            for key in Token.objects.filter(user_id=user_id).values_list('key', flat=True):
+                self.shared.delete(self.shared_key(key))
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self):
+        return {
+            **self.local.stats(),
+            'shared_hits': self.shared_hits,
+            'shared_misses': self.shared_misses,
+        }
+
+
+token_cache = TokenCache()
+register_collector('token_cache', lambda: {
+    key: value for key, value in token_cache.stats().items()
+    if key in ('hits', 'misses', 'evictions', 'shared_hits', 'shared_misses')
+})
+
+
+def revoke_token(user):
+    """
+    Deletes the user's auth token and evicts it from the token cache.
+    Returns False if the user had no token.
+    """
+    try:
+        token = Token.objects.get(user=user)
+    except Token.DoesNotExist:
+        return False
+    token_cache.invalidate(token.key)
+    token.delete()
+    return True
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Drop-in replacement for DRF's TokenAuthentication that serves lookups from token_cache.
+    """
+
+    def authenticate_credentials(self, key):
+        entry = token_cache.get(key)
+        if entry is None:
+            user, token = super().authenticate_credentials(key)
+            token_cache.set(key, user, token)
+        else:
+            user, token = entry
+        # hand out a copy so one request can't leak state (cached relations etc.) into another
+        return copy.copy(user), token
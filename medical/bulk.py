@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.db import transaction
+
+from .models import Patient, PatientRecord
+from .serializers import PatientRecordBulkItemSerializer
+
+
+def ingest_patient_records(items, principal):
+    """
+    Validates and inserts many PatientRecords at once.
+
+    Every item is validated on its own (no queries), then all patient ids are checked with one
+    query and the valid records are inserted with bulk_create in one transaction. Returns one
+    result per item, in input order: {'index', 'status': 'created', 'record_id'} or
+    {'index', 'status': 'error', 'errors'}.
+    """
+    results = [None] * len(items)
+    pending = []  # (index, validated_data)
+    for index, item in enumerate(items):
+        serializer = PatientRecordBulkItemSerializer(data=item)
+        if serializer.is_valid():
+            pending.append((index, serializer.validated_data))
+        else:
+            results[index] = {'index': index, 'status': 'error', 'errors': serializer.errors}
+
+    patient_ids = {data['patient'] for _, data in pending}
+    patient_departments = dict(Patient.objects.filter(pk__in=patient_ids).values_list('id', 'department_id'))
+
+    records = []
+    for index, data in pending:
+        patient_id = data.pop('patient')
+        if patient_id not in patient_departments:
+            results[index] = {'index': index, 'status': 'error', 'errors': {'patient': ['Invalid patient ID.']}}
+            continue
+        if principal.is_doctor:
+            # doctors may only write into their own department
+            if patient_departments[patient_id] != principal.department_id:
+                results[index] = {'index': index, 'status': 'error', 'errors': {'patient': ['Patient does not belong to your department.']}}
+                continue
+            department_id = principal.department_id
+        else:
+            department_id = patient_departments[patient_id]
+        records.append((index, PatientRecord(patient_id=patient_id, department_id=department_id, **data)))
+
+    with transaction.atomic():
+        PatientRecord.objects.bulk_create(
+            [record for _, record in records],
+            batch_size=settings.BULK_RECORDS_BATCH_SIZE,
+        )
+
+    for index, record in records:
+        results[index] = {'index': index, 'status': 'created', 'record_id': record.record_id}
+    return results
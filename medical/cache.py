@@ -0,0 +1,142 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache as default_cache
+
+
+class LRUCache:
+    """
+    Small thread-safe in-process LRU with a per-entry TTL and hit/miss counters.
+    Every gunicorn worker has its own copy, so keep the TTL short for anything that can go stale.
+
+    With `tag(value) -> hashable` the entries are indexed by tag, and delete_tagged(tag) drops
+    the entries of one tag without scanning the others.
+    """
+
+    def __init__(self, max_size=1000, ttl=300, tag=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.tag = tag
+        self._entries = OrderedDict()
+        self._tagged = {}  # tag -> keys
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at, value)
+            if self.tag is not None:
+                self._tagged.setdefault(self.tag(value), set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        # with the lock held
+        _, value = self._entries.pop(key)
+        if self.tag is not None:
+            tag = self.tag(value)
+            keys = self._tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tagged[tag]
+
+    def delete(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._remove(key)
+            return True
+
+    def delete_tagged(self, tag):
+        """Drops every entry tagged `tag`, returns how many were removed."""
+        with self._lock:
+            keys = self._tagged.pop(tag, ())
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tagged.clear()
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        lookups = self.hits + self.misses
+        return {
+            'size': size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+_build_locks = {}
+_build_locks_guard = threading.Lock()
+
+
+def _build_lock(key):
+    with _build_locks_guard:
+        return _build_locks.setdefault(key, threading.Lock())
+
+
+def get_or_build(key, builder, timeout=None, cache=None, wait=5.0):
+    """
+    cache.get(key), rebuilding the value with builder() on a miss.
+
+    Concurrent misses are coalesced (single flight): threads of this worker wait on a local lock,
+    other workers wait for a short-lived cache.add() lock and then read what the winner stored.
+    If the winner doesn't finish within `wait` seconds the value is built without being cached.
+    """
+    cache = cache or default_cache
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    with _build_lock(key):
+        value = cache.get(key)
+        if value is not None:
+            return value
+
+        lock_key = f'{key}:lock'
+        if cache.add(lock_key, 1, wait):
+            try:
+                value = builder()
+                cache.set(key, value, timeout)
+            finally:
+                cache.delete(lock_key)
+            return value
+
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            value = cache.get(key)
+            if value is not None:
+                return value
+        return builder()
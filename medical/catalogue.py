@@ -0,0 +1,47 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max
+from rest_framework.renderers import JSONRenderer
+
+from .cache import get_or_build
+from .models import Department
+from .replicas import PRIMARY
+from .serializers import DepartmentSerializer
+from .utils import make_etag
+
+CATALOGUE_CACHE_KEY = 'medical:department-catalogue'
+# the database's side of the catalogue version: any insert, update or delete changes one of them
+CATALOGUE_VERSION = {'count': Count('pk'), 'updated': Max('updated_at')}
+
+
+def catalogue_key(version):
+    updated = version['updated'].timestamp() if version['updated'] else 0
+    return f"{CATALOGUE_CACHE_KEY}:{version['count']}:{updated}"
+
+
+def build_department_catalogue():
+    data = list(DepartmentSerializer(Department.objects.using(PRIMARY), many=True).data)
+    return {'data': data, 'etag': make_etag(JSONRenderer().render(data))}
+
+
+def get_department_catalogue():
+    """
+    The serialized department list and its ETag, served from the cache.
+
+    Entries are keyed on the departments' count and latest updated_at, read from the database
+    on every call: a change is seen by every worker on its next request, whatever cache holds
+    the entries. Only one worker rebuilds a new version, the others wait for its result. Both
+    read the primary, a lagging replica would pair an old version or old rows with the new key.
+    """
+    key = catalogue_key(Department.objects.using(PRIMARY).aggregate(**CATALOGUE_VERSION))
+    return get_or_build(key, build_department_catalogue, timeout=settings.DEPARTMENT_CATALOGUE_TTL)
+
+
+async def aget_department_catalogue():
+    """get_department_catalogue() for async views. Only a cache miss leaves the event loop."""
+    key = catalogue_key(await Department.objects.using(PRIMARY).aaggregate(**CATALOGUE_VERSION))
+    catalogue = await cache.aget(key)
+    if catalogue is None:
+        catalogue = await sync_to_async(get_or_build)(key, build_department_catalogue, timeout=settings.DEPARTMENT_CATALOGUE_TTL)
+    return catalogue
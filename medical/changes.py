@@ -0,0 +1,218 @@
+"""
+Change feed of a patient's records (patient_records/<pk>/changes/?cursor=).
+
+Database triggers (installed by migration 0009_recordchange) append a RecordChange row for
+every insert, update and delete of a PatientRecord, in the same transaction, bulk_create,
+queryset.update() and cascades included. A record moved to another patient is a delete for
+the old one and a create for the new one. Updates that change nothing (the If-Match claim
+of medical/versioning.py) aren't logged.
+
+seq is the cursor, and cursors are per patient. On PostgreSQL the trigger takes a
+transaction-level advisory lock on each patient whose records the statement writes (in patient
+order) before appending, so the writers of one patient get their seqs in commit order and a
+reader can never pass a seq that a slower transaction commits later. Writers of different
+patients don't wait for each other: their seqs interleave out of commit order, which is why a
+snapshot's cursor is the patient's latest seq, not the log's. A transaction writing records of
+several patients in several statements can still deadlock with another one locking them in
+another order, PostgreSQL then aborts one of them. SQLite has a single writer anyway.
+
+A client without a cursor gets every record as created, and the cursor to poll from. The
+next polls return what changed after it: one entry per record (its latest state, or a
+tombstone), `limit` log rows at a time. The log isn't pruned.
+
+Records moved to the archive (medical/archive.py) are logged 'archived': not a change for the
+clients, which keep them. The snapshot includes them with ?include_archived=1.
+"""
+from django.conf import settings
+
+from .models import ArchivedPatientRecord, PatientRecord, RecordChange
+from .projection import compile_projection
+from .serializers import PatientRecordSerializer
+
+CHANGE_TABLE = RecordChange._meta.db_table
+RECORD_TABLE = PatientRecord._meta.db_table
+
+_COLUMNS = ('patient_id', 'created_date', 'diagnostics', 'observations', 'treatments', 'department_id', 'misc', 'version', 'updated_at')
+_CHANGED = ' OR '.join(f'old.{column} IS NOT new.{column}' for column in _COLUMNS)
+_NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+
+def _sqlite_log(row, operation):
+    return (
+        f'INSERT INTO {CHANGE_TABLE} (record_id, patient_id, operation, changed_at) '
+        f"VALUES ({row}.record_id, {row}.patient_id, '{operation}', {_NOW});"
+    )
+
+
+SQLITE_TRIGGERS_SQL = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {CHANGE_TABLE}_ai AFTER INSERT ON {RECORD_TABLE} BEGIN
+        {_sqlite_log('new', 'created')}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {CHANGE_TABLE}_ad AFTER DELETE ON {RECORD_TABLE} BEGIN
+        {_sqlite_log('old', 'deleted')}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {CHANGE_TABLE}_au AFTER UPDATE ON {RECORD_TABLE}
+    WHEN old.patient_id IS new.patient_id AND ({_CHANGED}) BEGIN
+        {_sqlite_log('new', 'updated')}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {CHANGE_TABLE}_au_moved AFTER UPDATE OF patient_id ON {RECORD_TABLE}
+    WHEN old.patient_id IS NOT new.patient_id BEGIN
+        {_sqlite_log('old', 'deleted')}
+        {_sqlite_log('new', 'created')}
+    END
+    """,
+]
+
+_PG_INSERT = f'INSERT INTO {CHANGE_TABLE} (record_id, patient_id, operation, changed_at)'
+_PG_JOINED = 'FROM old_rows o JOIN new_rows n ON n.record_id = o.record_id'
+
+
+def _pg_lock(patients):
+    """Locks the patients of the `patients` query until commit, in patient order."""
+    return (
+        f"PERFORM pg_advisory_xact_lock(hashtext('{CHANGE_TABLE}'), patient_id) "
+        f'FROM ({patients} ORDER BY patient_id) patients;'
+    )
+
+
+POSTGRESQL_FUNCTION_SQL = f"""
+CREATE OR REPLACE FUNCTION {CHANGE_TABLE}_log() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    -- held until commit: a patient's seqs are handed out in commit order
+    IF TG_OP = 'INSERT' THEN
+        {_pg_lock('SELECT DISTINCT patient_id FROM new_rows')}
+        {_PG_INSERT} SELECT record_id, patient_id, 'created', now() FROM new_rows ORDER BY record_id;
+    ELSIF TG_OP = 'DELETE' THEN
+        {_pg_lock('SELECT DISTINCT patient_id FROM old_rows')}
+        {_PG_INSERT} SELECT record_id, patient_id, 'deleted', now() FROM old_rows ORDER BY record_id;
+    ELSE
+        {_pg_lock('SELECT patient_id FROM old_rows UNION SELECT patient_id FROM new_rows')}
+        {_PG_INSERT} SELECT n.record_id, n.patient_id, 'updated', now() {_PG_JOINED}
+            WHERE o.patient_id = n.patient_id AND o IS DISTINCT FROM n ORDER BY n.record_id;
+        {_PG_INSERT} SELECT record_id, patient_id, operation, now() FROM (
+            SELECT o.record_id, o.patient_id, 'deleted' AS operation, 0 AS step {_PG_JOINED} WHERE o.patient_id <> n.patient_id
+            UNION ALL
+            SELECT n.record_id, n.patient_id, 'created', 1 {_PG_JOINED} WHERE o.patient_id <> n.patient_id
+        ) moved ORDER BY record_id, step;
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+POSTGRESQL_TRIGGERS_SQL = [
+    f'DROP TRIGGER IF EXISTS {CHANGE_TABLE}_ins ON {RECORD_TABLE}',
+    f'CREATE TRIGGER {CHANGE_TABLE}_ins AFTER INSERT ON {RECORD_TABLE} REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {CHANGE_TABLE}_log()',
+    f'DROP TRIGGER IF EXISTS {CHANGE_TABLE}_del ON {RECORD_TABLE}',
+    f'CREATE TRIGGER {CHANGE_TABLE}_del AFTER DELETE ON {RECORD_TABLE} REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION {CHANGE_TABLE}_log()',
+    f'DROP TRIGGER IF EXISTS {CHANGE_TABLE}_upd ON {RECORD_TABLE}',
+    f'CREATE TRIGGER {CHANGE_TABLE}_upd AFTER UPDATE ON {RECORD_TABLE} REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {CHANGE_TABLE}_log()',
+]
+
+
+def install_change_triggers(connection):
+    """Creates (or recreates) the change log triggers. Idempotent."""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            for statement in SQLITE_TRIGGERS_SQL:
+                cursor.execute(statement)
+        elif connection.vendor == 'postgresql':
+            cursor.execute(POSTGRESQL_FUNCTION_SQL)
+            for statement in POSTGRESQL_TRIGGERS_SQL:
+                cursor.execute(statement)
+
+
+def restore_change_triggers(connection):
+    """SQLite drops them when Django rebuilds medical_patientrecord, called after every migrate."""
+    if connection.vendor == 'sqlite' and CHANGE_TABLE in connection.introspection.table_names():
+        install_change_triggers(connection)
+
+
+def uninstall_change_triggers(connection):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            for suffix in ('ai', 'ad', 'au', 'au_moved'):
+                cursor.execute(f'DROP TRIGGER IF EXISTS {CHANGE_TABLE}_{suffix}')
+        elif connection.vendor == 'postgresql':
+            for suffix in ('ins', 'del', 'upd'):
+                cursor.execute(f'DROP TRIGGER IF EXISTS {CHANGE_TABLE}_{suffix} ON {RECORD_TABLE}')
+            cursor.execute(f'DROP FUNCTION IF EXISTS {CHANGE_TABLE}_log()')
+
+
+def latest_change(patient_id):
+    """(seq, changed_at) of the patient's latest record change, (None, None) if the log has none."""
+    return RecordChange.objects.filter(patient_id=patient_id).order_by('-seq').values_list('seq', 'changed_at').first() or (None, None)
+
+
+async def alatest_change(patient_id):
+    return await RecordChange.objects.filter(patient_id=patient_id).order_by('-seq').values_list('seq', 'changed_at').afirst() or (None, None)
+
+
+def _render(records):
+    projection = compile_projection(PatientRecordSerializer)
+    if projection is None:
+        return PatientRecordSerializer(PatientRecordSerializer.setup_eager_loading(records), many=True).data
+    return projection.render(projection.values(records))
+
+
+def record_snapshot(patient_id, include_archived=False):
+    """Every record of the patient (archived ones too if asked) as created, with the cursor to poll from."""
+    # the cursor first: a change between the two queries is in the snapshot and replayed once more.
+    # The patient's, not the log's: another patient's later seq can commit before this one's last.
+    cursor = latest_change(patient_id)[0] or 0
+    records = _render(PatientRecord.objects.filter(patient_id=patient_id).order_by('record_id'))
+    if include_archived:
+        archived = _render(ArchivedPatientRecord.objects.filter(patient_id=patient_id).order_by('record_id'))
+        records = sorted(records + archived, key=lambda record: record['record_id'])
+    changes = [{'seq': cursor, 'operation': 'created', 'record_id': record['record_id'], 'record': record} for record in records]
+    return {'cursor': cursor, 'has_more': False, 'changes': changes}
+
+
+def record_changes(patient_id, cursor, limit=None):
+    """
+    The patient's record changes after cursor: up to `limit` log rows, folded into one entry per
+    record in the order of its last change. Records that still exist come with their current
+    data (created if the first change in the page created them, else updated), the others as
+    deleted tombstones. Archival isn't a change: it only moves the cursor, and a record changed
+    then archived in the page comes with its archived data.
+    """
+    limit = limit or settings.RECORD_CHANGES_PAGE_SIZE
+    rows = list(
+        RecordChange.objects.filter(patient_id=patient_id, seq__gt=cursor)
+        .order_by('seq').values_list('seq', 'record_id', 'operation')[:limit + 1]
+    )
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    folded = {}  # record_id -> (seq of the last change, first operation, last operation)
+    for seq, record_id, operation in rows:
+        if operation == 'archived':
+            continue
+        first = folded[record_id][1] if record_id in folded else operation
+        folded[record_id] = (seq, first, operation)
+    alive = [record_id for record_id, (_, _, last) in folded.items() if last != 'deleted']
+    current = {}
+    if alive:
+        records = PatientRecord.objects.filter(patient_id=patient_id, record_id__in=alive).order_by('record_id')
+        current = {record['record_id']: record for record in _render(records)}
+        moved = [record_id for record_id in alive if record_id not in current]
+        if moved:
+            records = ArchivedPatientRecord.objects.filter(patient_id=patient_id, record_id__in=moved).order_by('record_id')
+            current.update((record['record_id'], record) for record in _render(records))
+
+    changes = []
+    for record_id, (seq, first, last) in sorted(folded.items(), key=lambda item: item[1][0]):
+        record = current.get(record_id)
+        if record is None:
+            # deleted, or moved to another patient (maybe in a later page)
+            changes.append({'seq': seq, 'operation': 'deleted', 'record_id': record_id})
+        else:
+            changes.append({'seq': seq, 'operation': 'created' if first == 'created' else 'updated', 'record_id': record_id, 'record': record})
+    return {'cursor': rows[-1][0] if rows else cursor, 'has_more': has_more, 'changes': changes}
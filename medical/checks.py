@@ -0,0 +1,74 @@
+import os
+
+from django.conf import settings
+from django.core.checks import Error, Tags, Warning, register
+
+# backends whose entries only the process that wrote them sees
+PER_PROCESS_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def _per_process(alias):
+    return settings.CACHES.get(alias, {}).get('BACKEND') in (None, *PER_PROCESS_CACHES)
+
+
+def _workers():
+    """gunicorn's worker count when it comes from the environment (its default is 1)."""
+    try:
+        return int(os.environ.get('WEB_CONCURRENCY', 1))
+    except ValueError:
+        return 1
+
+
+@register(Tags.database, Tags.caches)
+def check_replicas(app_configs, **kwargs):
+    """A pin must outlast the lag of the replicas still read from, and every worker must see it."""
+    if not settings.DATABASE_REPLICAS:
+        return []
+    errors = []
+    window = settings.REPLICA_MAX_LAG_SECONDS + settings.REPLICA_LAG_CHECK_SECONDS
+    if settings.REPLICA_PIN_SECONDS < window:
+        errors.append(Error(
+            f'REPLICA_PIN_SECONDS ({settings.REPLICA_PIN_SECONDS}) is shorter than the {window} s a write can take to '
+            'reach the replicas still read from: a client could read from one that misses its write.',
+            hint='Raise REPLICA_PIN_SECONDS to REPLICA_MAX_LAG_SECONDS + REPLICA_LAG_CHECK_SECONDS, or lower those.',
+            id='medical.E001',
+        ))
+    if _per_process(settings.REPLICA_PIN_CACHE_ALIAS):
+        errors.append(Error(
+            f'The replica pins are kept in the {settings.REPLICA_PIN_CACHE_ALIAS!r} cache, which the other workers '
+            "don't see: a client's next request can go to a worker that sends it to a replica missing its write.",
+            hint='Set SHARED_CACHE_URL, or REPLICA_PIN_CACHE_ALIAS to a cache shared by the workers.',
+            id='medical.E002',
+        ))
+    return errors
+
+
+@register(Tags.caches)
+def check_detail_cache(app_configs, **kwargs):
+    """Several workers each with their own detail cache serve each other's stale entries."""
+    if _workers() > 1 and _per_process(settings.DETAIL_CACHE_ALIAS):
+        return [Warning(
+            f'{_workers()} workers, each with its own {settings.DETAIL_CACHE_ALIAS!r} detail cache: a change only '
+            'invalidates the entries of the worker that made it, the others serve the old patient or doctor '
+            'for up to DETAIL_CACHE_TTL seconds.',
+            hint='Set SHARED_CACHE_URL, or DETAIL_CACHE_ALIAS to a cache shared by the workers.',
+            id='medical.W001',
+        )]
+    return []
+
+
+@register(Tags.caches)
+def check_token_cache(app_configs, **kwargs):
+    """Several workers each with their own token cache keep accepting each other's revoked tokens."""
+    alias = settings.TOKEN_CACHE_ALIAS
+    if _workers() > 1 and (not alias or _per_process(alias)):
+        return [Warning(
+            f'{_workers()} workers, each caching tokens for itself: logging out or deleting a user only evicts the '
+            'token from the worker that handled it, the others accept it for up to TOKEN_CACHE_TTL seconds.',
+            hint='Set SHARED_CACHE_URL, or TOKEN_CACHE_ALIAS to a cache shared by the workers.',
+            id='medical.W002',
+        )]
+    return []
@@ -0,0 +1,83 @@
+"""
+Denormalized counters: doctors, patients and records per department, patients per doctor.
+
+Like the search index, the counters are maintained by triggers (installed by migration
+0006_department_counters), so they follow every insert, delete and reassignment in the same
+transaction whatever issued the SQL: bulk_create, queryset.update(), and the UPDATE ... SET
+department_id = NULL Django itself runs for on_delete=SET_NULL, which sends no signals:
+
+* SQLite: row triggers adding or subtracting one.
+* PostgreSQL: statement triggers with transition tables, so a bulk_create of 5000 records
+  updates each department row once instead of 5000 times.
+
+Other databases get no triggers and depend on reconcile_counters(), which recomputes every
+counter from COUNT queries and fixes the ones that drifted (manage.py reconcile_counters, run
+it periodically from cron). A write racing the reconciliation can leave a small drift that
+the next run fixes.
+
+The trigger SQL exists once, frozen in the migrations (0006, and 0010 for the archive); the
+post_migrate restore reinstalls it from there.
+
+Department.record_count counts archived records too (medical/archive.py): moving a record to
+the archive is one decrement and one increment.
+"""
+from importlib import import_module
+
+from django.db import connections
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import ArchivedPatientRecord, Department, Doctor, Patient, PatientRecord
+
+# (model counted, its foreign key, model holding the counter, counter field)
+COUNTERS = [
+    (Doctor, 'department', Department, 'doctor_count'),
+    (Patient, 'department', Department, 'patient_count'),
+    (Patient, 'assigned_doctor', Doctor, 'patient_count'),
+    (PatientRecord, 'department', Department, 'record_count'),
+    (ArchivedPatientRecord, 'department', Department, 'record_count'),
+]
+
+# the same counters as the migrations install them: trigger names and table/column names
+department_counters = import_module('medical.migrations.0006_department_counters')
+archived_patient_record = import_module('medical.migrations.0010_archivedpatientrecord')
+COUNTER_TRIGGERS = department_counters.COUNTERS + archived_patient_record.ARCHIVE_COUNTERS
+
+
+def restore_counter_triggers(connection):
+    """
+    SQLite drops a table's triggers when Django rebuilds it during a migration. Called after
+    every migrate, does nothing before migration 0006 created the counters.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    columns = [column.name for column in connection.introspection.get_table_description(connection.cursor(), Department._meta.db_table)]
+    if 'record_count' in columns:
+        existing = connection.introspection.table_names()
+        # the archive has none before migration 0010 creates it
+        department_counters.install_counter_triggers(
+            connection, [tables for tables in COUNTER_TRIGGERS if tables['source'] in existing]
+        )
+
+
+def reconcile_counters(using='default'):
+    """
+    Recomputes every counter and fixes the stored values that differ, one UPDATE per counter.
+    Returns {'<model>.<counter>': rows fixed}; all zeros means nothing had drifted.
+    """
+    existing = connections[using].introspection.table_names()
+    sources = {}  # (target, counter) -> [(source, fk_name)], record_count adds up two tables
+    for source, fk_name, target, counter in COUNTERS:
+        if source._meta.db_table in existing:
+            sources.setdefault((target, counter), []).append((source, fk_name))
+    fixed = {}
+    for (target, counter), counted in sources.items():
+        expected = sum(
+            Coalesce(Subquery(
+                source.objects.using(using).filter(**{fk_name: OuterRef('pk')}).order_by().values(fk_name).annotate(total=Count('pk')).values('total')
+            ), 0)
+            for source, fk_name in counted
+        )
+        drifted = target.objects.using(using).annotate(expected=expected).exclude(**{counter: F('expected')})
+        fixed[f'{target._meta.model_name}.{counter}'] = drifted.update(**{counter: expected})
+    return fixed
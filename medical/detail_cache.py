@@ -0,0 +1,189 @@
+"""
+Read-through cache of the patient and doctor detail representations (GET patients/<pk>/ and
+doctors/<pk>/), the bedside tablets' most frequent calls.
+
+An entry is keyed by the object's pk and version. The version is a random token stored next
+to the entries and replaced (not incremented: an evicted token can't come back with an old
+value) when something the representation is built from changes:
+
+- post_save / post_delete of the Patient or Doctor,
+- post_save / post_delete of its User, and for a doctor's user also of the patients showing
+  its username as assigned_doctor_name,
+- post_delete of a Doctor and post_save / post_delete of a Department: every entry, through a
+  global version, as the database nulls the foreign keys pointing to them without signals.
+
+Versions are replaced after commit. A reader that loaded the old rows before that stored them
+under the old version, which nobody asks for anymore. Misses read the primary: rows from a
+lagging replica (medical/replicas.py) would be stored under the new version.
+
+DETAIL_CACHE_ALIAS picks the Django cache: the shared one (SHARED_CACHE_URL) when there is
+one, else local memory. That one is per worker: a write only invalidates the worker that
+handled it, the others serve the old representation for at most DETAIL_CACHE_TTL seconds
+(manage.py check warns when WEB_CONCURRENCY says there are several workers).
+Access isn't decided on that old data: a doctor reading someone else's profile is checked
+against the patient's assigned doctor in the database (views.current_assignment).
+
+Patients have no updated_at of their own (the representation also shows their user, doctor and
+department), so an entry's Last-Modified is when it was read: every change that invalidates it
+makes the next read later. An entry rebuilt after a plain eviction gets a new date too, which
+only costs the If-Modified-Since clients a full response.
+"""
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .metrics import register_collector
+from .models import Doctor, Patient
+from .replicas import PRIMARY
+from .serializers import DoctorSerializer, PatientSerializer
+
+# kind -> model, serializer, the attributes the views' permission checks read
+KINDS = {
+    'patient': (Patient, PatientSerializer, ('user_id', 'assigned_doctor_id')),
+    'doctor': (Doctor, DoctorSerializer, ('user_id', 'department_id')),
+}
+GLOBAL_VERSION_KEY = 'medical:detail:version'
+
+# User fields the representations show, other User saves (last_login, password) keep the entries
+USER_FIELDS = {'username', 'first_name', 'last_name'}
+
+
+class CachedDetail:
+    """
+    A cached object: its serialized data, the ids permission checks need without a query, and
+    when it was read (the Last-Modified of the response).
+    """
+    __slots__ = ('pk', 'data', 'modified', 'user_id', 'assigned_doctor_id', 'department_id')
+
+    def __init__(self, pk, data, modified, **ids):
+        self.pk = pk
+        self.data = data
+        self.modified = modified
+        for name in ('user_id', 'assigned_doctor_id', 'department_id'):
+            setattr(self, name, ids.get(name))
+
+
+def _version_key(kind, pk):
+    return f'medical:detail:{kind}:{pk}:version'
+
+
+def _new_version():
+    return uuid.uuid4().hex[:16]
+
+
+class DetailCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    @property
+    def cache(self):
+        return caches[settings.DETAIL_CACHE_ALIAS]
+
+    # lookups
+
+    def get(self, kind, pk):
+        """The object's CachedDetail, built from the database on a miss. None if it doesn't exist."""
+        started = time.perf_counter()
+        key, started_versions = self._entry_key(kind, pk, self.cache.get_many([GLOBAL_VERSION_KEY, _version_key(kind, pk)]))
+        if started_versions:
+            self.cache.set_many(started_versions, None)
+        entry = self.cache.get(key)
+        if entry is not None:
+            self._observe(kind, True, time.perf_counter() - started)
+            return entry
+        model, serializer_class, _ = KINDS[kind]
+        read_at = timezone.now()
+        try:
+            instance = serializer_class.setup_eager_loading(model.objects.using(PRIMARY)).get(pk=pk)
+        except model.DoesNotExist:
+            return None
+        entry = self._entry(kind, instance, read_at)
+        self.cache.set(key, entry, settings.DETAIL_CACHE_TTL)
+        self._observe(kind, False, time.perf_counter() - started)
+        return entry
+
+    async def aget(self, kind, pk):
+        """get() for async views, with the async ORM on a miss."""
+        started = time.perf_counter()
+        key, started_versions = self._entry_key(kind, pk, await self.cache.aget_many([GLOBAL_VERSION_KEY, _version_key(kind, pk)]))
+        if started_versions:
+            await self.cache.aset_many(started_versions, None)
+        entry = await self.cache.aget(key)
+        if entry is not None:
+            self._observe(kind, True, time.perf_counter() - started)
+            return entry
+        model, serializer_class, _ = KINDS[kind]
+        read_at = timezone.now()
+        try:
+            instance = await serializer_class.setup_eager_loading(model.objects.using(PRIMARY)).aget(pk=pk)
+        except model.DoesNotExist:
+            return None
+        entry = self._entry(kind, instance, read_at)
+        await self.cache.aset(key, entry, settings.DETAIL_CACHE_TTL)
+        self._observe(kind, False, time.perf_counter() - started)
+        return entry
+
+    @staticmethod
+    def _entry_key(kind, pk, versions):
+        """
+        The entry key for the versions found, and the versions to store for those that aren't in
+        the cache (yet, or evicted): new tokens, whatever was cached under the old ones is out of reach.
+        """
+        version_key = _version_key(kind, pk)
+        started = {key: _new_version() for key in (GLOBAL_VERSION_KEY, version_key) if key not in versions}
+        versions = {**versions, **started}
+        return f'medical:detail:{kind}:{pk}:{versions[GLOBAL_VERSION_KEY]}.{versions[version_key]}', started
+
+    @staticmethod
+    def _entry(kind, instance, read_at):
+        _, serializer_class, ids = KINDS[kind]
+        # a plain dict: ReturnDict would pickle the serializer along
+        data = dict(serializer_class(instance).data)
+        return CachedDetail(instance.pk, data, read_at, **{name: getattr(instance, name) for name in ids})
+
+    # invalidation
+
+    def invalidate(self, kind, pks):
+        """Replaces the objects' versions once the current transaction commits."""
+        pks = list(pks)
+        if pks:
+            transaction.on_commit(lambda: self.cache.set_many({_version_key(kind, pk): _new_version() for pk in pks}, None))
+
+    def invalidate_all(self):
+        transaction.on_commit(lambda: self.cache.set(GLOBAL_VERSION_KEY, _new_version(), None))
+
+    def invalidate_user(self, user_id):
+        """The user's patient / doctor, and the patients of the doctor whose username they show."""
+        self.invalidate('patient', Patient.objects.filter(Q(user_id=user_id) | Q(assigned_doctor__user_id=user_id)).values_list('pk', flat=True))
+        self.invalidate('doctor', Doctor.objects.filter(user_id=user_id).values_list('pk', flat=True))
+
+    # metrics
+
+    def _observe(self, kind, hit, seconds):
+        with self._lock:
+            stats = self._stats.setdefault(kind, {'hits': 0, 'misses': 0, 'hit_seconds': 0.0, 'miss_seconds': 0.0, 'saved_seconds': 0.0})
+            if hit:
+                stats['hits'] += 1
+                stats['hit_seconds'] += seconds
+                if stats['misses']:
+                    # against the average cost of a miss: what the hit spared the request
+                    stats['saved_seconds'] += max(stats['miss_seconds'] / stats['misses'] - seconds, 0.0)
+            else:
+                stats['misses'] += 1
+                stats['miss_seconds'] += seconds
+
+    def stats(self):
+        """Per kind: hits, misses, seconds spent in each and the estimated seconds saved by the hits."""
+        with self._lock:
+            return {f'{kind}_{name}': value for kind, stats in self._stats.items() for name, value in stats.items()}
+
+
+detail_cache = DetailCache()
+register_collector('detail_cache', detail_cache.stats)
@@ -0,0 +1,97 @@
+import csv
+import io
+import json
+import zlib
+
+from .models import PatientRecord
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+
+# column name -> ORM lookup
+EXPORT_COLUMNS = {
+    'record_id': 'record_id',
+    'patient': 'patient_id',
+    'patient_name': 'patient__user__username',
+    'department': 'department_id',
+    'department_name': 'department__name',
+    'created_date': 'created_date',
+    'diagnostics': 'diagnostics',
+    'observations': 'observations',
+    'treatments': 'treatments',
+    'misc': 'misc',
+}
+
+# rows are flushed in chunks of roughly this many bytes
+FLUSH_SIZE = 64 * 1024
+
+
+def export_rows(department_id=None, chunk_size=2000):
+    """
+    Yields PatientRecord rows as tuples (see EXPORT_COLUMNS) in record_id order.
+    QuerySet.iterator() keeps only one chunk in memory (a server side cursor on Postgres).
+    """
+    queryset = PatientRecord.objects.order_by('record_id')
+    if department_id is not None:
+        queryset = queryset.filter(department_id=department_id)
+    return queryset.values_list(*EXPORT_COLUMNS.values()).iterator(chunk_size=chunk_size)
+
+
+def _plain(value):
+    # same datetime format as the API (DRF's DateTimeField)
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+        if value.endswith('+00:00'):
+            value = value[:-6] + 'Z'
+    return value
+
+
+def _buffered(pieces):
+    buffer = []
+    size = 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= FLUSH_SIZE:
+            yield ''.join(buffer).encode()
+            buffer, size = [], 0
+    if buffer:
+        yield ''.join(buffer).encode()
+
+
+def iter_ndjson(rows):
+    columns = list(EXPORT_COLUMNS)
+    return _buffered(
+        json.dumps(dict(zip(columns, map(_plain, row))), separators=(',', ':')) + '\n'
+        for row in rows
+    )
+
+
+def iter_csv(rows):
+    def lines():
+        line = io.StringIO()
+        writer = csv.writer(line)
+        writer.writerow(EXPORT_COLUMNS)
+        for row in rows:
+            writer.writerow(map(_plain, row))
+            yield line.getvalue()
+            line.seek(0)
+            line.truncate()
+        if line.getvalue():  # nothing to export, only the header was written
+            yield line.getvalue()
+    return _buffered(lines())
+
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def stream_export(export_format='ndjson', department_id=None, gzip=False, chunk_size=2000):
+    """Byte chunks of the whole export, suitable for StreamingHttpResponse or writing to a file."""
+    rows = export_rows(department_id=department_id, chunk_size=chunk_size)
+    chunks = iter_csv(rows) if export_format == 'csv' else iter_ndjson(rows)
+    return gzip_stream(chunks) if gzip else chunks
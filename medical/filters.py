@@ -0,0 +1,65 @@
+import datetime
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend, OrderingFilter
+
+
+def _parse_bound(value, param):
+    """Accepts an ISO date or datetime, returns (aware datetime, whether a bare date was given)."""
+    try:
+        day = parse_date(value)
+        moment = datetime.datetime.combine(day, datetime.time.min) if day else parse_datetime(value)
+    except ValueError:
+        moment = None
+    if moment is None:
+        raise ValidationError({param: 'Use an ISO date (2024-01-31) or datetime (2024-01-31T12:00:00Z).'})
+    is_date = day is not None
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment, is_date
+
+
+def filter_created_range(queryset, params):
+    """
+    Applies ?created_after= / ?created_before= to a PatientRecord queryset. Both bounds are
+    inclusive, a bare date as upper bound covers the whole day.
+    """
+    created_after = params.get('created_after')
+    created_before = params.get('created_before')
+    if created_after:
+        after, _ = _parse_bound(created_after, 'created_after')
+        queryset = queryset.filter(created_date__gte=after)
+    if created_before:
+        before, is_date = _parse_bound(created_before, 'created_before')
+        if is_date:
+            queryset = queryset.filter(created_date__lt=before + datetime.timedelta(days=1))
+        else:
+            queryset = queryset.filter(created_date__lte=before)
+    return queryset
+
+
+def record_ordering(params, default=('-created_date', '-record_id')):
+    """
+    ?ordering=created_date or -created_date. record_id is always added as a tie breaker in the
+    same direction so the order is stable (cursor pagination depends on it).
+    """
+    value = params.get('ordering')
+    if value == 'created_date':
+        return ('created_date', 'record_id')
+    if value == '-created_date':
+        return ('-created_date', '-record_id')
+    if value:
+        raise ValidationError({'ordering': 'Use created_date or -created_date.'})
+    return default
+
+
+class CreatedDateRangeFilter(BaseFilterBackend):
+    def filter_queryset(self, request, queryset, view):
+        return filter_created_range(queryset, request.query_params)
+
+
+class RecordOrderingFilter(OrderingFilter):
+    def get_ordering(self, request, queryset, view):
+        return record_ordering(request.query_params)
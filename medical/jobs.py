@@ -0,0 +1,281 @@
+"""
+Background jobs without a broker: the Job table is the queue.
+
+Heavy operations asked with `Prefer: respond-async` (deleting a patient, bulk imports and
+registrations, exports) and the maintenance jobs POSTed to jobs/ are enqueue()d and answered
+with a 202 pointing to jobs/<id>/. `manage.py run_jobs --concurrency N` workers claim the
+queued jobs, call the handler registered for their kind and store its result.
+
+- A handler gets the job and its params, may report_progress(job, done, total) and returns a
+  JSON-serializable result. It runs outside any request, so params carry ids, not objects.
+- Claiming is a conditional UPDATE (after SELECT ... FOR UPDATE SKIP LOCKED where the database
+  has it): two workers never run the same job.
+- A failing job is queued again after JOB_RETRY_BACKOFF_SECONDS * 2^(attempts - 1), at most
+  JOB_RETRY_BACKOFF_MAX_SECONDS, until it has failed max_attempts times.
+- Progress reports are the job's heartbeat. A running job without one for JOB_STALE_SECONDS
+  lost its worker: it's queued again (or failed, out of attempts).
+
+A retried job runs again from the start. Handlers registered atomic=True run in the
+transaction that marks the job succeeded, so their writes commit exactly once; the others
+(long, batched) must be safe to run twice. Atomic jobs report no progress, so no heartbeat
+either: they have to finish within JOB_STALE_SECONDS (the views cap what they enqueue).
+"""
+import contextlib
+import datetime
+import os
+import socket
+import threading
+import traceback
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import DatabaseError, connection, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .archive import archive_records
+from .authentication import revoke_token
+from .bulk import ingest_patient_records
+from .counters import reconcile_counters
+from .export import export_rows, gzip_stream, iter_csv, iter_ndjson
+from .models import ArchivedPatientRecord, Job, Patient, PatientRecord
+from .principal import resolve_principal
+from .registration import register_users
+from .rollups import backfill_rollups
+
+# kind -> (handler, atomic)
+HANDLERS = {}
+
+# kinds superusers may POST to jobs/, the others are enqueued by the views they offload
+MAINTENANCE_KINDS = ('backfill_rollups', 'reconcile_counters', 'archive_records')
+
+
+def handler(kind, atomic=False):
+    def register(function):
+        HANDLERS[kind] = (function, atomic)
+        return function
+    return register
+
+
+def enqueue(kind, params=None, user=None, max_attempts=None):
+    """Queues a job, it's visible to the workers once the current transaction commits."""
+    if kind not in HANDLERS:
+        raise ValueError(f'Unknown job kind {kind!r}.')
+    return Job.objects.create(
+        kind=kind,
+        params=params or {},
+        created_by=user,
+        max_attempts=max_attempts or settings.JOB_MAX_ATTEMPTS,
+        run_after=timezone.now(),
+    )
+
+
+def report_progress(job, done, total=None):
+    """
+    Stores a running job's progress, which is also its heartbeat. Atomic handlers only get it on
+    the job object: written in their transaction, it would be invisible until the job ends and
+    would hold SQLite's write lock meanwhile.
+    """
+    job.progress_done = done
+    if total is not None:
+        job.progress_total = total
+    if HANDLERS.get(job.kind, (None, False))[1]:
+        return
+    Job.objects.filter(pk=job.pk).update(progress_done=job.progress_done, progress_total=job.progress_total, heartbeat_at=timezone.now())
+
+
+# workers
+
+def claim_job(worker):
+    """The next due job, now running on `worker`. None if there's none (or another worker was faster)."""
+    now = timezone.now()
+    due = Job.objects.filter(status='queued', run_after__lte=now).order_by('run_after', 'pk')
+    skip_locked = connection.features.has_select_for_update_skip_locked
+    # without SKIP LOCKED (SQLite) no transaction: a read lock upgraded by two workers at once
+    # is a deadlock there, and the conditional UPDATE picks the winner on its own
+    with transaction.atomic() if skip_locked else contextlib.nullcontext():
+        if skip_locked:
+            due = due.select_for_update(skip_locked=True)
+        job = due.only('pk').first()
+        if job is None:
+            return None
+        claimed = Job.objects.filter(pk=job.pk, status='queued').update(
+            status='running', worker=worker, attempts=F('attempts') + 1, started_at=now, heartbeat_at=now,
+        )
+    if not claimed:
+        return None
+    return Job.objects.get(pk=job.pk)
+
+
+def requeue_stale_jobs():
+    """Queues again (or fails) the running jobs whose worker stopped reporting. Returns how many."""
+    now = timezone.now()
+    stale = Job.objects.filter(status='running', heartbeat_at__lt=now - datetime.timedelta(seconds=settings.JOB_STALE_SECONDS))
+    error = 'The worker running the job stopped responding.'
+    failed = stale.filter(attempts__gte=F('max_attempts')).update(status='failed', error=error, worker='', finished_at=now)
+    requeued = stale.filter(attempts__lt=F('max_attempts')).update(status='queued', error=error, worker='', run_after=now)
+    return failed + requeued
+
+
+def _finish(job, **fields):
+    # only while still ours: a job requeued as stale may be running on another worker by now
+    return Job.objects.filter(pk=job.pk, status='running', worker=job.worker).update(**fields)
+
+
+def retry_delay(attempts):
+    return min(settings.JOB_RETRY_BACKOFF_SECONDS * 2 ** (attempts - 1), settings.JOB_RETRY_BACKOFF_MAX_SECONDS)
+
+
+def run_job(job):
+    """Runs a claimed job and stores its outcome. Returns the traceback of a failure, else None."""
+    if job.kind not in HANDLERS:
+        _finish(job, status='failed', error=f'Unknown job kind {job.kind!r}.', finished_at=timezone.now())
+        return None
+    function, atomic = HANDLERS[job.kind]
+    try:
+        with transaction.atomic() if atomic else contextlib.nullcontext():
+            result = function(job, **job.params)
+            done = job.progress_total if job.progress_total is not None else job.progress_done
+            _finish(job, status='succeeded', result=result, error='', progress_done=done, progress_total=job.progress_total, finished_at=timezone.now())
+    except Exception as exc:
+        error = f'{type(exc).__name__}: {exc}'
+        if job.attempts < job.max_attempts:
+            _finish(job, status='queued', error=error, worker='', run_after=timezone.now() + datetime.timedelta(seconds=retry_delay(job.attempts)))
+        else:
+            _finish(job, status='failed', error=error, finished_at=timezone.now())
+        return traceback.format_exc()
+    return None
+
+
+def work(index, stop, poll_interval=None, once=False, log=None):
+    """
+    One worker thread: claims and runs jobs until `stop` is set, or, with `once`, until no job
+    is due. `log(message)` gets a line per job.
+    """
+    worker = f'{socket.gethostname()}:{os.getpid()}:{index}'
+    poll_interval = settings.JOB_POLL_SECONDS if poll_interval is None else poll_interval
+    log = log or (lambda message: None)
+    try:
+        while not stop.is_set():
+            try:
+                requeue_stale_jobs()
+                job = claim_job(worker)
+            except DatabaseError as exc:
+                # e.g. SQLite busy with a long write: try again on the next poll
+                log(f'{worker}: {exc}')
+                stop.wait(poll_interval)
+                continue
+            if job is None:
+                if once:
+                    break
+                stop.wait(poll_interval)
+                continue
+            log(f'{worker}: job {job.pk} {job.kind}, attempt {job.attempts} of {job.max_attempts}')
+            failure = run_job(job)
+            job.refresh_from_db(fields=['status'])
+            log(f'{worker}: job {job.pk} {job.status}' + (f'\n{failure}' if failure else ''))
+    finally:
+        # the thread's connections
+        connections.close_all()
+
+
+def start_workers(concurrency, poll_interval=None, once=False, log=None):
+    """Starts `concurrency` worker threads, returns them and the event that stops them."""
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=work, args=(index, stop, poll_interval, once, log), name=f'job-worker-{index}', daemon=True)
+        for index in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    return threads, stop
+
+
+# handlers
+
+@handler('delete_patient')
+def delete_patient(job, patient_id):
+    """The patient's records in batches (hot, then archived), then the patient and its user."""
+    patient = Patient.objects.select_related('user').filter(pk=patient_id).first()
+    if patient is None:
+        return {'deleted': False}  # an earlier attempt got that far
+    total = PatientRecord.objects.filter(patient_id=patient_id).count() + ArchivedPatientRecord.objects.filter(patient_id=patient_id).count()
+    done = 0
+    report_progress(job, done, total)
+    for model in (PatientRecord, ArchivedPatientRecord):
+        while True:
+            batch = list(model.objects.filter(patient_id=patient_id).values_list('pk', flat=True)[:settings.JOB_DELETE_BATCH_SIZE])
+            if not batch:
+                break
+            model.objects.filter(pk__in=batch).delete()
+            done += len(batch)
+            report_progress(job, done)
+    revoke_token(patient.user)
+    patient.user.delete()
+    patient.delete()
+    return {'deleted': True, 'records': done}
+
+
+@handler('ingest_patient_records', atomic=True)
+def ingest_records(job, user_id, items):
+    principal = resolve_principal(User.objects.get(pk=user_id))
+    report_progress(job, 0, len(items))
+    results = ingest_patient_records(items, principal)
+    created = sum(1 for result in results if result['status'] == 'created')
+    return {'created': created, 'failed': len(results) - created, 'results': results}
+
+
+@handler('register_users', atomic=True)
+def register(job, items):
+    report_progress(job, 0, len(items))
+    # hashed inline: the process pool closes the connections (and this transaction) to fork
+    results = register_users(items, workers=1)
+    created = sum(1 for result in results if result['status'] == 'created')
+    return {'created': created, 'failed': len(results) - created, 'results': results}
+
+
+def export_path(job):
+    extension = job.params['export_format'] + ('.gz' if job.params.get('gzip') else '')
+    return os.path.join(settings.JOB_FILES_DIR, f'job-{job.pk}.{extension}')
+
+
+@handler('export_patient_records')
+def export_records(job, export_format, department_id=None, gzip=False):
+    """The export of views.PatientRecordExportView, written to JOB_FILES_DIR for jobs/<id>/result/."""
+    total = PatientRecord.objects.filter(**({} if department_id is None else {'department_id': department_id})).count()
+    report_progress(job, 0, total)
+
+    def counted(rows):
+        for done, row in enumerate(rows, 1):
+            if done % settings.EXPORT_CHUNK_SIZE == 0:
+                report_progress(job, done)
+            yield row
+
+    rows = counted(export_rows(department_id=department_id, chunk_size=settings.EXPORT_CHUNK_SIZE))
+    chunks = iter_csv(rows) if export_format == 'csv' else iter_ndjson(rows)
+    path = export_path(job)
+    os.makedirs(settings.JOB_FILES_DIR, exist_ok=True)
+    size = 0
+    # a retry overwrites what a failed attempt left
+    with open(path, 'wb') as out:
+        for chunk in gzip_stream(chunks) if gzip else chunks:
+            out.write(chunk)
+            size += len(chunk)
+    return {'file': os.path.basename(path), 'bytes': size}
+
+
+@handler('backfill_rollups')
+def rollups(job):
+    return {'records': backfill_rollups(progress=lambda done, last: report_progress(job, done, last))}
+
+
+@handler('reconcile_counters')
+def counters(job):
+    return {'corrected': reconcile_counters()}
+
+
+@handler('archive_records')
+def archive(job, older_than_days=None):
+    days = settings.ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    older_than = timezone.now() - datetime.timedelta(days=days)
+    return {'archived': archive_records(older_than=older_than, progress=lambda moved: report_progress(job, moved))}
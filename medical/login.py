@@ -0,0 +1,137 @@
+"""
+Password checks for LoginView, off the request threads.
+
+PBKDF2 is deliberately slow. When hundreds of users log in at once, hashing on the request
+threads starves every other endpoint. Here the hashes run in a small per-process pool
+(LOGIN_HASH_WORKERS threads; hashlib releases the GIL, so they really run in parallel). At
+most LOGIN_HASH_QUEUE more logins may wait for a free worker, and none of them waits longer
+than LOGIN_HASH_TIMEOUT seconds. Beyond that the login is refused with a 503 and a
+Retry-After header, so everyone else keeps their threads and CPU.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from django.conf import settings
+from django.contrib.auth import _clean_credentials
+from django.contrib.auth.hashers import check_password, make_password
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_login_failed
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import APIException
+
+from .metrics import register_collector
+
+
+class LoginUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Too many logins in progress, please try again in a moment.'
+    default_code = 'login_unavailable'
+
+    def __init__(self, detail=None, code=None):
+        super().__init__(detail, code)
+        self.wait = settings.LOGIN_RETRY_AFTER  # the exception handler turns it into Retry-After
+
+
+class PasswordCheckPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+        self._pid = None
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def _start(self):
+        # created on first use in each process: threads don't survive a fork
+        with self._lock:
+            if self._pid != os.getpid():
+                workers = settings.LOGIN_HASH_WORKERS
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='login-hash')
+                self._slots = threading.BoundedSemaphore(workers + settings.LOGIN_HASH_QUEUE)
+                self._pid = os.getpid()
+
+    def run(self, function, *args):
+        """function(*args) on a pool thread. Raises LoginUnavailable when saturated or too slow."""
+        if self._pid != os.getpid():
+            self._start()
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise LoginUnavailable()
+        self.admitted += 1
+        try:
+            future = self._executor.submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=settings.LOGIN_HASH_TIMEOUT)
+        except TimeoutError:
+            future.cancel()  # still queued: it never runs. Already running: it finishes unread.
+            self.timeouts += 1
+            raise LoginUnavailable()
+
+    def stats(self):
+        return {'admitted': self.admitted, 'rejected': self.rejected, 'timeouts': self.timeouts}
+
+
+password_pool = PasswordCheckPool()
+register_collector('login_pool', password_pool.stats)
+
+
+def _verify(password, encoded):
+    """Runs on the pool. Returns (valid, new encoded password if the hasher settings changed)."""
+    upgraded = []
+    valid = check_password(password, encoded, setter=lambda raw: upgraded.append(make_password(raw)))
+    return valid, upgraded[0] if upgraded else None
+
+
+def login(username, password, request=None):
+    """
+    Checks the credentials like ModelBackend does and returns the login payload
+    ({'token': ..., 'user': {...}}), or None if they are wrong.
+
+    The user, its role ids, groups and token come from one query (one row per group). Wrong
+    credentials send user_login_failed, as authenticate() would, so lockout and audit
+    receivers still see them.
+    """
+    rows = list(User.objects.filter(username=username).values_list(
+        'id', 'username', 'password', 'is_active', 'patient__id', 'doctor__id', 'auth_token__key', 'groups__name',
+    ))
+    if not rows:
+        # hash anyway so a missing user takes as long as a wrong password
+        password_pool.run(make_password, password)
+        return _failed(username, password, request)
+
+    user_id, username, encoded, is_active, patient_id, doctor_id, token_key, _ = rows[0]
+    valid, upgraded = password_pool.run(_verify, password, encoded)
+    if not (valid and is_active):
+        return _failed(username, password, request)
+    if upgraded:
+        User.objects.filter(pk=user_id).update(password=upgraded)
+    if token_key is None:
+        token_key = Token.objects.get_or_create(user_id=user_id)[0].key
+
+    role_id = {}
+    if patient_id is not None:
+        role_id['patient_id'] = patient_id
+    if doctor_id is not None:
+        role_id['doctor_id'] = doctor_id
+    return {
+        'token': token_key,
+        'user': {
+            'user_id': user_id,
+            **role_id,
+            'username': username,
+            'groups': [row[-1] for row in rows if row[-1] is not None],
+        }
+    }
+
+
+def _failed(username, password, request):
+    credentials = _clean_credentials({'username': username, 'password': password})
+    user_login_failed.send(sender=__name__, credentials=credentials, request=request)
+    return None
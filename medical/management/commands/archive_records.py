@@ -0,0 +1,30 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+
+from medical.archive import archive_records
+
+
+class Command(BaseCommand):
+    help = 'Move old patient records from the hot table to the archive table, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=None, help='Archive records created more than this many days ago (default ARCHIVE_AFTER_DAYS)')
+        parser.add_argument('--batch-size', type=int, default=None, help='Records moved per transaction (default ARCHIVE_BATCH_SIZE)')
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        days = settings.ARCHIVE_AFTER_DAYS if options['older_than_days'] is None else options['older_than_days']
+        if days < 0:
+            raise CommandError('--older-than-days must not be negative.')
+        older_than = timezone.now() - datetime.timedelta(days=days)
+
+        def progress(moved):
+            self.stdout.write(f'  {moved} records archived')
+
+        self.stdout.write(f'Archiving records created before {older_than:%Y-%m-%d %H:%M}')
+        total = archive_records(older_than=older_than, batch_size=options['batch_size'], connection=connections[options['database']], progress=progress)
+        self.stdout.write(self.style.SUCCESS(f'Archived {total} records'))
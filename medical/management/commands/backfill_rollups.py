@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from medical.rollups import backfill_rollups
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the department analytics rollups from all patient records (run while writes are quiet)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='Records per INSERT ... SELECT (default ROLLUP_BACKFILL_BATCH_SIZE)')
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        def progress(done, last):
+            self.stdout.write(f'  up to record {done} of {last}')
+
+        total = backfill_rollups(batch_size=options['batch_size'], connection=connections[options['database']], progress=progress)
+        self.stdout.write(self.style.SUCCESS(f'Rolled up {total} records'))
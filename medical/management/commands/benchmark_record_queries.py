@@ -0,0 +1,91 @@
+import json
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from medical.models import Patient, PatientRecord
+from medical.utils import explicit_created_dates
+
+
+class Command(BaseCommand):
+    help = 'Time the PatientRecord date range queries and capture their EXPLAIN plans'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000, help='Number of records the benchmark expects')
+        parser.add_argument('--seed', action='store_true', help='Insert synthetic records until --rows exist')
+        parser.add_argument('--days', type=int, default=730, help='Seeded records are spread over this many days')
+        parser.add_argument('--repeat', type=int, default=20, help='Runs per query')
+        parser.add_argument('--json', dest='json_path', help='Also write the results to this file')
+
+    def handle(self, *args, **options):
+        patients = list(Patient.objects.exclude(department=None).values_list('id', 'department_id'))
+        if not patients:
+            raise CommandError('No patients with a department, run populate_database first.')
+
+        existing = PatientRecord.objects.count()
+        if existing < options['rows']:
+            if not options['seed']:
+                self.stdout.write(self.style.WARNING(f"Only {existing} records exist, pass --seed to insert {options['rows'] - existing} more."))
+            else:
+                self.seed(patients, options['rows'] - existing, options['days'])
+
+        now = timezone.now()
+        month_ago = now - timedelta(days=30)
+        patient_id, department_id = patients[0]
+        cases = {
+            'department_last_30_days': PatientRecord.objects.filter(department_id=department_id, created_date__gte=month_ago).order_by('-created_date', '-record_id')[:50],
+            'patient_last_30_days': PatientRecord.objects.filter(patient_id=patient_id, created_date__gte=month_ago).order_by('-created_date', '-record_id'),
+            'patient_history': PatientRecord.objects.filter(patient_id=patient_id).order_by('-created_date', '-record_id')[:200],
+            'all_last_30_days': PatientRecord.objects.filter(created_date__gte=month_ago).order_by('-created_date', '-record_id')[:50],
+        }
+
+        results = {'vendor': connection.vendor, 'rows': PatientRecord.objects.count(), 'cases': {}}
+        for name, queryset in cases.items():
+            timings = []
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                list(queryset.values_list('record_id', 'created_date'))
+                timings.append((time.perf_counter() - started) * 1000)
+            plan = queryset.values_list('record_id', 'created_date').explain()
+            results['cases'][name] = {
+                'median_ms': round(statistics.median(timings), 3),
+                'min_ms': round(min(timings), 3),
+                'max_ms': round(max(timings), 3),
+                'plan': plan,
+            }
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(f"  median {results['cases'][name]['median_ms']} ms, min {results['cases'][name]['min_ms']} ms")
+            for line in plan.splitlines():
+                self.stdout.write(f'  {line}')
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as out:
+                json.dump(results, out, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['json_path']}"))
+
+    def seed(self, patients, count, days, batch_size=5000):
+        self.stdout.write(f'Seeding {count} records...')
+        rng = random.Random(42)
+        now = timezone.now()
+        span = days * 24 * 3600
+        with explicit_created_dates():
+            for start in range(0, count, batch_size):
+                batch = []
+                for _ in range(min(batch_size, count - start)):
+                    patient_id, department_id = rng.choice(patients)
+                    batch.append(PatientRecord(
+                        patient_id=patient_id,
+                        department_id=department_id,
+                        created_date=now - timedelta(seconds=rng.randrange(span)),
+                        diagnostics='Benchmark diagnostics',
+                        observations='Benchmark observations',
+                        treatments='Benchmark treatments',
+                    ))
+                with transaction.atomic():
+                    PatientRecord.objects.bulk_create(batch)
+        self.stdout.write(self.style.SUCCESS(f'Seeded {count} records.'))
@@ -0,0 +1,69 @@
+import gzip
+import io
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from medical.models import PatientRecord
+from medical.parsers import MessagePackParser, ORJSONParser
+from medical.projection import compile_projection
+from medical.renderers import MessagePackRenderer, ORJSONRenderer
+from medical.serializers import PatientRecordSerializer
+
+FORMATS = {
+    'json (stdlib)': (JSONRenderer, JSONParser),
+    'json (orjson)': (ORJSONRenderer, ORJSONParser),
+    'msgpack': (MessagePackRenderer, MessagePackParser),
+}
+
+
+class Command(BaseCommand):
+    help = 'Time encoding and decoding of a large record list with each renderer/parser, and compare payload sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help='Records in the list')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per format')
+        parser.add_argument('--json', dest='json_path', help='Also write the results to this file')
+
+    def handle(self, *args, **options):
+        projection = compile_projection(PatientRecordSerializer)
+        data = projection.render(projection.values(PatientRecord.objects.order_by('-created_date', '-record_id')[:options['rows']]))
+        if not data:
+            raise CommandError('No records, run populate_database first.')
+
+        results = {'rows': len(data), 'formats': {}}
+        self.stdout.write(f'{len(data)} records')
+        self.stdout.write(f"  {'format':<15}{'encode ms':>11}{'decode ms':>11}{'bytes':>11}{'gzip bytes':>12}")
+        for name, (renderer_class, parser_class) in FORMATS.items():
+            renderer, parser = renderer_class(), parser_class()
+            payload = renderer.render(data)
+            if parser.parse(io.BytesIO(payload)) != json.loads(json.dumps(data)):
+                raise CommandError(f'{name}: the payload does not decode back to the data.')
+            encode = self.time(lambda: renderer.render(data), options['repeat'])
+            decode = self.time(lambda: parser.parse(io.BytesIO(payload)), options['repeat'])
+            results['formats'][name] = {
+                'encode_ms': round(encode, 2),
+                'decode_ms': round(decode, 2),
+                'bytes': len(payload),
+                'gzip_bytes': len(gzip.compress(payload)),
+            }
+            row = results['formats'][name]
+            self.stdout.write(f"  {name:<15}{row['encode_ms']:>11}{row['decode_ms']:>11}{row['bytes']:>11}{row['gzip_bytes']:>12}")
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as out:
+                json.dump(results, out, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['json_path']}"))
+
+    @staticmethod
+    def time(function, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            function()
+            timings.append((time.perf_counter() - started) * 1000)
+        return statistics.median(timings)
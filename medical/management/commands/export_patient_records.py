@@ -0,0 +1,33 @@
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from medical.export import EXPORT_FORMATS, stream_export
+
+
+class Command(BaseCommand):
+    help = 'Stream patient records to a file (or stdout) as NDJSON or CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='ndjson')
+        parser.add_argument('--department', type=int, help='Only export records of this department id')
+        parser.add_argument('--gzip', action='store_true', help='Gzip the output')
+        parser.add_argument('--chunk-size', type=int, default=settings.EXPORT_CHUNK_SIZE)
+        parser.add_argument('--output', '-o', help='Output file, defaults to stdout')
+
+    def handle(self, *args, **options):
+        chunks = stream_export(
+            options['format'],
+            department_id=options['department'],
+            gzip=options['gzip'],
+            chunk_size=options['chunk_size'],
+        )
+        if options['output']:
+            with open(options['output'], 'wb') as out:
+                written = sum(out.write(chunk) for chunk in chunks)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {written} bytes to {options['output']}"))
+        else:
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
@@ -0,0 +1,288 @@
+import http.client
+import json
+import math
+import platform
+import random
+import socket
+import socketserver
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+from urllib.parse import urlsplit
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from django.core.management.base import BaseCommand, CommandError
+
+# operation -> weight in the mixed workload
+WORKLOAD = {
+    'login': 5,
+    'patient-record-list': 30,
+    'patient-record-create': 10,
+    'patient-detail': 25,
+    'department-list': 20,
+    'department-patients': 10,
+}
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+class VirtualUser:
+    """One client: logs in as a doctor, then runs random operations from WORKLOAD."""
+
+    def __init__(self, base_url, username, password, rng):
+        parts = urlsplit(base_url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.username = username
+        self.password = password
+        self.rng = rng
+        self.connection = None
+        self.token = None
+        self.doctor_id = None
+        self.department_id = None
+        self.patient_ids = []
+
+    def request(self, method, path, body=None, authenticated=True):
+        if self.connection is None:
+            self.connection = self.connection_class(self.netloc, timeout=30)
+        headers = {'Accept': 'application/json'}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        if authenticated and self.token:
+            headers['Authorization'] = f'Token {self.token}'
+        try:
+            self.connection.request(method, self.prefix + path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            content = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            raise
+        if response.getheader('Connection', '').lower() == 'close':
+            self.connection.close()
+            self.connection = None
+        return response.status, content
+
+    def login(self):
+        status, content = self.request('POST', '/medical/login/', {'username': self.username, 'password': self.password}, authenticated=False)
+        if status == 200:
+            data = json.loads(content)
+            self.token = data['token']
+            self.doctor_id = data['user'].get('doctor_id')
+        return status
+
+    def setup(self):
+        if self.login() != 200:
+            raise CommandError(f'Could not log in as {self.username}.')
+        if self.doctor_id is None:
+            raise CommandError(f'{self.username} is not a doctor.')
+        status, content = self.request('GET', f'/medical/doctors/{self.doctor_id}/')
+        self.department_id = json.loads(content)['department']
+        status, content = self.request('GET', f'/medical/department/{self.department_id}/patients/?page_size=500')
+        if status == 200:
+            self.patient_ids = [p['id'] for p in json.loads(content)['results'] if p['assigned_doctor'] == self.doctor_id]
+        if not self.patient_ids:
+            raise CommandError(f'{self.username} has no assigned patients to work with.')
+
+    def run_operation(self, operation):
+        if operation == 'login':
+            return self.login()
+        if operation == 'patient-record-list':
+            return self.request('GET', '/medical/patient_records/')[0]
+        if operation == 'patient-record-create':
+            return self.request('POST', '/medical/patient_records/', {
+                'patient': self.rng.choice(self.patient_ids),
+                'diagnostics': 'Load test',
+                'observations': 'Load test observation',
+                'treatments': 'Load test treatment',
+            })[0]
+        if operation == 'patient-detail':
+            return self.request('GET', f'/medical/patients/{self.rng.choice(self.patient_ids)}/')[0]
+        if operation == 'department-list':
+            return self.request('GET', '/medical/departments/', authenticated=False)[0]
+        if operation == 'department-patients':
+            return self.request('GET', f'/medical/department/{self.department_id}/patients/')[0]
+        raise ValueError(operation)
+
+
+class Command(BaseCommand):
+    help = 'Run a concurrent mixed workload against the medical API and report latency per endpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='Base URL of a running server. Without it a local server is started, see --server')
+        parser.add_argument('--server', choices=['wsgi', 'asgi'], default='wsgi', help='Local server: threaded wsgiref on hospital.wsgi, or uvicorn on hospital.asgi (needs uvicorn installed)')
+        parser.add_argument('--concurrency', type=int, default=10, help='Number of virtual users')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds to run')
+        parser.add_argument('--username', action='append', help='Doctor username to log in with (repeatable), defaults to the first doctors in the database')
+        parser.add_argument('--password', default='password')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--output', '-o', help='Write the results as JSON to this file')
+        parser.add_argument('--baseline', help='Results JSON of an earlier run to compare against')
+
+    def handle(self, *args, **options):
+        usernames = options['username'] or self.default_usernames(options['concurrency'])
+        stop_server = None
+        base_url = options['url']
+        if not base_url:
+            base_url, stop_server = self.start_server(options['server'])
+            self.stdout.write(f"Started local {options['server'].upper()} server on {base_url}")
+
+        try:
+            samples = self.run(base_url, usernames, options)
+        finally:
+            if stop_server is not None:
+                stop_server()
+
+        results = self.summarize(samples, options)
+        self.report(results)
+        if options['baseline']:
+            with open(options['baseline']) as baseline:
+                self.compare(results, json.load(baseline))
+        if options['output']:
+            with open(options['output'], 'w') as out:
+                json.dump(results, out, indent=2, sort_keys=True)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+    def start_server(self, kind):
+        """Starts a local server in a background thread, returns (base_url, stop function)."""
+        if kind == 'asgi':
+            try:
+                import uvicorn
+            except ImportError:
+                raise CommandError('--server asgi needs uvicorn (pip install uvicorn).')
+            from hospital.asgi import application
+
+            with socket.socket() as probe:
+                probe.bind(('127.0.0.1', 0))
+                port = probe.getsockname()[1]
+            server = uvicorn.Server(uvicorn.Config(application, host='127.0.0.1', port=port, log_level='warning', lifespan='off'))
+            threading.Thread(target=server.run, daemon=True).start()
+            while not server.started:
+                time.sleep(0.05)
+
+            def stop():
+                server.should_exit = True
+            return f'http://127.0.0.1:{port}', stop
+
+        from hospital.wsgi import application
+
+        server = make_server('127.0.0.1', 0, application, server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{server.server_port}', server.shutdown
+
+    def default_usernames(self, count):
+        from medical.models import Doctor
+
+        usernames = list(
+            Doctor.objects.filter(patients__isnull=False).distinct().order_by('id').values_list('user__username', flat=True)[:count]
+        )
+        if not usernames:
+            raise CommandError('No doctor with patients found, run populate_database or pass --username.')
+        return usernames
+
+    def run(self, base_url, usernames, options):
+        operations, weights = zip(*WORKLOAD.items())
+        samples = []  # (operation, status, seconds); list.append is atomic
+        deadline = None
+        start_barrier = threading.Barrier(options['concurrency'] + 1)
+        errors = []
+
+        def worker(index):
+            rng = random.Random(f"{options['seed']}:{index}")
+            user = VirtualUser(base_url, usernames[index % len(usernames)], options['password'], rng)
+            try:
+                user.setup()
+            except Exception as exc:
+                errors.append(exc)
+                start_barrier.abort()
+                return
+            try:
+                start_barrier.wait()
+            except threading.BrokenBarrierError:
+                return
+            while time.monotonic() < deadline:
+                operation = rng.choices(operations, weights)[0]
+                started = time.perf_counter()
+                try:
+                    status = user.run_operation(operation)
+                except Exception:
+                    status = 0  # connection error / timeout
+                samples.append((operation, status, time.perf_counter() - started))
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(options['concurrency'])]
+        for thread in threads:
+            thread.start()
+        try:
+            deadline = time.monotonic() + options['duration']
+            start_barrier.wait()
+        except threading.BrokenBarrierError:
+            pass
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise CommandError(f'Virtual user setup failed: {errors[0]}')
+        return samples
+
+    def summarize(self, samples, options):
+        endpoints = {}
+        for operation in WORKLOAD:
+            rows = [(status, seconds) for op, status, seconds in samples if op == operation]
+            latencies = sorted(seconds * 1000 for _, seconds in rows)
+            failed = sum(1 for status, _ in rows if not 200 <= status < 400)
+            endpoints[operation] = {
+                'requests': len(rows),
+                'errors': failed,
+                'error_rate': round(failed / len(rows), 4) if rows else 0.0,
+                'throughput_rps': round(len(rows) / options['duration'], 2),
+                'p50_ms': round(percentile(latencies, 50), 2) if rows else None,
+                'p95_ms': round(percentile(latencies, 95), 2) if rows else None,
+                'p99_ms': round(percentile(latencies, 99), 2) if rows else None,
+                'max_ms': round(latencies[-1], 2) if rows else None,
+                'status_codes': {str(code): sum(1 for status, _ in rows if status == code) for code in sorted({status for status, _ in rows})},
+            }
+        return {
+            'started_at': datetime.now(dt_timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'concurrency': options['concurrency'],
+            'duration_s': options['duration'],
+            'total_requests': len(samples),
+            'throughput_rps': round(len(samples) / options['duration'], 2),
+            'endpoints': endpoints,
+        }
+
+    def report(self, results):
+        header = f"{'endpoint':<24}{'reqs':>8}{'rps':>9}{'err%':>7}{'p50':>9}{'p95':>9}{'p99':>9}"
+        self.stdout.write(self.style.MIGRATE_HEADING(header))
+        for name, row in results['endpoints'].items():
+            if not row['requests']:
+                continue
+            self.stdout.write(
+                f"{name:<24}{row['requests']:>8}{row['throughput_rps']:>9}{row['error_rate'] * 100:>6.1f}%"
+                f"{row['p50_ms']:>9}{row['p95_ms']:>9}{row['p99_ms']:>9}"
+            )
+        self.stdout.write(f"total {results['total_requests']} requests, {results['throughput_rps']} req/s at concurrency {results['concurrency']}")
+
+    def compare(self, results, baseline):
+        self.stdout.write(self.style.MIGRATE_HEADING('p95 vs baseline'))
+        for name, row in results['endpoints'].items():
+            before = baseline.get('endpoints', {}).get(name, {}).get('p95_ms')
+            if before and row['p95_ms']:
+                change = (row['p95_ms'] - before) / before * 100
+                style = self.style.ERROR if change > 10 else self.style.SUCCESS
+                self.stdout.write(style(f"{name:<24}{before:>9} -> {row['p95_ms']:<9} ({change:+.1f}%)"))
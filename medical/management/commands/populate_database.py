@@ -1,78 +1,189 @@
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group, User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+
 from medical.models import Department, Doctor, Patient, PatientRecord
-from django.contrib.auth.models import User
-from django.core.management.base import BaseCommand
-# Create and save Department instances
+from medical.utils import explicit_created_dates
+
+FIRST_NAMES = ['John', 'Jane', 'Alex', 'Susan', 'Mike', 'Alice', 'Bob', 'Charlie', 'David', 'Eva', 'Frank',
+               'Grace', 'Hannah', 'Ivy', 'Jack', 'Karen', 'Leo', 'Mia', 'Nina', 'Oscar']
+LAST_NAMES = ['Doe', 'Smith', 'Johnson', 'Lee', 'Brown', 'Wong', 'Nguyen', 'Kim', 'Patel', 'Garcia', 'Harris',
+              'Martinez', 'Lopez', 'Davis', 'Miller', 'Wilson', 'Moore', 'Taylor', 'Anderson', 'Thomas']
+
+# name, diagnostics, specialization, (diagnosis, observation, treatment) examples
+DEPARTMENTS = [
+    ('Cardiology', 'Heart issues', 'Heart', [
+        ('Hypertension', 'High BP', 'Medication'),
+        ('Arrhythmia', 'Irregular heartbeat', 'Pacemaker'),
+        ('Coronary Artery Disease', 'Chest pain', 'Surgery'),
+        ('Congestive Heart Failure', 'Shortness of breath', 'Surgery'),
+        ('Myocardial Infarction', 'Chest pain', 'Stent'),
+    ]),
+    ('Neurology', 'Brain issues', 'Brain', [
+        ('Epilepsy', 'Seizures', 'Medication'),
+        ('Migraine', 'Headaches', 'Medication'),
+        ('Stroke', 'Weakness', 'Therapy'),
+        ("Parkinson's Disease", 'Tremors', 'Therapy'),
+        ("Alzheimer's Disease", 'Memory loss', 'Medication'),
+    ]),
+    ('Orthopedics', 'Bone issues', 'Bones', [
+        ('Fracture', 'Broken leg', 'Casting'),
+        ('Arthritis', 'Joint pain', 'Medication'),
+        ('Osteoporosis', 'Weak bones', 'Medication'),
+        ('Tendonitis', 'Inflammation', 'Therapy'),
+        ('Dislocation', 'Shoulder dislocation', 'Reduction'),
+    ]),
+]
+
+# patients per record-generation task, also the unit the random seed is derived from
+PATIENT_CHUNK = 1000
+
+
+def insert_records(task):
+    """
+    Creates the records of one chunk of patients. Runs in the worker processes (or inline), the
+    random generator is seeded per chunk so the data doesn't depend on the number of workers.
+    """
+    seed, chunk_index, patients, records_per_patient, days, now, batch_size = task
+    rng = random.Random(f'{seed}:records:{chunk_index}')
+    span = days * 24 * 3600
+    examples = [department[3] for department in DEPARTMENTS]
+
+    batch = []
+    created = 0
+    with explicit_created_dates():
+        for patient_id, department_id, department_index in patients:
+            for _ in range(records_per_patient):
+                diagnosis, observation, treatment = rng.choice(examples[department_index % len(examples)])
+                batch.append(PatientRecord(
+                    patient_id=patient_id,
+                    department_id=department_id,
+                    created_date=now - timedelta(seconds=rng.randrange(span)),
+                    diagnostics=diagnosis,
+                    observations=observation,
+                    treatments=treatment,
+                    misc='None',
+                ))
+                if len(batch) >= batch_size:
+                    created += _flush(batch)
+        if batch:
+            created += _flush(batch)
+    return created
+
+
+def _flush(batch):
+    with transaction.atomic():
+        PatientRecord.objects.bulk_create(batch)
+    count = len(batch)
+    batch.clear()
+    return count
+
 
 class Command(BaseCommand):
-    help = 'Populate the database with sample data'
+    help = 'Populate the database with deterministic sample data, from a handful of rows to millions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--departments', type=int, default=3)
+        parser.add_argument('--doctors', type=int, default=5)
+        parser.add_argument('--patients', type=int, default=15)
+        parser.add_argument('--records-per-patient', type=int, default=1)
+        parser.add_argument('--days', type=int, default=365, help='Records are spread over this many past days')
+        parser.add_argument('--seed', type=int, default=1, help='Same seed and sizes -> same data')
+        parser.add_argument('--password', default='password', help='Password of every generated user')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--workers', type=int, default=1, help='Processes inserting records (ignored on SQLite, which has a single writer)')
 
     def handle(self, *args, **options):
-        departments = [
-            Department(name="Cardiology", diagnostics="Heart issues", location="Building A", specialization="Heart"),
-            Department(name="Neurology", diagnostics="Brain issues", location="Building B", specialization="Brain"),
-            Department(name="Orthopedics", diagnostics="Bone issues", location="Building C", specialization="Bones"),
-        ]
+        if options['departments'] < 1 or options['doctors'] < 1:
+            raise CommandError('Need at least one department and one doctor.')
+        started = time.monotonic()
+        rng = random.Random(f"{options['seed']}:people")
+        batch_size = options['batch_size']
 
-        for dept in departments:
-            dept.save()
-            
-
-        # Create and save Doctor instances
-        doctors = [
-            Doctor(user=User.objects.create(username='dr_john', first_name='John', last_name='Doe', password='password'), department=departments[0]),
-            Doctor(user=User.objects.create(username='dr_jane', first_name='Jane', last_name='Smith', password='password'), department=departments[0]),
-            Doctor(user=User.objects.create(username='dr_alex', first_name='Alex', last_name='Johnson', password='password'), department=departments[1]),
-            Doctor(user=User.objects.create(username='dr_susan', first_name='Susan', last_name='Lee', password='password'), department=departments[1]),
-            Doctor(user=User.objects.create(username='dr_mike', first_name='Mike', last_name='Brown', password='password'), department=departments[2]),
-        ]
+        doctor_users = []
+        for i in range(1, options['doctors'] + 1):
+            first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            doctor_users.append(User(username=f'dr_{first.lower()}_{i}', first_name=first, last_name=last))
+        if User.objects.filter(username__in=[user.username for user in doctor_users] + ['patient_1']).exists():
+            raise CommandError('Sample users already exist, populate an empty database.')
+
+        # Departments
+        departments = []
+        for i in range(options['departments']):
+            name, diagnostics, specialization, _ = DEPARTMENTS[i % len(DEPARTMENTS)]
+            if i >= len(DEPARTMENTS):
+                name = f'{name} {i // len(DEPARTMENTS) + 1}'
+            departments.append(Department(name=name, diagnostics=diagnostics, location=f'Building {chr(65 + i % 26)}', specialization=specialization))
+        departments = Department.objects.bulk_create(departments)
 
+        # One PBKDF2 run for everybody instead of one per user
+        password = make_password(options['password'])
+        doctor_group, _ = Group.objects.get_or_create(name='Doctor')
+        patient_group, _ = Group.objects.get_or_create(name='Patient')
+
+        # Doctors, spread round robin over the departments
+        for user in doctor_users:
+            user.password = password
+        doctor_users = User.objects.bulk_create(doctor_users, batch_size=batch_size)
+        doctors = Doctor.objects.bulk_create(
+            [Doctor(user=user, department=departments[i % len(departments)]) for i, user in enumerate(doctor_users)],
+            batch_size=batch_size,
+        )
+        self.add_to_group(doctor_group, doctor_users, batch_size)
+        doctors_by_department = {}
         for doctor in doctors:
-            doctor.user.set_password('password')  # Ensure the password is hashed
-            doctor.user.save()
-            doctor.save()
-
-        # Create and save Patient instances
-        patients = [
-            Patient(user=User.objects.create(username='patient_1', first_name='Alice', last_name='Wong', password='password'), department=departments[0], assigned_doctor=doctors[0]),
-            Patient(user=User.objects.create(username='patient_2', first_name='Bob', last_name='Nguyen', password='password'), department=departments[0], assigned_doctor=doctors[1]),
-            Patient(user=User.objects.create(username='patient_3', first_name='Charlie', last_name='Kim', password='password'), department=departments[0], assigned_doctor=doctors[0]),
-            Patient(user=User.objects.create(username='patient_4', first_name='David', last_name='Patel', password='password'), department=departments[1], assigned_doctor=doctors[2]),
-            Patient(user=User.objects.create(username='patient_5', first_name='Eva', last_name='Garcia', password='password'), department=departments[1], assigned_doctor=doctors[3]),
-            Patient(user=User.objects.create(username='patient_6', first_name='Frank', last_name='Harris', password='password'), department=departments[1], assigned_doctor=doctors[2]),
-            Patient(user=User.objects.create(username='patient_7', first_name='Grace', last_name='Martinez', password='password'), department=departments[2], assigned_doctor=doctors[4]),
-            Patient(user=User.objects.create(username='patient_8', first_name='Hannah', last_name='Lopez', password='password'), department=departments[2], assigned_doctor=doctors[4]),
-            Patient(user=User.objects.create(username='patient_9', first_name='Ivy', last_name='Davis', password='password'), department=departments[0], assigned_doctor=doctors[0]),
-            Patient(user=User.objects.create(username='patient_10', first_name='Jack', last_name='Miller', password='password'), department=departments[0], assigned_doctor=doctors[1]),
-            Patient(user=User.objects.create(username='patient_11', first_name='Karen', last_name='Wilson', password='password'), department=departments[1], assigned_doctor=doctors[3]),
-            Patient(user=User.objects.create(username='patient_12', first_name='Leo', last_name='Moore', password='password'), department=departments[1], assigned_doctor=doctors[2]),
-            Patient(user=User.objects.create(username='patient_13', first_name='Mia', last_name='Taylor', password='password'), department=departments[2], assigned_doctor=doctors[4]),
-            Patient(user=User.objects.create(username='patient_14', first_name='Nina', last_name='Anderson', password='password'), department=departments[2], assigned_doctor=doctors[4]),
-            Patient(user=User.objects.create(username='patient_15', first_name='Oscar', last_name='Thomas', password='password'), department=departments[2], assigned_doctor=doctors[4]),
-        ]
+            doctors_by_department.setdefault(doctor.department_id, []).append(doctor)
+        self.stdout.write(f'{len(departments)} departments, {len(doctors)} doctors')
 
-        for patient in patients:
-            patient.user.set_password('password')  # Ensure the password is hashed
-            patient.user.save()
-            patient.save()
-
-        # Create and save PatientRecord instances
-        patient_records = [
-            PatientRecord(patient=patients[0], created_date='2023-01-15', diagnostics="Hypertension", observations="High BP", treatments="Medication", department=departments[0], misc="None"),
-            PatientRecord(patient=patients[1], created_date='2023-02-10', diagnostics="Arrhythmia", observations="Irregular heartbeat", treatments="Pacemaker", department=departments[0], misc="None"),
-            PatientRecord(patient=patients[2], created_date='2023-03-05', diagnostics="Coronary Artery Disease", observations="Chest pain", treatments="Surgery", department=departments[0], misc="None"),
-            PatientRecord(patient=patients[3], created_date='2023-04-20', diagnostics="Epilepsy", observations="Seizures", treatments="Medication", department=departments[1], misc="None"),
-            PatientRecord(patient=patients[4], created_date='2023-05-25', diagnostics="Migraine", observations="Headaches", treatments="Medication", department=departments[1], misc="None"),
-            PatientRecord(patient=patients[5], created_date='2023-06-15', diagnostics="Stroke", observations="Weakness", treatments="Therapy", department=departments[1], misc="None"),
-            PatientRecord(patient=patients[6], created_date='2023-07-05', diagnostics="Fracture", observations="Broken leg", treatments="Casting", department=departments[2], misc="None"),
-            PatientRecord(patient=patients[7], created_date='2023-08-10', diagnostics="Arthritis", observations="Joint pain", treatments="Medication", department=departments[2], misc="None"),
-            PatientRecord(patient=patients[8], created_date='2023-09-01', diagnostics="Congestive Heart Failure", observations="Shortness of breath", treatments="Surgery", department=departments[0], misc="None"),
-            PatientRecord(patient=patients[9], created_date='2023-10-15', diagnostics="Myocardial Infarction", observations="Chest pain", treatments="Stent", department=departments[0], misc="None"),
-            PatientRecord(patient=patients[10], created_date='2023-11-05', diagnostics="Parkinson's Disease", observations="Tremors", treatments="Therapy", department=departments[1], misc="None"),
-            PatientRecord(patient=patients[11], created_date='2023-12-01', diagnostics="Alzheimer's Disease", observations="Memory loss", treatments="Medication", department=departments[1], misc="None"),
-            PatientRecord(patient=patients[12], created_date='2023-12-15', diagnostics="Osteoporosis", observations="Weak bones", treatments="Medication", department=departments[2], misc="None"),
-            PatientRecord(patient=patients[13], created_date='2024-01-10', diagnostics="Tendonitis", observations="Inflammation", treatments="Therapy", department=departments[2], misc="None"),
-            PatientRecord(patient=patients[14], created_date='2024-02-05', diagnostics="Dislocation", observations="Shoulder dislocation", treatments="Reduction", department=departments[2], misc="None"),
+        # Patients, created in batches so memory stays bounded
+        patient_rows = []  # (patient_id, department_id, department_index)
+        for start in range(0, options['patients'], batch_size):
+            users = []
+            for i in range(start + 1, min(start + batch_size, options['patients']) + 1):
+                first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+                users.append(User(username=f'patient_{i}', first_name=first, last_name=last, password=password))
+            users = User.objects.bulk_create(users)
+            patients = []
+            department_indexes = []
+            for user in users:
+                department_index = rng.randrange(len(departments))
+                department = departments[department_index]
+                candidates = doctors_by_department.get(department.id)
+                patients.append(Patient(user=user, department=department, assigned_doctor=rng.choice(candidates) if candidates else None))
+                department_indexes.append(department_index)
+            patients = Patient.objects.bulk_create(patients)
+            self.add_to_group(patient_group, users, batch_size)
+            patient_rows.extend(
+                (patient.id, patient.department_id, department_index)
+                for patient, department_index in zip(patients, department_indexes)
+            )
+        self.stdout.write(f'{len(patient_rows)} patients')
+
+        # Records
+        now = datetime.now(dt_timezone.utc)
+        tasks = [
+            (options['seed'], index, patient_rows[start:start + PATIENT_CHUNK], options['records_per_patient'], options['days'], now, batch_size)
+            for index, start in enumerate(range(0, len(patient_rows), PATIENT_CHUNK))
         ]
+        workers = options['workers'] if connection.vendor != 'sqlite' else 1
+        if workers > 1:
+            connections.close_all()  # the workers open their own connections
+            with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as pool:
+                created = sum(pool.map(insert_records, tasks))
+        else:
+            created = sum(insert_records(task) for task in tasks)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(f'{created} patient records, done in {elapsed:.1f}s'))
 
-        for record in patient_records:
-            record.save()
+    @staticmethod
+    def add_to_group(group, users, batch_size):
+        Membership = User.groups.through
+        Membership.objects.bulk_create([Membership(user_id=user.id, group_id=group.id) for user in users], batch_size=batch_size)
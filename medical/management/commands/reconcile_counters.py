@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from medical.counters import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = 'Recompute the department/doctor counters and fix the ones that drifted (run periodically, e.g. nightly from cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        fixed = reconcile_counters(using=options['database'])
+        for counter, rows in fixed.items():
+            style = self.style.WARNING if rows else self.style.SUCCESS
+            self.stdout.write(style(f'{counter}: {rows} rows corrected'))
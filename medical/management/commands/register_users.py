@@ -0,0 +1,50 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from medical.parsers import CSVParser, NDJSONParser
+from medical.registration import register_users
+
+PARSERS = {
+    'csv': CSVParser,
+    'ndjson': NDJSONParser,
+}
+
+
+class Command(BaseCommand):
+    help = 'Register doctors and patients from a CSV, JSON or NDJSON file (fields of the register endpoint)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File with one user per row/item')
+        parser.add_argument('--format', choices=['csv', 'json', 'ndjson'], help='Defaults to the file extension')
+        parser.add_argument('--workers', type=int, default=settings.BULK_REGISTER_HASH_WORKERS, help='Processes hashing passwords')
+        parser.add_argument('--batch-size', type=int, default=settings.BULK_REGISTER_BATCH_SIZE, help='Rows per insert transaction')
+        parser.add_argument('--report', help='Write the per-row results as JSON to this file')
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or options['path'].rsplit('.', 1)[-1].lower()
+        if file_format not in ('csv', 'json', 'ndjson'):
+            raise CommandError('Unknown file format, pass --format.')
+        with open(options['path'], 'rb') as source:
+            if file_format == 'json':
+                items = json.load(source)
+            else:
+                items = PARSERS[file_format]().parse(source)
+        if not isinstance(items, list):
+            raise CommandError('Expected a list of users.')
+
+        started = time.monotonic()
+        results = register_users(items, workers=options['workers'], batch_size=options['batch_size'])
+        elapsed = time.monotonic() - started
+
+        errors = [result for result in results if result['status'] == 'error']
+        for result in errors[:20]:
+            self.stderr.write(f"row {result['index']}: {json.dumps(result['errors'])}")
+        if len(errors) > 20:
+            self.stderr.write(f'... and {len(errors) - 20} more errors')
+        if options['report']:
+            with open(options['report'], 'w') as out:
+                json.dump(results, out, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'{len(results) - len(errors)} users registered, {len(errors)} failed, in {elapsed:.1f}s'))
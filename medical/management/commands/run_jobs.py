@@ -0,0 +1,37 @@
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from medical.jobs import start_workers
+
+
+class Command(BaseCommand):
+    help = 'Run the queued background jobs (deletions, exports, bulk imports, maintenance) until stopped'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=None, help='Worker threads (default JOB_WORKER_CONCURRENCY)')
+        parser.add_argument('--poll-interval', type=float, default=None, help='Seconds between polls of an idle worker (default JOB_POLL_SECONDS)')
+        parser.add_argument('--once', action='store_true', help='Exit when no job is due instead of polling')
+
+    def handle(self, *args, **options):
+        concurrency = options['concurrency'] or settings.JOB_WORKER_CONCURRENCY
+        if concurrency < 1:
+            raise CommandError('--concurrency must be at least 1.')
+        lock = threading.Lock()
+
+        def log(message):
+            with lock:
+                self.stdout.write(message)
+
+        threads, stop = start_workers(concurrency, poll_interval=options['poll_interval'], once=options['once'], log=log)
+        self.stdout.write(f'{concurrency} workers started, Ctrl-C stops them after their current job')
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        self.stdout.write(self.style.SUCCESS('Workers stopped'))
@@ -0,0 +1,37 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connections
+
+from medical.replicas import PRIMARY, replica_lag
+
+
+class Command(BaseCommand):
+    help = 'Copy the SQLite primary over the SQLite replicas: a local stand-in for replication, to try the replica router'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0, help='Copy again every this many seconds (default: once)')
+
+    def handle(self, *args, **options):
+        if not settings.DATABASE_REPLICAS:
+            raise CommandError('No replicas, set DATABASE_REPLICA_URLS.')
+        for alias in [PRIMARY, *settings.DATABASE_REPLICAS]:
+            if connections[alias].vendor != 'sqlite':
+                raise CommandError(f'{alias} is not SQLite, use the database\'s own replication.')
+
+        while True:
+            for alias in settings.DATABASE_REPLICAS:
+                try:
+                    lag = f'{replica_lag(alias):.1f} s behind'
+                except DatabaseError:
+                    lag = 'not initialized'
+                connections[alias].close()
+                # the backup API copies a consistent snapshot, even while the primary is written to
+                with sqlite3.connect(connections[PRIMARY].settings_dict['NAME']) as source, sqlite3.connect(connections[alias].settings_dict['NAME']) as target:
+                    source.backup(target)
+                self.stdout.write(f'{alias}: was {lag}, copied')
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,310 @@
+"""
+Per-endpoint request metrics in Prometheus text format, without external dependencies.
+
+MetricsMiddleware records for every request, labelled with the resolved URL name
+(doctor-detail, patient-record-list-create, ...): latency histogram, SQL query count
+histogram, SQL time, response bytes and status codes. A streaming response (the exports) is
+observed once its body has been sent: its latency, queries and bytes cover the whole stream.
+
+Every process keeps its own counters. With several gunicorn workers set METRICS_MULTIPROC_DIR
+to a directory shared by the workers: each one dumps its counters there (at most every
+METRICS_FLUSH_INTERVAL seconds) and a scrape, whichever worker serves it, adds them all up.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# extra counters (cache hits etc.) reported by other modules: name -> callable returning {counter: value}
+_collectors = {}
+
+
+def register_collector(name, collect):
+    """
+    Adds counters from elsewhere to the scrape as medical_<name>_<counter>_total, e.g.
+    register_collector('token_cache', lambda: {'hits': ..., 'misses': ...}).
+    """
+    _collectors[name] = collect
+
+
+class _Histogram:
+    @staticmethod
+    def new(buckets):
+        return {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+
+    @staticmethod
+    def observe(histogram, buckets, value):
+        for index, bound in enumerate(buckets):
+            if value <= bound:
+                histogram['buckets'][index] += 1
+                break
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = self._empty()
+        self._last_flush = 0.0
+
+    @staticmethod
+    def _empty():
+        return {
+            'requests': {},        # "view|method|status" -> count
+            'latency': {},         # view -> histogram (seconds)
+            'sql_queries': {},     # view -> histogram (queries per request)
+            'sql_seconds': {},     # view -> total seconds spent in SQL
+            'response_bytes': {},  # view -> total bytes
+        }
+
+    def observe(self, view, method, status, duration, queries, sql_seconds, size):
+        with self._lock:
+            state = self._state
+            key = f'{view}|{method}|{status}'
+            state['requests'][key] = state['requests'].get(key, 0) + 1
+            _Histogram.observe(state['latency'].setdefault(view, _Histogram.new(LATENCY_BUCKETS)), LATENCY_BUCKETS, duration)
+            _Histogram.observe(state['sql_queries'].setdefault(view, _Histogram.new(QUERY_BUCKETS)), QUERY_BUCKETS, queries)
+            state['sql_seconds'][view] = state['sql_seconds'].get(view, 0.0) + sql_seconds
+            state['response_bytes'][view] = state['response_bytes'].get(view, 0) + size
+        self.maybe_flush()
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = json.loads(json.dumps(self._state))
+        snapshot['collectors'] = {name: collect() for name, collect in _collectors.items()}
+        return snapshot
+
+    # multi-process support
+
+    @staticmethod
+    def _directory():
+        return getattr(settings, 'METRICS_MULTIPROC_DIR', None)
+
+    def maybe_flush(self, force=False):
+        directory = self._directory()
+        if not directory:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_flush < settings.METRICS_FLUSH_INTERVAL:
+            return
+        self._last_flush = now
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as out:
+            json.dump(self.snapshot(), out)
+        os.replace(tmp_path, os.path.join(directory, f'metrics_{os.getpid()}.json'))
+
+    def collect(self):
+        """This process's counters, plus the other workers' when METRICS_MULTIPROC_DIR is set."""
+        directory = self._directory()
+        if not directory:
+            return self.snapshot()
+        self.maybe_flush(force=True)
+        merged = self._empty()
+        merged['collectors'] = {}
+        for name in os.listdir(directory):
+            if not (name.startswith('metrics_') and name.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(directory, name)) as source:
+                    _merge(merged, json.load(source))
+            except (OSError, ValueError):
+                continue  # a worker is replacing its file right now
+        return merged
+
+
+def _merge(into, other):
+    for section in ('requests', 'sql_seconds', 'response_bytes'):
+        for key, value in other.get(section, {}).items():
+            into[section][key] = into[section].get(key, 0) + value
+    for section in ('latency', 'sql_queries'):
+        for key, histogram in other.get(section, {}).items():
+            target = into[section].setdefault(key, {'buckets': [0] * len(histogram['buckets']), 'sum': 0.0, 'count': 0})
+            target['buckets'] = [a + b for a, b in zip(target['buckets'], histogram['buckets'])]
+            target['sum'] += histogram['sum']
+            target['count'] += histogram['count']
+    for name, counters in other.get('collectors', {}).items():
+        target = into['collectors'].setdefault(name, {})
+        for key, value in counters.items():
+            target[key] = target.get(key, 0) + value
+
+
+registry = MetricsRegistry()
+
+
+def _labels(**labels):
+    return ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels.items())
+
+
+def _histogram_lines(name, buckets, histograms):
+    lines = []
+    for view, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(buckets, histogram['buckets']):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{_labels(view=view, le=bound)}}} {cumulative}')
+        lines.append(f'{name}_bucket{{{_labels(view=view, le="+Inf")}}} {histogram["count"]}')
+        lines.append(f'{name}_sum{{{_labels(view=view)}}} {histogram["sum"]}')
+        lines.append(f'{name}_count{{{_labels(view=view)}}} {histogram["count"]}')
+    return lines
+
+
+def render_prometheus(state):
+    lines = [
+        '# HELP medical_http_requests_total Requests by URL name, method and status code.',
+        '# TYPE medical_http_requests_total counter',
+    ]
+    for key, count in sorted(state['requests'].items()):
+        view, method, status = key.split('|')
+        lines.append(f'medical_http_requests_total{{{_labels(view=view, method=method, status=status)}}} {count}')
+
+    lines += [
+        '# HELP medical_http_request_duration_seconds Request latency by URL name.',
+        '# TYPE medical_http_request_duration_seconds histogram',
+    ]
+    lines += _histogram_lines('medical_http_request_duration_seconds', LATENCY_BUCKETS, state['latency'])
+
+    lines += [
+        '# HELP medical_http_sql_queries SQL queries per request by URL name.',
+        '# TYPE medical_http_sql_queries histogram',
+    ]
+    lines += _histogram_lines('medical_http_sql_queries', QUERY_BUCKETS, state['sql_queries'])
+
+    lines += [
+        '# HELP medical_http_sql_duration_seconds_total Time spent in SQL by URL name.',
+        '# TYPE medical_http_sql_duration_seconds_total counter',
+    ]
+    lines += [f'medical_http_sql_duration_seconds_total{{{_labels(view=view)}}} {value}' for view, value in sorted(state['sql_seconds'].items())]
+
+    lines += [
+        '# HELP medical_http_response_bytes_total Response body bytes by URL name.',
+        '# TYPE medical_http_response_bytes_total counter',
+    ]
+    lines += [f'medical_http_response_bytes_total{{{_labels(view=view)}}} {value}' for view, value in sorted(state['response_bytes'].items())]
+
+    for name, counters in sorted(state.get('collectors', {}).items()):
+        for counter, value in sorted(counters.items()):
+            metric = f'medical_{name}_{counter}_total'
+            lines += [f'# TYPE {metric} counter', f'{metric} {value}']
+    return '\n'.join(lines) + '\n'
+
+
+class _QueryCounter:
+    """connection.execute_wrapper() hook counting and timing the queries of one request."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.count += 1
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True  # under ASGI the async views keep an all-async middleware chain
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        counter = _QueryCounter()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(counter))
+            response = self.get_response(request)
+        if response.streaming:
+            self.observe_stream(request, response, started, counter, connections.all())
+        else:
+            self.observe(request, response, time.perf_counter() - started, counter)
+        return response
+
+    async def __acall__(self, request):
+        counter = _QueryCounter()
+        started = time.perf_counter()
+        # the async ORM runs its queries in the request's sync thread, which has its own connections
+        request_connections = await sync_to_async(connections.all)()
+        with ExitStack() as stack:
+            for connection in request_connections:
+                stack.enter_context(connection.execute_wrapper(counter))
+            response = await self.get_response(request)
+        if response.streaming:
+            self.observe_stream(request, response, started, counter, request_connections)
+        else:
+            self.observe(request, response, time.perf_counter() - started, counter)
+        return response
+
+    @staticmethod
+    def observe(request, response, duration, counter, size=None):
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name or match.view_name) if match else 'unmatched'
+        size = len(response.content) if size is None else size
+        registry.observe(view, request.method, response.status_code, duration, counter.count, counter.seconds, size)
+
+    def observe_stream(self, request, response, started, counter, request_connections):
+        """
+        Wraps a streaming response's body to count the queries and bytes of the stream, and
+        observes the request when the body is exhausted (or closed early by the server). An
+        async body queries through the request's connections, a sync one through those of the
+        thread iterating it (under ASGI a sync_to_async one).
+        """
+        content = response.streaming_content
+
+        def finish(size):
+            self.observe(request, response, time.perf_counter() - started, counter, size)
+
+        if response.is_async:
+            async def observed():
+                size = 0
+                try:
+                    with ExitStack() as stack:
+                        for connection in request_connections:
+                            stack.enter_context(connection.execute_wrapper(counter))
+                        async for chunk in content:
+                            size += len(chunk)
+                            yield chunk
+                finally:
+                    finish(size)
+        else:
+            def observed():
+                size = 0
+                try:
+                    with ExitStack() as stack:
+                        for connection in connections.all():
+                            stack.enter_context(connection.execute_wrapper(counter))
+                        for chunk in content:
+                            size += len(chunk)
+                            yield chunk
+                finally:
+                    finish(size)
+
+        response.streaming_content = observed()
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint. Set METRICS_TOKEN to require 'Authorization: Bearer <token>'."""
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token and request.META.get('HTTP_AUTHORIZATION') != f'Bearer {token}':
+        return HttpResponseForbidden()
+    return HttpResponse(render_prometheus(registry.collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
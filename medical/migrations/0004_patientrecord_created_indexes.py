@@ -0,0 +1,25 @@
+# Generated by Django 5.1 on 2026-10-18 18:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medical', '0003_patient_assigned_doctor_patient_department_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='patientrecord',
+            index=models.Index(fields=['created_date'], name='record_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patientrecord',
+            index=models.Index(fields=['department', 'created_date'], name='record_dept_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patientrecord',
+            index=models.Index(fields=['patient', 'created_date'], name='record_patient_created_idx'),
+        ),
+    ]
@@ -0,0 +1,82 @@
+from django.db import migrations
+
+# The SQL as of this migration, frozen here: medical/search.py can change without changing
+# what this migration does.
+
+SQLITE_TABLE_SQL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS medical_patientrecord_fts USING fts5(
+    diagnostics, observations, treatments,
+    content='medical_patientrecord', content_rowid='record_id',
+    tokenize='porter unicode61'
+)
+"""
+
+SQLITE_TRIGGERS_SQL = [
+    """
+    CREATE TRIGGER IF NOT EXISTS medical_patientrecord_fts_ai AFTER INSERT ON medical_patientrecord BEGIN
+        INSERT INTO medical_patientrecord_fts(rowid, diagnostics, observations, treatments)
+        VALUES (new.record_id, new.diagnostics, new.observations, new.treatments);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS medical_patientrecord_fts_ad AFTER DELETE ON medical_patientrecord BEGIN
+        INSERT INTO medical_patientrecord_fts(medical_patientrecord_fts, rowid, diagnostics, observations, treatments)
+        VALUES ('delete', old.record_id, old.diagnostics, old.observations, old.treatments);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS medical_patientrecord_fts_au AFTER UPDATE OF diagnostics, observations, treatments ON medical_patientrecord BEGIN
+        INSERT INTO medical_patientrecord_fts(medical_patientrecord_fts, rowid, diagnostics, observations, treatments)
+        VALUES ('delete', old.record_id, old.diagnostics, old.observations, old.treatments);
+        INSERT INTO medical_patientrecord_fts(rowid, diagnostics, observations, treatments)
+        VALUES (new.record_id, new.diagnostics, new.observations, new.treatments);
+    END
+    """,
+]
+
+POSTGRESQL_INDEX_SQL = [
+    """
+    ALTER TABLE medical_patientrecord ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(diagnostics, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(treatments, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(observations, '')), 'C')
+    ) STORED
+    """,
+    'CREATE INDEX IF NOT EXISTS medical_patientrecord_search_idx ON medical_patientrecord USING GIN (search_vector)',
+]
+
+
+def forwards(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        if schema_editor.connection.vendor == 'sqlite':
+            cursor.execute(SQLITE_TABLE_SQL)
+            for statement in SQLITE_TRIGGERS_SQL:
+                cursor.execute(statement)
+            # index the rows that already exist
+            cursor.execute("INSERT INTO medical_patientrecord_fts(medical_patientrecord_fts) VALUES ('rebuild')")
+        elif schema_editor.connection.vendor == 'postgresql':
+            # the generated column is computed for existing rows when it is added
+            for statement in POSTGRESQL_INDEX_SQL:
+                cursor.execute(statement)
+
+
+def backwards(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        if schema_editor.connection.vendor == 'sqlite':
+            for suffix in ('au', 'ad', 'ai'):
+                cursor.execute(f'DROP TRIGGER IF EXISTS medical_patientrecord_fts_{suffix}')
+            cursor.execute('DROP TABLE IF EXISTS medical_patientrecord_fts')
+        elif schema_editor.connection.vendor == 'postgresql':
+            cursor.execute('DROP INDEX IF EXISTS medical_patientrecord_search_idx')
+            cursor.execute('ALTER TABLE medical_patientrecord DROP COLUMN IF EXISTS search_vector')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medical', '0004_patientrecord_created_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
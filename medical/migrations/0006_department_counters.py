@@ -0,0 +1,141 @@
+# Generated by Django 5.1 on 2026-10-18 18:25
+
+from django.db import migrations, models
+
+# The SQL as of this migration, frozen here: medical/counters.py can change without changing
+# what this migration does. 0010 and 0012 install the same triggers with these templates.
+
+# per counter: the trigger names, the table counted, its foreign key, the counter's table and column
+COUNTERS = [
+    {'name': 'medical_doctor_department_count', 'source': 'medical_doctor', 'source_pk': 'id', 'fk': 'department_id',
+     'target': 'medical_department', 'target_pk': 'id', 'counter': 'doctor_count'},
+    {'name': 'medical_patient_department_count', 'source': 'medical_patient', 'source_pk': 'id', 'fk': 'department_id',
+     'target': 'medical_department', 'target_pk': 'id', 'counter': 'patient_count'},
+    {'name': 'medical_patient_assigned_doctor_count', 'source': 'medical_patient', 'source_pk': 'id', 'fk': 'assigned_doctor_id',
+     'target': 'medical_doctor', 'target_pk': 'id', 'counter': 'patient_count'},
+    {'name': 'medical_patientrecord_department_count', 'source': 'medical_patientrecord', 'source_pk': 'record_id', 'fk': 'department_id',
+     'target': 'medical_department', 'target_pk': 'id', 'counter': 'record_count'},
+]
+
+SQLITE_TRIGGERS_SQL = [
+    """
+    CREATE TRIGGER IF NOT EXISTS {name}_ai AFTER INSERT ON {source} WHEN new.{fk} IS NOT NULL BEGIN
+        UPDATE {target} SET {counter} = {counter} + 1 WHERE {target_pk} = new.{fk};
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS {name}_ad AFTER DELETE ON {source} WHEN old.{fk} IS NOT NULL BEGIN
+        UPDATE {target} SET {counter} = {counter} - 1 WHERE {target_pk} = old.{fk};
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS {name}_au AFTER UPDATE OF {fk} ON {source} WHEN old.{fk} IS NOT new.{fk} BEGIN
+        UPDATE {target} SET {counter} = {counter} - 1 WHERE {target_pk} = old.{fk};
+        UPDATE {target} SET {counter} = {counter} + 1 WHERE {target_pk} = new.{fk};
+    END
+    """,
+]
+
+POSTGRESQL_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION {name}() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE {target} t SET {counter} = t.{counter} + d.delta
+        FROM (SELECT {fk} AS id, count(*) AS delta FROM new_rows WHERE {fk} IS NOT NULL GROUP BY {fk}) d
+        WHERE t.{target_pk} = d.id;
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE {target} t SET {counter} = t.{counter} - d.delta
+        FROM (SELECT {fk} AS id, count(*) AS delta FROM old_rows WHERE {fk} IS NOT NULL GROUP BY {fk}) d
+        WHERE t.{target_pk} = d.id;
+    ELSE
+        UPDATE {target} t SET {counter} = t.{counter} - d.delta
+        FROM (SELECT o.{fk} AS id, count(*) AS delta FROM old_rows o JOIN new_rows n ON n.{source_pk} = o.{source_pk}
+              WHERE o.{fk} IS DISTINCT FROM n.{fk} AND o.{fk} IS NOT NULL GROUP BY o.{fk}) d
+        WHERE t.{target_pk} = d.id;
+        UPDATE {target} t SET {counter} = t.{counter} + d.delta
+        FROM (SELECT n.{fk} AS id, count(*) AS delta FROM old_rows o JOIN new_rows n ON n.{source_pk} = o.{source_pk}
+              WHERE o.{fk} IS DISTINCT FROM n.{fk} AND n.{fk} IS NOT NULL GROUP BY n.{fk}) d
+        WHERE t.{target_pk} = d.id;
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+POSTGRESQL_TRIGGERS_SQL = [
+    'DROP TRIGGER IF EXISTS {name}_ins ON {source}',
+    'CREATE TRIGGER {name}_ins AFTER INSERT ON {source} REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {name}()',
+    'DROP TRIGGER IF EXISTS {name}_del ON {source}',
+    'CREATE TRIGGER {name}_del AFTER DELETE ON {source} REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION {name}()',
+    'DROP TRIGGER IF EXISTS {name}_upd ON {source}',
+    'CREATE TRIGGER {name}_upd AFTER UPDATE ON {source} REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {name}()',
+]
+
+
+def install_counter_triggers(connection, counters):
+    with connection.cursor() as cursor:
+        for tables in counters:
+            if connection.vendor == 'sqlite':
+                for statement in SQLITE_TRIGGERS_SQL:
+                    cursor.execute(statement.format(**tables))
+            elif connection.vendor == 'postgresql':
+                cursor.execute(POSTGRESQL_FUNCTION_SQL.format(**tables))
+                for statement in POSTGRESQL_TRIGGERS_SQL:
+                    cursor.execute(statement.format(**tables))
+
+
+def uninstall_counter_triggers(connection, counters):
+    with connection.cursor() as cursor:
+        for tables in counters:
+            if connection.vendor == 'sqlite':
+                for suffix in ('ai', 'ad', 'au'):
+                    cursor.execute(f"DROP TRIGGER IF EXISTS {tables['name']}_{suffix}")
+            elif connection.vendor == 'postgresql':
+                for suffix in ('ins', 'del', 'upd'):
+                    cursor.execute(f"DROP TRIGGER IF EXISTS {tables['name']}_{suffix} ON {tables['source']}")
+                cursor.execute(f"DROP FUNCTION IF EXISTS {tables['name']}()")
+
+
+def forwards(apps, schema_editor):
+    install_counter_triggers(schema_editor.connection, COUNTERS)
+    # counts for the rows that already exist
+    with schema_editor.connection.cursor() as cursor:
+        for tables in COUNTERS:
+            cursor.execute(
+                'UPDATE {target} SET {counter} = (SELECT count(*) FROM {source} WHERE {source}.{fk} = {target}.{target_pk})'.format(**tables)
+            )
+
+
+def backwards(apps, schema_editor):
+    uninstall_counter_triggers(schema_editor.connection, COUNTERS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medical', '0005_patientrecord_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='department',
+            name='doctor_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='department',
+            name='patient_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='department',
+            name='record_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='doctor',
+            name='patient_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(forwards, backwards),
+    ]
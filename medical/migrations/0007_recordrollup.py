@@ -0,0 +1,216 @@
+# Generated by Django 5.1 on 2026-10-18 18:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# The SQL as of this migration, frozen here: medical/rollups.py can change without changing
+# what this migration does. 0010 installs the same triggers on the archive with these templates.
+
+ROLLUP_TABLE = 'medical_recordrollup'
+CONFLICT = '(department_id, kind, month, value)'
+
+MONTH_SQL = {
+    'sqlite': "strftime('%Y-%m-01', {p}created_date)",
+    'postgresql': "date_trunc('month', {p}created_date AT TIME ZONE 'UTC')::date",
+}
+VALUE_SQL = {
+    'sqlite': "substr(lower(trim({p}{column})), 1, 200)",
+    'postgresql': "left(lower(btrim({p}{column})), 200)",
+}
+
+
+def _buckets(vendor, source, where='TRUE', p=''):
+    """SELECT department_id, kind, month, value, record_count grouped over the rows of `source`."""
+    month = MONTH_SQL[vendor].format(p=p)
+    selects = [
+        f"SELECT {p}department_id AS department_id, 'total' AS kind, {month} AS month, '' AS value, count(*) AS record_count "
+        f"FROM {source} WHERE {p}department_id IS NOT NULL AND {where} GROUP BY 1, 3"
+    ]
+    for kind, column in (('diagnosis', 'diagnostics'), ('treatment', 'treatments')):
+        value = VALUE_SQL[vendor].format(p=p, column=column)
+        selects.append(
+            f"SELECT {p}department_id, '{kind}', {month}, {value}, count(*) "
+            f"FROM {source} WHERE {p}department_id IS NOT NULL AND {where} GROUP BY 1, 3, 4"
+        )
+    return ' UNION ALL '.join(selects)
+
+
+def _add_sql(vendor, source, where='TRUE', p=''):
+    return (
+        f'INSERT INTO {ROLLUP_TABLE} (department_id, kind, month, value, record_count) '
+        f'SELECT * FROM ({_buckets(vendor, source, where, p)}) buckets WHERE TRUE '
+        f'ON CONFLICT {CONFLICT} DO UPDATE SET record_count = {ROLLUP_TABLE}.record_count + excluded.record_count'
+    )
+
+
+def _subtract_sql(vendor, source, where='TRUE', p=''):
+    return (
+        f'UPDATE {ROLLUP_TABLE} SET record_count = {ROLLUP_TABLE}.record_count - buckets.record_count '
+        f'FROM ({_buckets(vendor, source, where, p)}) buckets '
+        f'WHERE {ROLLUP_TABLE}.department_id = buckets.department_id AND {ROLLUP_TABLE}.kind = buckets.kind '
+        f'AND {ROLLUP_TABLE}.month = buckets.month AND {ROLLUP_TABLE}.value = buckets.value'
+    )
+
+
+def _sqlite_row(row):
+    """The three buckets of one trigger row (new / old) as a VALUES list."""
+    month = MONTH_SQL['sqlite'].format(p=f'{row}.')
+    diagnosis = VALUE_SQL['sqlite'].format(p=f'{row}.', column='diagnostics')
+    treatment = VALUE_SQL['sqlite'].format(p=f'{row}.', column='treatments')
+    return [('total', month, "''"), ('diagnosis', month, diagnosis), ('treatment', month, treatment)]
+
+
+def _sqlite_add(row):
+    values = ', '.join(f"({row}.department_id, '{kind}', {month}, {value}, 1)" for kind, month, value in _sqlite_row(row))
+    return (
+        f'INSERT INTO {ROLLUP_TABLE} (department_id, kind, month, value, record_count) VALUES {values} '
+        f'ON CONFLICT {CONFLICT} DO UPDATE SET record_count = record_count + 1;'
+    )
+
+
+def _sqlite_subtract(row):
+    return '\n'.join(
+        f"UPDATE {ROLLUP_TABLE} SET record_count = record_count - 1 "
+        f"WHERE department_id = {row}.department_id AND kind = '{kind}' AND month = {month} AND value = {value};"
+        for kind, month, value in _sqlite_row(row)
+    )
+
+
+_CHANGED = ('old.department_id IS NOT new.department_id OR old.created_date IS NOT new.created_date '
+            'OR old.diagnostics IS NOT new.diagnostics OR old.treatments IS NOT new.treatments')
+_UPDATE_OF = 'department_id, created_date, diagnostics, treatments'
+
+
+def _sqlite_triggers_sql(name, table):
+    return [
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {name}_ai AFTER INSERT ON {table}
+        WHEN new.department_id IS NOT NULL BEGIN
+            {_sqlite_add('new')}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {name}_ad AFTER DELETE ON {table}
+        WHEN old.department_id IS NOT NULL BEGIN
+            {_sqlite_subtract('old')}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {name}_au_old AFTER UPDATE OF {_UPDATE_OF} ON {table}
+        WHEN old.department_id IS NOT NULL AND ({_CHANGED}) BEGIN
+            {_sqlite_subtract('old')}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {name}_au_new AFTER UPDATE OF {_UPDATE_OF} ON {table}
+        WHEN new.department_id IS NOT NULL AND ({_CHANGED}) BEGIN
+            {_sqlite_add('new')}
+        END
+        """,
+    ]
+
+
+_PG_CHANGED_OLD = (
+    '(SELECT o.* FROM old_rows o JOIN new_rows n ON n.record_id = o.record_id '
+    'WHERE (o.department_id, o.created_date, o.diagnostics, o.treatments) '
+    'IS DISTINCT FROM (n.department_id, n.created_date, n.diagnostics, n.treatments)) changed'
+)
+_PG_CHANGED_NEW = _PG_CHANGED_OLD.replace('SELECT o.*', 'SELECT n.*')
+
+POSTGRESQL_FUNCTION_SQL = f"""
+CREATE OR REPLACE FUNCTION {ROLLUP_TABLE}_apply() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        {_add_sql('postgresql', 'new_rows')};
+    ELSIF TG_OP = 'DELETE' THEN
+        {_subtract_sql('postgresql', 'old_rows')};
+    ELSE
+        {_subtract_sql('postgresql', _PG_CHANGED_OLD)};
+        {_add_sql('postgresql', _PG_CHANGED_NEW)};
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+
+def _postgresql_triggers_sql(name, table):
+    # one function for both tables, it only reads the transition tables
+    return [
+        f'DROP TRIGGER IF EXISTS {name}_ins ON {table}',
+        f'CREATE TRIGGER {name}_ins AFTER INSERT ON {table} REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {ROLLUP_TABLE}_apply()',
+        f'DROP TRIGGER IF EXISTS {name}_del ON {table}',
+        f'CREATE TRIGGER {name}_del AFTER DELETE ON {table} REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION {ROLLUP_TABLE}_apply()',
+        f'DROP TRIGGER IF EXISTS {name}_upd ON {table}',
+        f'CREATE TRIGGER {name}_upd AFTER UPDATE ON {table} REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {ROLLUP_TABLE}_apply()',
+    ]
+
+
+def install_rollup_triggers(connection, sources):
+    """sources: [(trigger name prefix, record table)]."""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(POSTGRESQL_FUNCTION_SQL)
+        for name, table in sources:
+            if connection.vendor == 'sqlite':
+                statements = _sqlite_triggers_sql(name, table)
+            elif connection.vendor == 'postgresql':
+                statements = _postgresql_triggers_sql(name, table)
+            else:
+                statements = []
+            for statement in statements:
+                cursor.execute(statement)
+
+
+def uninstall_rollup_triggers(connection, sources):
+    with connection.cursor() as cursor:
+        for name, table in sources:
+            if connection.vendor == 'sqlite':
+                for suffix in ('ai', 'ad', 'au_old', 'au_new'):
+                    cursor.execute(f'DROP TRIGGER IF EXISTS {name}_{suffix}')
+            elif connection.vendor == 'postgresql':
+                for suffix in ('ins', 'del', 'upd'):
+                    cursor.execute(f'DROP TRIGGER IF EXISTS {name}_{suffix} ON {table}')
+        if connection.vendor == 'postgresql':
+            cursor.execute(f'DROP FUNCTION IF EXISTS {ROLLUP_TABLE}_apply()')
+
+
+SOURCES = [(ROLLUP_TABLE, 'medical_patientrecord')]
+
+
+def forwards(apps, schema_editor):
+    install_rollup_triggers(schema_editor.connection, SOURCES)
+    if schema_editor.connection.vendor in MONTH_SQL:
+        # buckets for the records that already exist, in one statement: manage.py
+        # backfill_rollups rebuilds them in batches when that's too long for a deploy
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(_add_sql(schema_editor.connection.vendor, 'medical_patientrecord'))
+
+
+def backwards(apps, schema_editor):
+    uninstall_rollup_triggers(schema_editor.connection, SOURCES)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medical', '0006_department_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecordRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('total', 'All records'), ('diagnosis', 'Diagnosis'), ('treatment', 'Treatment')], max_length=10)),
+                ('month', models.DateField()),
+                ('value', models.CharField(blank=True, max_length=200)),
+                ('record_count', models.IntegerField(default=0)),
+                ('department', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='medical.department')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('department', 'kind', 'month', 'value'), name='rollup_bucket_uniq')],
+            },
+        ),
+        migrations.RunPython(forwards, backwards),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.1 on 2026-10-18 18:41
+
+from importlib import import_module
+
+from django.db import migrations, models
+
+# the triggers as 0005, 0006 and 0007 created them
+search_index = import_module('medical.migrations.0005_patientrecord_search_index')
+department_counters = import_module('medical.migrations.0006_department_counters')
+record_rollup = import_module('medical.migrations.0007_recordrollup')
+
+
+def forwards(apps, schema_editor):
+    PatientRecord = apps.get_model('medical', 'PatientRecord')
+    # existing records were last written when they were created
+    PatientRecord.objects.using(schema_editor.connection.alias).update(updated_at=models.F('created_date'))
+    # SQLite rebuilds the table to add the columns, which drops the triggers on it
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for statement in search_index.SQLITE_TRIGGERS_SQL:
+            cursor.execute(statement)
+    department_counters.install_counter_triggers(
+        schema_editor.connection, [tables for tables in department_counters.COUNTERS if tables['source'] == 'medical_patientrecord'],
+    )
+    record_rollup.install_rollup_triggers(schema_editor.connection, record_rollup.SOURCES)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medical', '0007_recordrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patientrecord',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='patientrecord',
+            name='version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
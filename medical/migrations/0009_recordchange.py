@@ -0,0 +1,137 @@
+# Generated by Django 5.1 on 2026-10-18 18:47
+
+from django.db import migrations, models
+
+# The SQL as of this migration, frozen here: medical/changes.py can change without changing
+# what this migration does.
+
+CHANGE_TABLE = 'medical_recordchange'
+RECORD_TABLE = 'medical_patientrecord'
+
+_COLUMNS = ('patient_id', 'created_date', 'diagnostics', 'observations', 'treatments', 'department_id', 'misc', 'version', 'updated_at')
+_CHANGED = ' OR '.join(f'old.{column} IS NOT new.{column}' for column in _COLUMNS)
+_NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+
+def _sqlite_log(row, operation):
+    return (
+        f'INSERT INTO {CHANGE_TABLE} (record_id, patient_id, operation, changed_at) '
+        f"VALUES ({row}.record_id, {row}.patient_id, '{operation}', {_NOW});"
+    )
+
+
+SQLITE_TRIGGERS_SQL = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {CHANGE_TABLE}_ai AFTER INSERT ON {RECORD_TABLE} BEGIN
+        {_sqlite_log('new', 'created')}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {CHANGE_TABLE}_ad AFTER DELETE ON {RECORD_TABLE} BEGIN
+        {_sqlite_log('old', 'deleted')}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {CHANGE_TABLE}_au AFTER UPDATE ON {RECORD_TABLE}
+    WHEN old.patient_id IS new.patient_id AND ({_CHANGED}) BEGIN
+        {_sqlite_log('new', 'updated')}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {CHANGE_TABLE}_au_moved AFTER UPDATE OF patient_id ON {RECORD_TABLE}
+    WHEN old.patient_id IS NOT new.patient_id BEGIN
+        {_sqlite_log('old', 'deleted')}
+        {_sqlite_log('new', 'created')}
+    END
+    """,
+]
+
+_PG_INSERT = f'INSERT INTO {CHANGE_TABLE} (record_id, patient_id, operation, changed_at)'
+_PG_JOINED = 'FROM old_rows o JOIN new_rows n ON n.record_id = o.record_id'
+
+POSTGRESQL_FUNCTION_SQL = f"""
+CREATE OR REPLACE FUNCTION {CHANGE_TABLE}_log() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    -- held until commit: seqs are handed out in commit order
+    PERFORM pg_advisory_xact_lock(hashtext('{CHANGE_TABLE}'));
+    IF TG_OP = 'INSERT' THEN
+        {_PG_INSERT} SELECT record_id, patient_id, 'created', now() FROM new_rows ORDER BY record_id;
+    ELSIF TG_OP = 'DELETE' THEN
+        {_PG_INSERT} SELECT record_id, patient_id, 'deleted', now() FROM old_rows ORDER BY record_id;
+    ELSE
+        {_PG_INSERT} SELECT n.record_id, n.patient_id, 'updated', now() {_PG_JOINED}
+            WHERE o.patient_id = n.patient_id AND o IS DISTINCT FROM n ORDER BY n.record_id;
+        {_PG_INSERT} SELECT record_id, patient_id, operation, now() FROM (
+            SELECT o.record_id, o.patient_id, 'deleted' AS operation, 0 AS step {_PG_JOINED} WHERE o.patient_id <> n.patient_id
+            UNION ALL
+            SELECT n.record_id, n.patient_id, 'created', 1 {_PG_JOINED} WHERE o.patient_id <> n.patient_id
+        ) moved ORDER BY record_id, step;
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+POSTGRESQL_TRIGGERS_SQL = [
+    f'DROP TRIGGER IF EXISTS {CHANGE_TABLE}_ins ON {RECORD_TABLE}',
+    f'CREATE TRIGGER {CHANGE_TABLE}_ins AFTER INSERT ON {RECORD_TABLE} REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {CHANGE_TABLE}_log()',
+    f'DROP TRIGGER IF EXISTS {CHANGE_TABLE}_del ON {RECORD_TABLE}',
+    f'CREATE TRIGGER {CHANGE_TABLE}_del AFTER DELETE ON {RECORD_TABLE} REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION {CHANGE_TABLE}_log()',
+    f'DROP TRIGGER IF EXISTS {CHANGE_TABLE}_upd ON {RECORD_TABLE}',
+    f'CREATE TRIGGER {CHANGE_TABLE}_upd AFTER UPDATE ON {RECORD_TABLE} REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {CHANGE_TABLE}_log()',
+]
+
+
+def install_change_triggers(connection):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            for statement in SQLITE_TRIGGERS_SQL:
+                cursor.execute(statement)
+        elif connection.vendor == 'postgresql':
+            cursor.execute(POSTGRESQL_FUNCTION_SQL)
+            for statement in POSTGRESQL_TRIGGERS_SQL:
+                cursor.execute(statement)
+
+
+def uninstall_change_triggers(connection):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            for suffix in ('ai', 'ad', 'au', 'au_moved'):
+                cursor.execute(f'DROP TRIGGER IF EXISTS {CHANGE_TABLE}_{suffix}')
+        elif connection.vendor == 'postgresql':
+            for suffix in ('ins', 'del', 'upd'):
+                cursor.execute(f'DROP TRIGGER IF EXISTS {CHANGE_TABLE}_{suffix} ON {RECORD_TABLE}')
+            cursor.execute(f'DROP FUNCTION IF EXISTS {CHANGE_TABLE}_log()')
+
+
+def forwards(apps, schema_editor):
+    # the log starts empty: clients begin with a snapshot (no cursor) anyway
+    install_change_triggers(schema_editor.connection)
+
+
+def backwards(apps, schema_editor):
+    uninstall_change_triggers(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medical', '0008_patientrecord_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecordChange',
+            fields=[
+                ('seq', models.BigAutoField(primary_key=True, serialize=False)),
+                ('record_id', models.IntegerField()),
+                ('patient_id', models.IntegerField()),
+                ('operation', models.CharField(choices=[('created', 'Created'), ('updated', 'Updated'), ('deleted', 'Deleted')], max_length=7)),
+                ('changed_at', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['patient_id', 'seq'], name='record_change_patient_idx')],
+            },
+        ),
+        migrations.RunPython(forwards, backwards),
+    ]
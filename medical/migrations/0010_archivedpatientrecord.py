@@ -0,0 +1,69 @@
+# Generated by Django 5.1 on 2026-10-18 18:53
+
+from importlib import import_module
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# the trigger SQL as 0006, 0007 and 0009 froze it
+department_counters = import_module('medical.migrations.0006_department_counters')
+record_rollup = import_module('medical.migrations.0007_recordrollup')
+record_change = import_module('medical.migrations.0009_recordchange')
+
+ARCHIVE_COUNTERS = [
+    {'name': 'medical_archivedpatientrecord_department_count', 'source': 'medical_archivedpatientrecord', 'source_pk': 'record_id',
+     'fk': 'department_id', 'target': 'medical_department', 'target_pk': 'id', 'counter': 'record_count'},
+]
+ARCHIVE_ROLLUP_SOURCES = [('medical_recordrollup_archived', 'medical_archivedpatientrecord')]
+
+
+def drop_change_triggers(apps, schema_editor):
+    # SQLite rebuilds medical_recordchange to widen operation, which fails while triggers insert into it
+    record_change.uninstall_change_triggers(schema_editor.connection)
+
+
+def create_change_triggers(apps, schema_editor):
+    record_change.install_change_triggers(schema_editor.connection)
+
+
+def forwards(apps, schema_editor):
+    # the archive is empty: only its triggers are missing, the counters and rollups stay right
+    department_counters.install_counter_triggers(schema_editor.connection, ARCHIVE_COUNTERS)
+    record_rollup.install_rollup_triggers(schema_editor.connection, ARCHIVE_ROLLUP_SOURCES)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medical', '0009_recordchange'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_change_triggers, create_change_triggers),
+        migrations.AlterField(
+            model_name='recordchange',
+            name='operation',
+            field=models.CharField(choices=[('created', 'Created'), ('updated', 'Updated'), ('deleted', 'Deleted'), ('archived', 'Archived')], max_length=8),
+        ),
+        migrations.RunPython(create_change_triggers, drop_change_triggers),
+        migrations.CreateModel(
+            name='ArchivedPatientRecord',
+            fields=[
+                ('record_id', models.IntegerField(primary_key=True, serialize=False)),
+                ('created_date', models.DateTimeField()),
+                ('diagnostics', models.TextField()),
+                ('observations', models.TextField()),
+                ('treatments', models.TextField()),
+                ('misc', models.TextField(blank=True, null=True)),
+                ('version', models.PositiveIntegerField(default=1)),
+                ('updated_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField()),
+                ('department', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='archived_records', to='medical.department')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_records', to='medical.patient')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['patient', 'created_date'], name='archived_patient_created_idx')],
+            },
+        ),
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.1 on 2026-10-18 19:11
+
+from importlib import import_module
+
+from django.db import migrations, models
+
+# the counter triggers as 0006 and 0010 froze them
+department_counters = import_module('medical.migrations.0006_department_counters')
+archived_patient_record = import_module('medical.migrations.0010_archivedpatientrecord')
+
+COUNTERS = department_counters.COUNTERS + archived_patient_record.ARCHIVE_COUNTERS
+
+
+def drop_counter_triggers(apps, schema_editor):
+    # SQLite rebuilds medical_department to add the column, which fails while triggers update it
+    department_counters.uninstall_counter_triggers(schema_editor.connection, COUNTERS)
+
+
+def create_counter_triggers(apps, schema_editor):
+    department_counters.install_counter_triggers(schema_editor.connection, COUNTERS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medical', '0011_job'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_counter_triggers, create_counter_triggers),
+        migrations.AddField(
+            model_name='department',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunPython(create_counter_triggers, drop_counter_triggers),
+    ]
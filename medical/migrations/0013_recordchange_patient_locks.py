@@ -0,0 +1,58 @@
+# Generated by Django 5.1 on 2026-10-18 20:05
+
+from importlib import import_module
+
+from django.db import migrations
+
+# the function as 0009 froze it, with its single lock for every writer
+record_change = import_module('medical.migrations.0009_recordchange')
+
+# The SQL as of this migration, frozen here. The triggers call the function by name: replacing
+# it is enough. PostgreSQL only, SQLite has no lock to take.
+POSTGRESQL_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION medical_recordchange_log() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    -- held until commit: a patient's seqs are handed out in commit order
+    IF TG_OP = 'INSERT' THEN
+        PERFORM pg_advisory_xact_lock(hashtext('medical_recordchange'), patient_id) FROM (SELECT DISTINCT patient_id FROM new_rows ORDER BY patient_id) patients;
+        INSERT INTO medical_recordchange (record_id, patient_id, operation, changed_at) SELECT record_id, patient_id, 'created', now() FROM new_rows ORDER BY record_id;
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM pg_advisory_xact_lock(hashtext('medical_recordchange'), patient_id) FROM (SELECT DISTINCT patient_id FROM old_rows ORDER BY patient_id) patients;
+        INSERT INTO medical_recordchange (record_id, patient_id, operation, changed_at) SELECT record_id, patient_id, 'deleted', now() FROM old_rows ORDER BY record_id;
+    ELSE
+        PERFORM pg_advisory_xact_lock(hashtext('medical_recordchange'), patient_id) FROM (SELECT patient_id FROM old_rows UNION SELECT patient_id FROM new_rows ORDER BY patient_id) patients;
+        INSERT INTO medical_recordchange (record_id, patient_id, operation, changed_at) SELECT n.record_id, n.patient_id, 'updated', now() FROM old_rows o JOIN new_rows n ON n.record_id = o.record_id
+            WHERE o.patient_id = n.patient_id AND o IS DISTINCT FROM n ORDER BY n.record_id;
+        INSERT INTO medical_recordchange (record_id, patient_id, operation, changed_at) SELECT record_id, patient_id, operation, now() FROM (
+            SELECT o.record_id, o.patient_id, 'deleted' AS operation, 0 AS step FROM old_rows o JOIN new_rows n ON n.record_id = o.record_id WHERE o.patient_id <> n.patient_id
+            UNION ALL
+            SELECT n.record_id, n.patient_id, 'created', 1 FROM old_rows o JOIN new_rows n ON n.record_id = o.record_id WHERE o.patient_id <> n.patient_id
+        ) moved ORDER BY record_id, step;
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+
+def forwards(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(POSTGRESQL_FUNCTION_SQL)
+
+
+def backwards(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(record_change.POSTGRESQL_FUNCTION_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medical', '0012_department_updated_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
@@ -1,18 +1,42 @@
 from django.db import models
 from django.contrib.auth.models import User
 
-class Department(models.Model):
+class DatabaseCounters:
+    """
+    For the models whose `counter_fields` the database maintains (medical/counters.py): save()
+    of an existing row leaves them out of the UPDATE. Written back, the values loaded with the
+    instance would undo the increments committed since, by other requests or workers.
+    """
+    counter_fields = ()
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            update_fields = kwargs.get('update_fields')
+            if update_fields is None:
+                update_fields = [field.name for field in self._meta.concrete_fields if not field.primary_key]
+            kwargs['update_fields'] = [name for name in update_fields if name not in self.counter_fields]
+        super().save(*args, **kwargs)
+
+class Department(DatabaseCounters, models.Model):
     name = models.CharField(max_length=100)
     diagnostics = models.TextField()
     location = models.CharField(max_length=255)
     specialization = models.CharField(max_length=100)
+    updated_at = models.DateTimeField(auto_now=True)  # versions the cached catalogue, see medical/catalogue.py
+    # kept up to date by the database, see medical/counters.py
+    doctor_count = models.IntegerField(default=0, editable=False)
+    patient_count = models.IntegerField(default=0, editable=False)
+    record_count = models.IntegerField(default=0, editable=False)
+    counter_fields = ('doctor_count', 'patient_count', 'record_count')
 
     def __str__(self):
         return self.name
 
-class Doctor(models.Model):
+class Doctor(DatabaseCounters, models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     department = models.ForeignKey(Department, related_name='doctors', on_delete=models.SET_NULL, null=True)
+    patient_count = models.IntegerField(default=0, editable=False)  # see medical/counters.py
+    counter_fields = ('patient_count',)
 
     def __str__(self):
         return self.user.username
@@ -34,6 +58,150 @@ class PatientRecord(models.Model):
     treatments = models.TextField()
     department = models.ForeignKey(Department, on_delete=models.SET_NULL, null=True)
     misc = models.TextField(blank=True, null=True)
+    # bumped by every save() of an existing record, the ETag / If-Match of the record (see medical/versioning.py).
+    # queryset.update() and the database's SET_NULL on department delete leave both as they are.
+    version = models.PositiveIntegerField(default=1, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        # date range scans, per department (record list) and per patient (patient history)
+        indexes = [
+            models.Index(fields=['created_date'], name='record_created_idx'),
+            models.Index(fields=['department', 'created_date'], name='record_dept_created_idx'),
+            models.Index(fields=['patient', 'created_date'], name='record_patient_created_idx'),
+        ]
 
     def __str__(self):
         return f'Record {self.record_id} for {self.patient.user.username}'
+
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            return super().save(*args, **kwargs)
+        # version = version + 1 in the UPDATE itself: two concurrent saves never end up with the same version
+        self.version = models.F('version') + 1
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'version', 'updated_at'}
+        super().save(*args, **kwargs)
+        self.refresh_from_db(fields=['version'])
+
+
+class ArchivedPatientRecord(models.Model):
+    """
+    A PatientRecord moved out of the hot table by medical/archive.py, columns unchanged.
+    Read-only, the record history serves it with ?include_archived=1.
+    """
+    record_id = models.IntegerField(primary_key=True)
+    patient = models.ForeignKey(Patient, related_name='archived_records', on_delete=models.CASCADE)
+    created_date = models.DateTimeField()
+    diagnostics = models.TextField()
+    observations = models.TextField()
+    treatments = models.TextField()
+    department = models.ForeignKey(Department, on_delete=models.SET_NULL, null=True, related_name='archived_records')
+    misc = models.TextField(blank=True, null=True)
+    version = models.PositiveIntegerField(default=1)
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['patient', 'created_date'], name='archived_patient_created_idx'),
+        ]
+
+    def __str__(self):
+        return f'Archived record {self.record_id}'
+
+
+class RecordRollup(models.Model):
+    """
+    Records per department and month: in total and per diagnosis / treatment text.
+    Maintained by the database from PatientRecord, see medical/rollups.py.
+    """
+    KIND_CHOICES = [
+        ('total', 'All records'),
+        ('diagnosis', 'Diagnosis'),
+        ('treatment', 'Treatment'),
+    ]
+
+    department = models.ForeignKey(Department, on_delete=models.CASCADE, related_name='rollups')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    month = models.DateField()  # first day of the month (UTC)
+    value = models.CharField(max_length=200, blank=True)  # normalized text, '' for total
+    record_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # also the index of the analytics queries: department, kind, month range
+            models.UniqueConstraint(fields=['department', 'kind', 'month', 'value'], name='rollup_bucket_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.department_id} {self.month:%Y-%m} {self.kind} {self.value!r}: {self.record_count}'
+
+
+class RecordChange(models.Model):
+    """
+    One insert, update or delete of a PatientRecord, written by the database in the same
+    transaction (see medical/changes.py). seq is the change feed's cursor.
+    """
+    OPERATION_CHOICES = [
+        ('created', 'Created'),
+        ('updated', 'Updated'),
+        ('deleted', 'Deleted'),
+        ('archived', 'Archived'),  # moved to the archive table, not a deletion for the clients
+    ]
+
+    seq = models.BigAutoField(primary_key=True)
+    # plain ids, not foreign keys: a tombstone outlives its record
+    record_id = models.IntegerField()
+    patient_id = models.IntegerField()
+    operation = models.CharField(max_length=8, choices=OPERATION_CHOICES)
+    changed_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            # a patient's changes after a cursor
+            models.Index(fields=['patient_id', 'seq'], name='record_change_patient_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.seq}: record {self.record_id} {self.operation}'
+
+
+class Job(models.Model):
+    """
+    A background job (see medical/jobs.py): the handler registered for `kind`, called with
+    `params` by a manage.py run_jobs worker. Its status is served on jobs/<id>/.
+    """
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+    ]
+
+    kind = models.CharField(max_length=50)
+    params = models.JSONField(default=dict)
+    status = models.CharField(max_length=9, choices=STATUS_CHOICES, default='queued')
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='jobs')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_after = models.DateTimeField()
+    progress_done = models.PositiveIntegerField(default=0)
+    progress_total = models.PositiveIntegerField(null=True)
+    result = models.JSONField(null=True)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=100, blank=True)  # hostname:pid:thread while running
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    heartbeat_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            # the workers' next queued job, and the running ones whose worker died
+            models.Index(fields=['status', 'run_after'], name='job_status_run_after_idx'),
+            models.Index(fields=['created_by', '-created_at'], name='job_created_by_idx'),
+        ]
+
+    def __str__(self):
+        return f'Job {self.pk} {self.kind} {self.status}'
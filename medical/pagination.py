@@ -0,0 +1,100 @@
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, _reverse_ordering
+
+
+class IdCursorPagination(CursorPagination):
+    """
+    Keyset pagination over the primary key.
+
+    The cursor is an opaque base64 token pointing at the last row of the previous
+    page, so each page is a single indexed range scan and no COUNT(*) is issued.
+    Clients can ask for a smaller or bigger page with ?page_size= (capped by max_page_size).
+    """
+    ordering = ('id',)
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+
+class PatientRecordCursorPagination(IdCursorPagination):
+    """
+    Newest records first, ?ordering= can flip it (medical/filters.py).
+
+    DRF's cursor holds the first ordering column only, created_date here, and gets past the rows
+    sharing it with an offset. A page whose rows were all created in the same instant (a
+    bulk_create) has no position at all and the next one is a plain offset, which repeats rows
+    when a record is written between the pages. So the cursor holds every ordering column of
+    the row it points at instead, and the next page is the rows after that (created_date,
+    record_id) pair. The orderings all end with record_id, positions are unique, the offset
+    stays 0.
+    """
+    ordering = ('-created_date', '-record_id')
+
+    def _get_position_from_instance(self, instance, ordering):
+        fields = [field.lstrip('-') for field in ordering]
+        if isinstance(instance, dict):
+            return json.dumps([str(instance[field]) for field in fields])
+        return json.dumps([str(getattr(instance, field)) for field in fields])
+
+    def _after(self, ordering, position):
+        """The rows after position in this ordering: (a, b) > (x, y) is a > x or (a = x and b > y)."""
+        try:
+            values = json.loads(position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(ordering):
+            raise NotFound(self.invalid_cursor_message)
+        after, equal = Q(), {}
+        for field, value in zip(ordering, values):
+            name = field.lstrip('-')
+            after |= Q(**equal, **{f"{name}__{'lt' if field.startswith('-') else 'gt'}": value})
+            equal[name] = value
+        return after
+
+    def paginate_queryset(self, queryset, request, view=None):
+        # CursorPagination.paginate_queryset, with the position compared on every ordering column
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        offset, reverse, current_position = self.cursor or (0, False, None)
+
+        ordering = _reverse_ordering(self.ordering) if reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+        if current_position is not None:
+            try:
+                queryset = queryset.filter(self._after(ordering, current_position))
+            except ValidationError:
+                raise NotFound(self.invalid_cursor_message)  # a position that isn't a date
+
+        results = list(queryset[offset:offset + self.page_size + 1])
+        self.page = results[:self.page_size]
+        has_following_position = len(results) > len(self.page)
+        following_position = self._get_position_from_instance(results[-1], self.ordering) if has_following_position else None
+
+        if reverse:
+            self.page = list(reversed(self.page))
+            self.has_next = current_position is not None or offset > 0
+            self.has_previous = has_following_position
+            if self.has_next:
+                self.next_position = current_position
+            if self.has_previous:
+                self.previous_position = following_position
+        else:
+            self.has_next = has_following_position
+            self.has_previous = current_position is not None or offset > 0
+            if self.has_next:
+                self.next_position = following_position
+            if self.has_previous:
+                self.previous_position = current_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
@@ -1,6 +1,6 @@
 from rest_framework.permissions import BasePermission
 from rest_framework.exceptions import PermissionDenied
-from .models import Doctor
+from .principal import get_principal
 
 class IsDoctor(BasePermission):
     """
@@ -8,9 +8,9 @@ class IsDoctor(BasePermission):
     """
 
     def has_permission(self, request, view):
-        # Check if the user is in the 'doctor' group
-        user = request.user
-        return request.user.is_superuser or hasattr(user, 'doctor') #request.user.groups.filter(name='Doctor').exists()
+        # Check if the user has a doctor profile
+        principal = get_principal(request)
+        return principal.is_superuser or principal.is_doctor
 
 
 
@@ -20,16 +20,17 @@ class IsRelevantPatientOrDoctor(BasePermission):
     """
 
     def has_object_permission(self, request, view, obj):
+        principal = get_principal(request)
         # Allow access if the user is a superuser
-        if request.user.is_superuser:
+        if principal.is_superuser:
             return True
-        
+
         # Allow access if the user is the patient
-        if obj.user == request.user:
+        if obj.user_id == principal.user_id:
             return True
 
         # Allow access if the user is the assigned doctor
-        if request.user.groups.filter(name='Doctor').exists() and obj.assigned_doctor.user == request.user:
+        if principal.in_group('Doctor') and principal.is_assigned_doctor_of(obj):
             return True
 
         # Deny access otherwise
@@ -40,11 +41,13 @@ class IsRelevantPatientOrDoctor(BasePermission):
 class IsDoctorInSameDepartment(BasePermission):
     def has_permission(self, request, view):
         # Check if the user is a doctor
-        return request.user.is_superuser or hasattr(request.user, 'doctor')
+        principal = get_principal(request)
+        return principal.is_superuser or principal.is_doctor
 
     def has_object_permission(self, request, view, obj):
         # Check if the doctor's department matches the record's department
-        return obj.department == request.user.doctor.department
+        principal = get_principal(request)
+        return principal.is_doctor and obj.department_id == principal.department_id
 
 
 
@@ -56,18 +59,20 @@ class IsRelevantPatientOrDoctorForRcords(BasePermission):
         return request.user and request.user.is_authenticated
 
     def has_object_permission(self, request, view, obj):
+        principal = get_principal(request)
         # Allow superusers to access any object
-        if request.user.is_superuser:
+        if principal.is_superuser:
             return True
-        
+
+        is_department_doctor = principal.is_doctor and principal.department_id == obj.department_id
+
         # For GET requests, check if the user is the patient or a relevant doctor
         if request.method == 'GET':
-            return (request.user == obj.patient.user or
-                    (request.user.is_authenticated and hasattr(request.user, 'doctor') and request.user.doctor.department == obj.department))
+            return (principal.is_patient and obj.patient_id == principal.patient_id) or is_department_doctor
 
         # For PATCH and DELETE requests, check if the user is a doctor in the same department
         if request.method in ['PATCH', 'DELETE']:
-            return (request.user.is_authenticated and hasattr(request.user, 'doctor') and request.user.doctor.department == obj.department)
+            return is_department_doctor
 
         return False
 
@@ -78,19 +83,19 @@ class IsRelevantPatientOrDoctorForRcords(BasePermission):
 
 class IsDoctorInDepartment(BasePermission):
     def has_permission(self, request, view):
+        principal = get_principal(request)
         # Allow superusers to access the endpoint
-        if request.user and request.user.is_superuser:
+        if principal.is_superuser:
             return True
-        
+
         department_id = view.kwargs.get('pk')
-        try:
-            doctor = Doctor.objects.get(user=request.user)
-        except Doctor.DoesNotExist:
+        if not principal.is_doctor:
             raise PermissionDenied("You are not authorized to access this department.")
 
         # Check if the doctor's department matches the department ID in the URL
-        if doctor.department_id != department_id:
-            raise PermissionDenied(f'You do not have permission to access doctors in this department because you are in {doctor.department.name} department your id is {doctor.department_id}.')
+        if principal.department_id != department_id:
+            raise PermissionDenied(f'You do not have permission to access doctors in this department because you are in {principal.department_name} department your id is {principal.department_id}.')
 
         return True
 
+
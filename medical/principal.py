@@ -0,0 +1,97 @@
+from dataclasses import dataclass, field
+
+from django.contrib.auth.models import User
+
+
+@dataclass(frozen=True)
+class Principal:
+    """
+    Everything the permissions, views and serializers need to know about the caller.
+    Resolved once per request (see get_principal) instead of calling
+    user.groups.filter(...).exists() / hasattr(user, 'doctor') over and over.
+    """
+    user_id: int = None
+    is_superuser: bool = False
+    doctor_id: int = None
+    patient_id: int = None
+    department_id: int = None  # the doctor's department, or the patient's one
+    department_name: str = None
+    groups: frozenset = field(default_factory=frozenset)
+
+    @property
+    def is_authenticated(self):
+        return self.user_id is not None
+
+    @property
+    def is_doctor(self):
+        return self.doctor_id is not None
+
+    @property
+    def is_patient(self):
+        return self.patient_id is not None
+
+    @property
+    def role(self):
+        if self.is_superuser:
+            return 'superuser'
+        if self.is_doctor:
+            return 'doctor'
+        if self.is_patient:
+            return 'patient'
+        return None
+
+    def in_group(self, name):
+        return name in self.groups
+
+    def is_assigned_doctor_of(self, patient):
+        return self.is_doctor and patient.assigned_doctor_id == self.doctor_id
+
+
+ANONYMOUS = Principal()
+
+
+def resolve_principal(user):
+    """
+    Builds the Principal for a user with a single query (LEFT JOINs to doctor, patient,
+    department and groups; there is one row per group).
+    """
+    if user is None or not user.is_authenticated:
+        return ANONYMOUS
+
+    rows = list(User.objects.filter(pk=user.pk).values_list(
+        'doctor__id', 'doctor__department_id', 'doctor__department__name',
+        'patient__id', 'patient__department_id', 'patient__department__name',
+        'groups__name',
+    ))
+    if not rows:
+        return ANONYMOUS
+
+    doctor_id, doctor_department_id, doctor_department_name, patient_id, patient_department_id, patient_department_name, _ = rows[0]
+    if doctor_id is not None:
+        department_id, department_name = doctor_department_id, doctor_department_name
+    else:
+        department_id, department_name = patient_department_id, patient_department_name
+
+    return Principal(
+        user_id=user.pk,
+        is_superuser=user.is_superuser,
+        doctor_id=doctor_id,
+        patient_id=patient_id,
+        department_id=department_id,
+        department_name=department_name,
+        groups=frozenset(row[-1] for row in rows if row[-1] is not None),
+    )
+
+
+def get_principal(request):
+    """
+    Returns the caller's Principal, resolving it on first use and caching it on the underlying
+    HttpRequest so DRF Request wrappers, permissions and serializers all share it.
+    """
+    http_request = getattr(request, '_request', request)
+    user = request.user
+    principal = getattr(http_request, '_principal', None)
+    if principal is None or principal.user_id != getattr(user, 'pk', None):
+        principal = resolve_principal(user)
+        http_request._principal = principal
+    return principal
@@ -0,0 +1,261 @@
+"""
+Read-only fast path for the list endpoints: rows from .values_list() instead of model instances
+and serializer fields.
+
+compile_projection() walks a serializer's readable fields once and maps every one of them to
+a database column (patient_name -> patient__user__username, the nested user -> user__username,
+user__first_name, ...), with the conversion the serializer field applies (DateTimeField ->
+ISO 8601, most others none). Rendering a row is then a dict comprehension over a tuple, and the
+JSON is byte for byte what the serializer produces: same keys, same order, same values, fields
+the serializer skips (a null assigned_doctor's name) skipped too.
+
+Serializers with fields that don't map to a column (method fields, many=True relations,
+computed sources) compile to None and the views keep using the serializer.
+
+?fields=id,user.username picks fields out of the projection, only their columns are selected.
+"""
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+from rest_framework.fields import empty
+from rest_framework.relations import PrimaryKeyRelatedField
+from rest_framework.settings import ISO_8601, api_settings
+
+# field classes whose to_representation() returns the database value unchanged
+PASSTHROUGH_FIELDS = (serializers.CharField, serializers.IntegerField, PrimaryKeyRelatedField)
+
+
+class Unsupported(Exception):
+    pass
+
+
+class Column:
+    __slots__ = ('key', 'column', 'field', 'skip_none')
+
+    def __init__(self, key, column, field, skip_none):
+        self.key = key
+        self.column = column
+        self.field = field
+        self.skip_none = skip_none  # None means a null relation on the way: the serializer omits the key
+
+
+class Nested:
+    __slots__ = ('key', 'children')
+
+    def __init__(self, key, children):
+        self.key = key
+        self.children = children
+
+
+def _model_field(model, path):
+    """The model field at the end of a forward-only relation path, and whether a relation on the way is nullable."""
+    nullable_relation = False
+    for position, name in enumerate(path):
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            raise Unsupported(name)
+        if not field.concrete:
+            raise Unsupported(name)  # reverse relations raise ObjectDoesNotExist instead of giving None
+        if position < len(path) - 1:
+            if not field.is_relation:
+                raise Unsupported(name)
+            nullable_relation = nullable_relation or field.null
+            model = field.related_model
+    return field, nullable_relation
+
+
+def _compile_fields(serializer, model, prefix):
+    nodes = []
+    for field in serializer._readable_fields:
+        if field.source == '*' or isinstance(field, (serializers.SerializerMethodField, serializers.HiddenField)):
+            raise Unsupported(field.field_name)
+        path = prefix + field.source_attrs
+
+        if isinstance(field, serializers.BaseSerializer):
+            if getattr(field, 'many', False) or not isinstance(field, serializers.ModelSerializer):
+                raise Unsupported(field.field_name)
+            relation, nullable_relation = _model_field(model, path)
+            if nullable_relation or relation.null:
+                raise Unsupported(field.field_name)  # None would have to become null instead of a dict
+            nodes.append(Nested(field.field_name, _compile_fields(field, model, path)))
+            continue
+
+        if isinstance(field, serializers.RelatedField) and not type(field) is PrimaryKeyRelatedField:
+            raise Unsupported(field.field_name)
+        model_field, nullable_relation = _model_field(model, path)
+        skip_none = False
+        if nullable_relation:
+            # DRF: the AttributeError on None is skipped by a read-only field, ambiguous if the column itself is nullable
+            if model_field.null or field.default is not empty or field.allow_null or field.required:
+                raise Unsupported(field.field_name)
+            skip_none = True
+        nodes.append(Column(field.field_name, '__'.join(path), field, skip_none))
+    return nodes
+
+
+class Projection:
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.columns = _columns(nodes)  # in rendering order: row[i] is the i-th Column's value
+        self._build = None
+
+    def only(self, fields):
+        """The projection restricted to ?fields= (comma separated, nested ones as user.username)."""
+        if not fields:
+            return self
+        wanted = [name.strip() for name in fields.split(',') if name.strip()]
+        nodes, unknown = _select(self.nodes, wanted)
+        if unknown:
+            raise ValidationError({'fields': f"Unknown field(s): {', '.join(unknown)}. Available: {', '.join(_names(self.nodes))}."})
+        return Projection(nodes)
+
+    def values(self, queryset, extra=()):
+        """
+        queryset.values_list() of the projection's columns, plus `extra` ones (e.g. the cursor
+        pagination's ordering) not rendered. Named rows, so pagination can read them as attributes.
+        """
+        columns = self.columns + [column for column in dict.fromkeys(extra) if column not in self.columns]
+        return queryset.prefetch_related(None).values_list(*columns, named=True)
+
+    def render(self, rows):
+        """Rows of values() -> the serializer's data. Extra columns, after the projection's, are ignored."""
+        # resolved per call, like the fields do: DateTimeField renders in the current time zone
+        converters = [_converter(column.field) for column in _leaves(self.nodes)]
+        if all(isinstance(node, Column) and not node.skip_none for node in self.nodes):
+            return _render_flat([node.key for node in self.nodes], converters, rows)
+        if self._build is None:
+            self._build = self._compile()
+        build = self._build
+        return [build(row, converters) for row in rows]
+
+    def _compile(self):
+        """The row -> dict function: data = {'id': row[0], 'user': {'username': row[1], ...}, ...}"""
+        return _builder(self.nodes, iter(range(len(self.columns))))
+
+
+def _render_flat(keys, converters, rows):
+    """
+    render() for a projection without nested dicts or omitted keys (the record list's): a row is
+    the keys zipped with its values, only the columns that need it converted. No per-field calls.
+    """
+    converted = [(index, convert) for index, convert in enumerate(converters) if convert is not None]
+    if not converted:
+        return [dict(zip(keys, row)) for row in rows]
+    data = []
+    for row in rows:
+        values = list(row)
+        for index, convert in converted:
+            if values[index] is not None:
+                values[index] = convert(values[index])
+        data.append(dict(zip(keys, values)))
+    return data
+
+
+def _builder(nodes, indexes):
+    """
+    build(row, convert) -> the dict of `nodes`, keys in their order. `indexes` hands out the row
+    positions of the leaves, depth first. The per-field getters are closures resolved here once,
+    a row costs one dict comprehension per (nested) dict.
+    """
+    getters = []
+    skipped = []  # (key, index): omitted when row[index] is None
+    for node in nodes:
+        if isinstance(node, Nested):
+            getters.append((node.key, _builder(node.children, indexes)))
+            continue
+        index = next(indexes)
+        if node.skip_none:
+            skipped.append((node.key, index))
+        if _converter(node.field) is None:
+            getters.append((node.key, lambda row, convert, index=index: row[index]))
+        else:
+            getters.append((node.key, lambda row, convert, index=index: None if row[index] is None else convert[index](row[index])))
+
+    def build(row, convert):
+        data = {key: get(row, convert) for key, get in getters}
+        for key, index in skipped:
+            if row[index] is None:
+                del data[key]
+        return data
+    return build
+
+
+def _converter(field):
+    """What render() applies to the non-null values of a serializer field, None for nothing."""
+    if type(field) in PASSTHROUGH_FIELDS:
+        return None
+    if type(field) is serializers.DateTimeField and (getattr(field, 'format', api_settings.DATETIME_FORMAT) or '').lower() == ISO_8601:
+        # DateTimeField.to_representation() minus its per-value checks, for the aware values the ORM returns
+        field_timezone = field.timezone if hasattr(field, 'timezone') else field.default_timezone()
+        if field_timezone is not None:
+            def iso_8601(value):
+                if value.tzinfo is None:
+                    return field.to_representation(value)
+                value = value.astimezone(field_timezone).isoformat()
+                return value[:-6] + 'Z' if value.endswith('+00:00') else value
+            return iso_8601
+    return field.to_representation
+
+
+def _leaves(nodes):
+    leaves = []
+    for node in nodes:
+        leaves += _leaves(node.children) if isinstance(node, Nested) else [node]
+    return leaves
+
+
+def _columns(nodes):
+    return [column.column for column in _leaves(nodes)]
+
+
+def _names(nodes, prefix=''):
+    names = []
+    for node in nodes:
+        names.append(prefix + node.key)
+        if isinstance(node, Nested):
+            names += _names(node.children, f'{prefix}{node.key}.')
+    return names
+
+
+def _select(nodes, wanted):
+    """Keeps the nodes named in `wanted` (their order, not the request's), returns (nodes, unknown names)."""
+    by_key = {node.key: node for node in nodes}
+    nested_wanted = {}
+    top = set()
+    unknown = []
+    for name in wanted:
+        head, _, rest = name.partition('.')
+        node = by_key.get(head)
+        if node is None or (rest and not isinstance(node, Nested)):
+            unknown.append(name)
+        elif rest:
+            nested_wanted.setdefault(head, []).append(rest)
+        else:
+            top.add(head)
+    selected = []
+    for node in nodes:
+        if node.key in top:
+            selected.append(node)
+        elif node.key in nested_wanted:
+            children, missing = _select(node.children, nested_wanted[node.key])
+            unknown += [f'{node.key}.{name}' for name in missing]
+            selected.append(Nested(node.key, children))
+    return selected, unknown
+
+
+_projections = {}
+
+
+def compile_projection(serializer_class):
+    """The serializer's projection (compiled once per class), or None if it can't have one."""
+    if serializer_class not in _projections:
+        try:
+            serializer = serializer_class(context={})
+            projection = Projection(_compile_fields(serializer, serializer.Meta.model, []))
+            if len(set(projection.columns)) != len(projection.columns):
+                raise Unsupported('two fields read the same column')
+            _projections[serializer_class] = projection
+        except (Unsupported, AttributeError):
+            _projections[serializer_class] = None
+    return _projections[serializer_class]
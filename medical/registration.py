@@ -0,0 +1,131 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group, User
+from django.db import IntegrityError, connections, transaction
+
+from .models import Department, Doctor, Patient
+from .serializers import RegisterBulkItemSerializer
+
+Membership = User.groups.through
+
+
+def hash_passwords(passwords, workers):
+    """
+    make_password() for every password, spread over `workers` processes. Small batches are
+    hashed inline, starting the pool would cost more than it saves.
+
+    The pool closes every database connection of the process and forks it: only for
+    single-threaded callers outside a transaction (the register_users command), never a request
+    or a job worker.
+    """
+    if workers <= 1 or len(passwords) < 2 * workers:
+        return [make_password(password) for password in passwords]
+    connections.close_all()  # don't hand open connections to forked processes
+    with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as pool:
+        return list(pool.map(make_password, passwords, chunksize=max(1, len(passwords) // (workers * 4))))
+
+
+def _error(index, message):
+    return {'index': index, 'status': 'error', 'errors': {'non_field_errors': [message]}}
+
+
+def register_users(items, workers=1, batch_size=None):
+    """
+    Registers many doctors and patients at once, with the rules of RegisterSerializer
+    (doctors get the dr_ prefix, a patient's doctor must work in the patient's department).
+
+    Rows are validated on their own first, then usernames, departments and doctors are checked
+    with one query each, the passwords are hashed (on `workers` processes, see hash_passwords())
+    and the users, their doctor/patient profiles and group memberships are inserted with
+    bulk_create, one transaction per batch_size rows. Returns one result per item, in input order:
+    {'index', 'status': 'created', 'user_id', 'username', 'doctor_id' or 'patient_id'} or
+    {'index', 'status': 'error', 'errors'}. A bad row never stops the others.
+    """
+    batch_size = batch_size or settings.BULK_REGISTER_BATCH_SIZE
+    results = [None] * len(items)
+
+    pending = []  # (index, validated_data, username)
+    seen = set()
+    for index, item in enumerate(items):
+        serializer = RegisterBulkItemSerializer(data=item)
+        if not serializer.is_valid():
+            results[index] = {'index': index, 'status': 'error', 'errors': serializer.errors}
+            continue
+        data = serializer.validated_data
+        username = f"dr_{data['username']}" if data['user_type'] == 'doctor' else data['username']
+        if username in seen:
+            results[index] = _error(index, 'This username appears more than once in the upload.')
+            continue
+        seen.add(username)
+        pending.append((index, data, username))
+
+    taken = set(User.objects.filter(username__in=[username for _, _, username in pending]).values_list('username', flat=True))
+    department_ids = set(Department.objects.filter(id__in={data['department'] for _, data, _ in pending}).values_list('id', flat=True))
+    doctor_departments = dict(Doctor.objects.filter(
+        id__in={data['assigned_doctor'] for _, data, _ in pending if data.get('assigned_doctor')}
+    ).values_list('id', 'department_id'))
+
+    valid = []
+    for index, data, username in pending:
+        if username in taken:
+            message = ("This username is already taken for a doctor. Please choose another." if data['user_type'] == 'doctor'
+                       else "This username is already taken. Please choose another.")
+            results[index] = _error(index, message)
+        elif data['department'] not in department_ids:
+            results[index] = _error(index, 'The specified department does not exist.')
+        elif data['user_type'] == 'patient' and data.get('assigned_doctor') and data['assigned_doctor'] not in doctor_departments:
+            results[index] = _error(index, 'The specified assigned doctor does not exist.')
+        elif data['user_type'] == 'patient' and data.get('assigned_doctor') and doctor_departments[data['assigned_doctor']] != data['department']:
+            results[index] = _error(index, 'The assigned doctor does not belong to the same department as the patient.')
+        else:
+            valid.append((index, data, username))
+
+    passwords = hash_passwords([data['password'] for _, data, _ in valid], workers)
+    groups = {
+        'doctor': Group.objects.get_or_create(name='Doctor')[0],
+        'patient': Group.objects.get_or_create(name='Patient')[0],
+    }
+    rows = [(index, data, username, password) for (index, data, username), password in zip(valid, passwords)]
+    for start in range(0, len(rows), batch_size):
+        chunk = rows[start:start + batch_size]
+        try:
+            with transaction.atomic():
+                _insert(chunk, groups, results)
+        except IntegrityError:
+            # somebody registered one of these usernames meanwhile: retry one by one so only that row fails
+            for row in chunk:
+                try:
+                    with transaction.atomic():
+                        _insert([row], groups, results)
+                except IntegrityError:
+                    results[row[0]] = _error(row[0], 'This username is already taken. Please choose another.')
+    return results
+
+
+def _insert(rows, groups, results):
+    users = User.objects.bulk_create([
+        User(username=username, password=password, first_name=data['first_name'], last_name=data['last_name'])
+        for _, data, username, password in rows
+    ])
+    doctors, patients = [], []
+    for (index, data, username, _), user in zip(rows, users):
+        if data['user_type'] == 'doctor':
+            doctors.append((index, Doctor(user=user, department_id=data['department'])))
+        else:
+            # 0 means no doctor, as in RegisterSerializer
+            patients.append((index, Patient(user=user, department_id=data['department'], assigned_doctor_id=data.get('assigned_doctor') or None)))
+    Doctor.objects.bulk_create([doctor for _, doctor in doctors])
+    Patient.objects.bulk_create([patient for _, patient in patients])
+    Membership.objects.bulk_create([
+        Membership(user_id=user.id, group_id=groups[data['user_type']].id)
+        for (_, data, _, _), user in zip(rows, users)
+    ])
+
+    users_by_index = {row[0]: user for row, user in zip(rows, users)}
+    for role, profiles in (('doctor', doctors), ('patient', patients)):
+        for index, profile in profiles:
+            user = users_by_index[index]
+            results[index] = {'index': index, 'status': 'created', 'user_id': user.id, 'username': user.username, f'{role}_id': profile.id}
@@ -0,0 +1,47 @@
+"""
+Response renderers picked by the Accept header (or ?format=json / ?format=msgpack).
+
+ORJSONRenderer writes the same bytes as DRF's JSONRenderer, several times faster. Whatever
+orjson can't encode the same way (pretty printing with ; indent=, ints beyond 64 bits,
+non-string keys) goes to JSONRenderer. The one difference left: NaN and infinities, which
+JSONRenderer refuses with a ValueError, are written as null. MessagePackRenderer serves
+application/msgpack, with dates, decimals etc. encoded like in JSON.
+"""
+import msgpack
+import orjson
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+_json_encoder = JSONEncoder()
+
+
+def encode_default(obj):
+    """Types the encoders don't know natively, converted like DRF's JSONEncoder does (datetimes too)."""
+    return _json_encoder.default(obj)
+
+
+class ORJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if not (self.compact and self.strict and not self.ensure_ascii) or self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            # OPT_PASSTHROUGH_DATETIME: datetimes as DRF writes them (...Z), not orjson's +00:00
+            ret = orjson.dumps(data, default=encode_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        except TypeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # escaped like JSONRenderer does, keeps the output a strict javascript subset
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=encode_default)
@@ -0,0 +1,220 @@
+"""
+Read replicas (DATABASE_REPLICA_URLS, see hospital/settings.py).
+
+ReplicaMiddleware decides per request where its reads go, ReplicaRouter applies it:
+
+- GET / HEAD requests read from a replica, the same one for the whole request, round robin
+  among the replicas at most REPLICA_MAX_LAG_SECONDS behind. Other methods, management
+  commands and anything outside a request use the primary (default).
+- A request that writes reads from the primary from then on, and pins its client to the
+  primary for REPLICA_PIN_SECONDS: a doctor who just created a record gets it in the history
+  even if the replicas haven't replayed it yet. A replica still read from may be up to
+  REPLICA_MAX_LAG_SECONDS behind as of a measurement up to REPLICA_LAG_CHECK_SECONDS old, the
+  pin has to last their sum (manage.py check says so). The client is its Authorization header
+  (or session cookie). Pins live in REPLICA_PIN_CACHE_ALIAS, a cache every worker sees: the
+  check refuses local memory.
+- Tokens, sessions and users are always read from the primary: the token a login just created
+  isn't on the replicas yet, nor is the user a registration just created, and the login
+  request carries no credentials to pin. The caller's principal (medical/principal.py) is a
+  User query. So are the reads that fill the shared caches (detail cache misses, the
+  department catalogue): an entry built from a lagging replica would outlive the lag.
+
+Lag is measured against the change log (medical/changes.py): how long ago the primary logged
+the oldest record change a replica doesn't have yet, 0 if it has them all (as far as its latest
+seq tells: seqs of different patients can commit out of order). Each worker measures it at
+most every REPLICA_LAG_CHECK_SECONDS, on a request; a replica that is too far behind or
+unreachable gets no reads until a later measurement finds it caught up. /metrics reports the
+lags and the routing decisions.
+
+Locally two SQLite files and a file cache do: DATABASE_REPLICA_URLS=sqlite:////tmp/replica.sqlite3
+SHARED_CACHE_URL=file:///tmp/hospital-cache, and manage.py sync_replicas [--interval 10] copies
+the primary over the replica.
+"""
+import contextvars
+import hashlib
+import itertools
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DatabaseError
+from django.db.models import Max
+from django.utils import timezone
+
+from .metrics import register_collector
+from .models import RecordChange
+
+PRIMARY = 'default'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+PRIMARY_ONLY = {'authtoken.token', 'sessions.session', 'auth.user'}
+
+
+class Routing:
+    """Where the current request reads from, and why (the decision /metrics counts)."""
+    __slots__ = ('alias', 'reason', 'wrote')
+
+    def __init__(self, alias, reason):
+        self.alias = alias
+        self.reason = reason
+        self.wrote = False
+
+
+_routing = contextvars.ContextVar('medical_replica_routing', default=None)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        routing = _routing.get()
+        if routing is None or model._meta.label_lower in PRIMARY_ONLY:
+            return PRIMARY
+        return routing.alias
+
+    def db_for_write(self, model, **hints):
+        routing = _routing.get()
+        if routing:
+            # the rest of the request reads its own writes
+            routing.alias = PRIMARY
+            routing.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # the replicas hold the same rows
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get the schema through replication
+        return db not in settings.DATABASE_REPLICAS
+
+
+def replica_lag(alias):
+    """Seconds since the primary logged the oldest record change `alias` doesn't have, 0.0 if none."""
+    replicated = RecordChange.objects.using(alias).aggregate(seq=Max('seq'))['seq'] or 0
+    missing = RecordChange.objects.using(PRIMARY).filter(seq__gt=replicated).order_by('seq').values_list('changed_at', flat=True).first()
+    if missing is None:
+        return 0.0
+    return max((timezone.now() - missing).total_seconds(), 0.0)
+
+
+class ReplicaMonitor:
+    """Per worker: the replicas' measured lags, the round robin and the routing decision counts."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lags = {}  # alias -> seconds, None if unreachable
+        self._measured = 0.0
+        self._cycle = itertools.count()
+        self._decisions = {}
+
+    def measure_due(self):
+        return bool(settings.DATABASE_REPLICAS) and time.monotonic() - self._measured >= settings.REPLICA_LAG_CHECK_SECONDS
+
+    def measure(self):
+        self._measured = time.monotonic()
+        for alias in settings.DATABASE_REPLICAS:
+            try:
+                lag = replica_lag(alias)
+            except DatabaseError:
+                lag = None
+            with self._lock:
+                self._lags[alias] = lag
+
+    def healthy(self, alias):
+        if alias not in self._lags:
+            return True  # not measured yet
+        lag = self._lags[alias]
+        return lag is not None and lag <= settings.REPLICA_MAX_LAG_SECONDS
+
+    def route(self, method, pinned):
+        if method not in SAFE_METHODS:
+            return Routing(PRIMARY, 'write_method')
+        if pinned:
+            return Routing(PRIMARY, 'pinned')
+        replicas = [alias for alias in settings.DATABASE_REPLICAS if self.healthy(alias)]
+        if not replicas:
+            return Routing(PRIMARY, 'replicas_behind')
+        alias = replicas[next(self._cycle) % len(replicas)]
+        return Routing(alias, alias)
+
+    def observe(self, routing, pinned_now):
+        with self._lock:
+            name = f'read_{routing.reason}'
+            self._decisions[name] = self._decisions.get(name, 0) + 1
+            if routing.wrote and routing.reason not in ('write_method', 'pinned'):
+                # a safe request that wrote: its later reads went to the primary
+                self._decisions['read_switched_to_primary'] = self._decisions.get('read_switched_to_primary', 0) + 1
+            if pinned_now:
+                self._decisions['pins'] = self._decisions.get('pins', 0) + 1
+
+    def stats(self):
+        """Requests per routing decision, pins set, and each replica's last measured lag (-1 unreachable)."""
+        with self._lock:
+            stats = dict(self._decisions)
+            for alias, lag in self._lags.items():
+                stats[f'{alias}_lag_seconds'] = -1 if lag is None else round(lag, 3)
+        return stats
+
+
+monitor = ReplicaMonitor()
+register_collector('replicas', monitor.stats)
+
+
+def _pin_key(request):
+    """The client's pin key, None for a client without credentials."""
+    credentials = request.META.get('HTTP_AUTHORIZATION') or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if not credentials:
+        return None
+    return 'medical:replica:pin:' + hashlib.sha256(credentials.encode()).hexdigest()[:32]
+
+
+class ReplicaMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    @property
+    def pins(self):
+        return caches[settings.REPLICA_PIN_CACHE_ALIAS]
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not settings.DATABASE_REPLICAS:
+            return self.get_response(request)
+        if monitor.measure_due():
+            monitor.measure()
+        key = _pin_key(request)
+        routing = monitor.route(request.method, bool(key and self.pins.get(key)))
+        token = _routing.set(routing)
+        try:
+            response = self.get_response(request)
+        finally:
+            _routing.reset(token)
+        pin = routing.wrote and key is not None
+        if pin:
+            self.pins.set(key, True, settings.REPLICA_PIN_SECONDS)
+        monitor.observe(routing, pin)
+        return response
+
+    async def __acall__(self, request):
+        if not settings.DATABASE_REPLICAS:
+            return await self.get_response(request)
+        if monitor.measure_due():
+            await sync_to_async(monitor.measure)()
+        key = _pin_key(request)
+        routing = monitor.route(request.method, bool(key and await self.pins.aget(key)))
+        # the async ORM's threads run in a copy of this context, and share the Routing object
+        token = _routing.set(routing)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _routing.reset(token)
+        pin = routing.wrote and key is not None
+        if pin:
+            await self.pins.aset(key, True, settings.REPLICA_PIN_SECONDS)
+        monitor.observe(routing, pin)
+        return response
@@ -0,0 +1,292 @@
+"""
+Monthly rollups of PatientRecord per department: record volume, diagnoses and treatments.
+
+RecordRollup holds one row per (department, kind, month, value) with the number of records in
+that bucket. value is the diagnosis or treatment text, trimmed, lower-cased and cut to 200
+characters, so "Hypertension " and "hypertension" count together. Months are UTC.
+
+Like the counters (medical/counters.py), the rollups are maintained by database triggers
+(installed by migration 0007_recordrollup) in the same transaction as every insert, update
+and delete of a record, bulk_create and cascades included. PostgreSQL uses statement triggers,
+so a bulk insert is one grouped upsert. Buckets that drop to zero stay as zero rows until
+the next backfill. Archived records (medical/archive.py) keep counting: the archive table has
+the same triggers, so moving a record there subtracts it from the hot side and adds it back.
+
+backfill_rollups() rebuilds everything from PatientRecord with set-based INSERT ... SELECT ...
+GROUP BY statements over record_id ranges. Records written while it runs can be counted
+slightly off, so run it when writes are quiet (manage.py backfill_rollups).
+
+The analytics endpoint reads only RecordRollup: a year is at most 12 total rows plus the top
+buckets per month, found through the unique index.
+"""
+import datetime
+
+from django.conf import settings
+from django.db import connection as default_connection, transaction
+from django.db.models import F, Sum, Window
+from django.db.models.functions import RowNumber
+
+from .models import ArchivedPatientRecord, PatientRecord, RecordRollup
+
+ROLLUP_TABLE = RecordRollup._meta.db_table
+RECORD_TABLE = PatientRecord._meta.db_table
+# trigger name prefix -> the table it watches
+SOURCES = {
+    ROLLUP_TABLE: RECORD_TABLE,
+    f'{ROLLUP_TABLE}_archived': ArchivedPatientRecord._meta.db_table,
+}
+CONFLICT = '(department_id, kind, month, value)'
+
+MONTH_SQL = {
+    'sqlite': "strftime('%Y-%m-01', {p}created_date)",
+    'postgresql': "date_trunc('month', {p}created_date AT TIME ZONE 'UTC')::date",
+}
+VALUE_SQL = {
+    'sqlite': "substr(lower(trim({p}{column})), 1, 200)",
+    'postgresql': "left(lower(btrim({p}{column})), 200)",
+}
+
+
+def _buckets(vendor, source, where='TRUE', p=''):
+    """SELECT department_id, kind, month, value, record_count grouped over the rows of `source`."""
+    month = MONTH_SQL[vendor].format(p=p)
+    selects = [
+        f"SELECT {p}department_id AS department_id, 'total' AS kind, {month} AS month, '' AS value, count(*) AS record_count "
+        f"FROM {source} WHERE {p}department_id IS NOT NULL AND {where} GROUP BY 1, 3"
+    ]
+    for kind, column in (('diagnosis', 'diagnostics'), ('treatment', 'treatments')):
+        value = VALUE_SQL[vendor].format(p=p, column=column)
+        selects.append(
+            f"SELECT {p}department_id, '{kind}', {month}, {value}, count(*) "
+            f"FROM {source} WHERE {p}department_id IS NOT NULL AND {where} GROUP BY 1, 3, 4"
+        )
+    return ' UNION ALL '.join(selects)
+
+
+def _add_sql(vendor, source, where='TRUE', p=''):
+    return (
+        f'INSERT INTO {ROLLUP_TABLE} (department_id, kind, month, value, record_count) '
+        f'SELECT * FROM ({_buckets(vendor, source, where, p)}) buckets WHERE TRUE '
+        f'ON CONFLICT {CONFLICT} DO UPDATE SET record_count = {ROLLUP_TABLE}.record_count + excluded.record_count'
+    )
+
+
+def _subtract_sql(vendor, source, where='TRUE', p=''):
+    return (
+        f'UPDATE {ROLLUP_TABLE} SET record_count = {ROLLUP_TABLE}.record_count - buckets.record_count '
+        f'FROM ({_buckets(vendor, source, where, p)}) buckets '
+        f'WHERE {ROLLUP_TABLE}.department_id = buckets.department_id AND {ROLLUP_TABLE}.kind = buckets.kind '
+        f'AND {ROLLUP_TABLE}.month = buckets.month AND {ROLLUP_TABLE}.value = buckets.value'
+    )
+
+
+def _sqlite_row(row):
+    """The three buckets of one trigger row (new / old) as a VALUES list."""
+    month = MONTH_SQL['sqlite'].format(p=f'{row}.')
+    diagnosis = VALUE_SQL['sqlite'].format(p=f'{row}.', column='diagnostics')
+    treatment = VALUE_SQL['sqlite'].format(p=f'{row}.', column='treatments')
+    return [('total', month, "''"), ('diagnosis', month, diagnosis), ('treatment', month, treatment)]
+
+
+def _sqlite_add(row):
+    values = ', '.join(f"({row}.department_id, '{kind}', {month}, {value}, 1)" for kind, month, value in _sqlite_row(row))
+    return (
+        f'INSERT INTO {ROLLUP_TABLE} (department_id, kind, month, value, record_count) VALUES {values} '
+        f'ON CONFLICT {CONFLICT} DO UPDATE SET record_count = record_count + 1;'
+    )
+
+
+def _sqlite_subtract(row):
+    return '\n'.join(
+        f"UPDATE {ROLLUP_TABLE} SET record_count = record_count - 1 "
+        f"WHERE department_id = {row}.department_id AND kind = '{kind}' AND month = {month} AND value = {value};"
+        for kind, month, value in _sqlite_row(row)
+    )
+
+
+_CHANGED = ('old.department_id IS NOT new.department_id OR old.created_date IS NOT new.created_date '
+            'OR old.diagnostics IS NOT new.diagnostics OR old.treatments IS NOT new.treatments')
+_UPDATE_OF = 'department_id, created_date, diagnostics, treatments'
+
+
+def _sqlite_triggers_sql(name, table):
+    return [
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {name}_ai AFTER INSERT ON {table}
+        WHEN new.department_id IS NOT NULL BEGIN
+            {_sqlite_add('new')}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {name}_ad AFTER DELETE ON {table}
+        WHEN old.department_id IS NOT NULL BEGIN
+            {_sqlite_subtract('old')}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {name}_au_old AFTER UPDATE OF {_UPDATE_OF} ON {table}
+        WHEN old.department_id IS NOT NULL AND ({_CHANGED}) BEGIN
+            {_sqlite_subtract('old')}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {name}_au_new AFTER UPDATE OF {_UPDATE_OF} ON {table}
+        WHEN new.department_id IS NOT NULL AND ({_CHANGED}) BEGIN
+            {_sqlite_add('new')}
+        END
+        """,
+    ]
+
+
+_PG_CHANGED_OLD = (
+    '(SELECT o.* FROM old_rows o JOIN new_rows n ON n.record_id = o.record_id '
+    'WHERE (o.department_id, o.created_date, o.diagnostics, o.treatments) '
+    'IS DISTINCT FROM (n.department_id, n.created_date, n.diagnostics, n.treatments)) changed'
+)
+_PG_CHANGED_NEW = _PG_CHANGED_OLD.replace('SELECT o.*', 'SELECT n.*')
+
+POSTGRESQL_FUNCTION_SQL = f"""
+CREATE OR REPLACE FUNCTION {ROLLUP_TABLE}_apply() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        {_add_sql('postgresql', 'new_rows')};
+    ELSIF TG_OP = 'DELETE' THEN
+        {_subtract_sql('postgresql', 'old_rows')};
+    ELSE
+        {_subtract_sql('postgresql', _PG_CHANGED_OLD)};
+        {_add_sql('postgresql', _PG_CHANGED_NEW)};
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+
+def _postgresql_triggers_sql(name, table):
+    # one function for both tables, it only reads the transition tables
+    return [
+        f'DROP TRIGGER IF EXISTS {name}_ins ON {table}',
+        f'CREATE TRIGGER {name}_ins AFTER INSERT ON {table} REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {ROLLUP_TABLE}_apply()',
+        f'DROP TRIGGER IF EXISTS {name}_del ON {table}',
+        f'CREATE TRIGGER {name}_del AFTER DELETE ON {table} REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION {ROLLUP_TABLE}_apply()',
+        f'DROP TRIGGER IF EXISTS {name}_upd ON {table}',
+        f'CREATE TRIGGER {name}_upd AFTER UPDATE ON {table} REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {ROLLUP_TABLE}_apply()',
+    ]
+
+
+def _existing_sources(connection):
+    existing = connection.introspection.table_names()
+    return [(name, table) for name, table in SOURCES.items() if table in existing]
+
+
+def install_rollup_triggers(connection):
+    """Creates (or recreates) the rollup triggers of the record tables that exist so far. Idempotent."""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(POSTGRESQL_FUNCTION_SQL)
+        for name, table in _existing_sources(connection):
+            if connection.vendor == 'sqlite':
+                statements = _sqlite_triggers_sql(name, table)
+            elif connection.vendor == 'postgresql':
+                statements = _postgresql_triggers_sql(name, table)
+            else:
+                statements = []
+            for statement in statements:
+                cursor.execute(statement)
+
+
+def restore_rollup_triggers(connection):
+    """SQLite drops them when Django rebuilds medical_patientrecord, called after every migrate."""
+    if connection.vendor == 'sqlite' and ROLLUP_TABLE in connection.introspection.table_names():
+        install_rollup_triggers(connection)
+
+
+def uninstall_rollup_triggers(connection):
+    with connection.cursor() as cursor:
+        for name, table in _existing_sources(connection):
+            if connection.vendor == 'sqlite':
+                for suffix in ('ai', 'ad', 'au_old', 'au_new'):
+                    cursor.execute(f'DROP TRIGGER IF EXISTS {name}_{suffix}')
+            elif connection.vendor == 'postgresql':
+                for suffix in ('ins', 'del', 'upd'):
+                    cursor.execute(f'DROP TRIGGER IF EXISTS {name}_{suffix} ON {table}')
+        if connection.vendor == 'postgresql':
+            cursor.execute(f'DROP FUNCTION IF EXISTS {ROLLUP_TABLE}_apply()')
+
+
+def backfill_rollups(batch_size=None, connection=None, progress=None):
+    """
+    Rebuilds RecordRollup from scratch: deletes every bucket, then adds the records (hot and
+    archived) batch by batch of record_id, each batch one grouped INSERT ... SELECT in its own
+    transaction. Returns the number of records processed.
+    """
+    batch_size = batch_size or settings.ROLLUP_BACKFILL_BATCH_SIZE
+    connection = connection or default_connection
+    if connection.vendor not in MONTH_SQL:
+        raise NotImplementedError(f'Rollups are not supported on {connection.vendor}.')
+    processed = 0
+    with connection.cursor() as cursor:
+        with transaction.atomic(using=connection.alias):
+            cursor.execute(f'DELETE FROM {ROLLUP_TABLE}')
+        for _, table in _existing_sources(connection):
+            cursor.execute(f'SELECT min(record_id), max(record_id), count(*) FROM {table}')
+            first, last, total = cursor.fetchone()
+            if first is None:
+                continue
+            for start in range(first, last + 1, batch_size):
+                end = min(start + batch_size - 1, last)
+                # ints only, inlined: SQLite's strftime pattern rules out %s parameters
+                with transaction.atomic(using=connection.alias):
+                    cursor.execute(_add_sql(connection.vendor, table, f'record_id BETWEEN {int(start)} AND {int(end)}'))
+                if progress:
+                    progress(end, last)
+            processed += total
+    return processed
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def add_months(day, months):
+    index = day.year * 12 + day.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def department_analytics(department_id, start, end, top=10):
+    """
+    Record volume per month, the `top` diagnoses of each month and the treatment mix over
+    [start, end] (first days of months, inclusive), from the rollups only.
+    """
+    buckets = RecordRollup.objects.filter(department_id=department_id, month__range=(start, end), record_count__gt=0)
+
+    totals = dict(buckets.filter(kind='total').values_list('month', 'record_count'))
+    volume = []
+    month = start
+    while month <= end:
+        volume.append({'month': f'{month:%Y-%m}', 'records': totals.get(month, 0)})
+        month = add_months(month, 1)
+
+    ranked = buckets.filter(kind='diagnosis').exclude(value='').annotate(
+        rank=Window(RowNumber(), partition_by=[F('month')], order_by=[F('record_count').desc(), F('value').asc()]),
+    ).filter(rank__lte=top).order_by('month', 'rank').values_list('month', 'value', 'record_count')
+    diagnoses = {}
+    for month, value, count in ranked:
+        diagnoses.setdefault(month, []).append({'diagnosis': value, 'records': count})
+
+    total_records = sum(totals.values())
+    treatments = (
+        buckets.filter(kind='treatment').exclude(value='').values('value')
+        .annotate(records=Sum('record_count')).order_by('-records', 'value')[:top]
+    )
+    return {
+        'department': department_id,
+        'from': f'{start:%Y-%m}',
+        'to': f'{end:%Y-%m}',
+        'volume': volume,
+        'top_diagnoses': [{'month': f'{month:%Y-%m}', 'diagnoses': diagnoses[month]} for month in sorted(diagnoses)],
+        'treatment_mix': [
+            {'treatment': row['value'], 'records': row['records'], 'share': round(row['records'] / total_records, 4) if total_records else 0.0}
+            for row in treatments
+        ],
+    }
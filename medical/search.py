@@ -0,0 +1,114 @@
+"""
+Full-text search over PatientRecord.diagnostics / observations / treatments.
+
+The index lives in the database and is maintained by the database itself (installed by
+migration 0005_patientrecord_search_index), so it stays in sync on every insert, update and delete,
+including bulk_create, queryset.update() and cascades that never send model signals:
+
+* SQLite: an external content FTS5 table (medical_patientrecord_fts) kept in sync by triggers,
+  ranked with bm25().
+* PostgreSQL: a generated, weighted tsvector column (search_vector) with a GIN index,
+  ranked with ts_rank().
+
+Other databases fall back to an unranked icontains scan.
+"""
+import re
+from importlib import import_module
+
+from django.db import connection
+from django.db.models import Q
+
+from .models import PatientRecord
+
+# the triggers as migration 0005 created them
+search_index = import_module('medical.migrations.0005_patientrecord_search_index')
+
+FTS_TABLE = 'medical_patientrecord_fts'
+SEARCH_FIELDS = ('diagnostics', 'observations', 'treatments')
+
+# weights: a hit in the diagnostics counts more than one in the treatments or observations
+SQLITE_BM25_WEIGHTS = (10.0, 2.0, 5.0)  # same order as SEARCH_FIELDS
+
+_TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def search_terms(query):
+    """The words of a user query. Everything else (operators, quotes, ...) is dropped."""
+    return _TERM_RE.findall(query)
+
+
+def restore_search_triggers(connection):
+    """
+    SQLite drops triggers when Django rebuilds a table during a migration (most AlterField /
+    AddField on medical_patientrecord). The FTS content stays valid, only the triggers need to
+    come back. Called after every migrate, does nothing if the index isn't installed.
+    """
+    if connection.vendor != 'sqlite' or FTS_TABLE not in connection.introspection.table_names():
+        return
+    with connection.cursor() as cursor:
+        for statement in search_index.SQLITE_TRIGGERS_SQL:
+            cursor.execute(statement)
+
+
+def _sqlite_search(terms, department_id, limit, offset):
+    # every term quoted -> implicit AND of plain words, no FTS5 syntax can leak in
+    match = ' '.join('"%s"' % term for term in terms)
+    sql = (
+        f'SELECT {FTS_TABLE}.rowid, bm25({FTS_TABLE}, %s, %s, %s) AS rank '
+        f'FROM {FTS_TABLE} '
+        f'JOIN {PatientRecord._meta.db_table} r ON r.record_id = {FTS_TABLE}.rowid '
+        f'WHERE {FTS_TABLE} MATCH %s'
+    )
+    params = [*SQLITE_BM25_WEIGHTS, match]
+    if department_id is not None:
+        sql += ' AND r.department_id = %s'
+        params.append(department_id)
+    sql += ' ORDER BY rank LIMIT %s OFFSET %s'
+    params += [limit, offset]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        # bm25 is "smaller is better", flip it so a higher rank is a better match everywhere
+        return [(record_id, -rank) for record_id, rank in cursor.fetchall()]
+
+
+def _postgresql_search(terms, department_id, limit, offset):
+    sql = (
+        f'SELECT record_id, ts_rank(search_vector, query) AS rank '
+        f"FROM {PatientRecord._meta.db_table}, plainto_tsquery('english', %s) query "
+        f'WHERE search_vector @@ query'
+    )
+    params = [' '.join(terms)]
+    if department_id is not None:
+        sql += ' AND department_id = %s'
+        params.append(department_id)
+    sql += ' ORDER BY rank DESC, record_id DESC LIMIT %s OFFSET %s'
+    params += [limit, offset]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def _fallback_search(terms, department_id, limit, offset):
+    queryset = PatientRecord.objects.all()
+    if department_id is not None:
+        queryset = queryset.filter(department_id=department_id)
+    for term in terms:
+        queryset = queryset.filter(
+            Q(diagnostics__icontains=term) | Q(observations__icontains=term) | Q(treatments__icontains=term)
+        )
+    record_ids = queryset.order_by('-record_id').values_list('record_id', flat=True)[offset:offset + limit]
+    return [(record_id, 0.0) for record_id in record_ids]
+
+
+def search_records(query, department_id=None, limit=20, offset=0):
+    """
+    Returns [(record_id, rank), ...] best match first. department_id=None searches every department.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return []
+    backend = {
+        'sqlite': _sqlite_search,
+        'postgresql': _postgresql_search,
+    }.get(connection.vendor, _fallback_search)
+    return backend(terms, department_id, limit, offset)
@@ -1,12 +1,29 @@
 
 from django.core.exceptions import ValidationError
+from django.db.models import Prefetch
 from rest_framework import serializers
-from .models import Doctor, Patient, PatientRecord, Department
+from .models import Doctor, Job, Patient, PatientRecord, Department
 from django.contrib.auth.models import User, Group 
-from django.contrib.auth import authenticate
-from rest_framework.authtoken.models import Token
+from .principal import get_principal
+from .login import login
 
 
+class EagerLoadingMixin:
+    """
+    Lets a serializer declare the relations it reads so views can load them up front.
+    Without this every nested/dotted source (user, assigned_doctor.user, ...) costs a query per row.
+    """
+    select_related_fields = ()
+    prefetch_related_fields = ()
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        if cls.select_related_fields:
+            queryset = queryset.select_related(*cls.select_related_fields)
+        if cls.prefetch_related_fields:
+            queryset = queryset.prefetch_related(*cls.prefetch_related_fields)
+        return queryset
+
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -32,8 +49,9 @@ class DoctornameSerializer(serializers.ModelSerializer):
         model = Doctor
         fields = ['user']
 
-class DoctorSerializer(serializers.ModelSerializer):
+class DoctorSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     user = UserSerializer()  # Nested serializer to handle the related User object
+    select_related_fields = ('user',)
 
     class Meta:
         model = Doctor
@@ -64,9 +82,10 @@ class DoctorSerializer(serializers.ModelSerializer):
         return instance
 
 
-class PatientSerializer(serializers.ModelSerializer):
+class PatientSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     user = UserSerializer()  # Nested serializer to handle the related User object
     assigned_doctor_name = serializers.CharField(source='assigned_doctor.user.username', read_only=True)
+    select_related_fields = ('user', 'assigned_doctor__user')
 
     class Meta:
         model = Patient
@@ -75,10 +94,10 @@ class PatientSerializer(serializers.ModelSerializer):
     def update(self, instance, validated_data):
         # Extract nested user data
         user_data = validated_data.pop('user', None)
-        request_user = self.context['request'].user
+        principal = get_principal(self.context['request'])
 
         # Superuser can update any field
-        if request_user.is_superuser:
+        if principal.is_superuser:
             if user_data:
                 user = instance.user
                 user_serializer = UserSerializer(user, data=user_data, partial=True)
@@ -92,7 +111,7 @@ class PatientSerializer(serializers.ModelSerializer):
             return super().update(instance, validated_data)
 
         # Restrict fields based on user role
-        if request_user.groups.filter(name='Patient').exists():
+        if principal.in_group('Patient'):
             # If the user is a patient, allow only user-related updates
             if user_data:
                 user = instance.user
@@ -107,7 +126,7 @@ class PatientSerializer(serializers.ModelSerializer):
                     user_serializer.save()
             else:
                 raise serializers.ValidationError("Patients are not allowed to update department or assigned doctor.")
-        elif request_user.groups.filter(name='Doctor').exists():
+        elif principal.in_group('Doctor'):
             # If the user is a doctor, allow only department or assigned doctor updates
             allowed_fields = ['department', 'assigned_doctor']
             update_data = {key: value for key, value in validated_data.items() if key in allowed_fields}
@@ -123,11 +142,13 @@ class PatientSerializer(serializers.ModelSerializer):
 
 
 
-class PatientRecordSerializer(serializers.ModelSerializer):
+class PatientRecordSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     patient_name = serializers.CharField(source='patient.user.username', read_only=True)
+    select_related_fields = ('patient__user',)
     class Meta:
         model = PatientRecord
-        fields = ['record_id', 'patient', 'patient_name' ,'created_date', 'diagnostics', 'observations', 'treatments', 'department', 'misc']
+        fields = ['record_id', 'patient', 'patient_name' ,'created_date', 'diagnostics', 'observations', 'treatments', 'department', 'misc', 'version', 'updated_at']
+        read_only_fields = ['version', 'updated_at']
 
     def validate(self, data):
         """
@@ -156,7 +177,8 @@ class PatientRecordSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         # Automatically assign the department based on the doctor's department
-        validated_data['department'] = self.context['request'].user.doctor.department
+        validated_data.pop('department', None)
+        validated_data['department_id'] = get_principal(self.context['request']).department_id
         return super().create(validated_data)
 
     def update(self, instance, validated_data):
@@ -174,12 +196,48 @@ class PatientRecordSerializer(serializers.ModelSerializer):
         return super().update(instance, validated_data)
 
 
+class PatientRecordBulkItemSerializer(serializers.ModelSerializer):
+    """
+    One item of a bulk upload. The patient is a plain id here, the bulk view checks
+    all of them with one query instead of one query per item.
+    """
+    patient = serializers.IntegerField()
+
+    class Meta:
+        model = PatientRecord
+        fields = ['patient', 'diagnostics', 'observations', 'treatments', 'misc']
+
+
 class DepartmentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Department
         fields = ['id', 'name', 'diagnostics', 'location', 'specialization']
 
 
+class DoctorStatsSerializer(serializers.ModelSerializer):
+    username = serializers.CharField(source='user.username', read_only=True)
+
+    class Meta:
+        model = Doctor
+        fields = ['id', 'username', 'patient_count']
+
+
+class DepartmentStatsSerializer(EagerLoadingMixin, serializers.ModelSerializer):
+    """The counters maintained by medical/counters.py, reading them costs no COUNT query."""
+
+    class Meta:
+        model = Department
+        fields = ['id', 'name', 'doctor_count', 'patient_count', 'record_count']
+
+
+class DepartmentDoctorStatsSerializer(DepartmentStatsSerializer):
+    doctors = DoctorStatsSerializer(many=True, read_only=True)
+    prefetch_related_fields = (Prefetch('doctors', queryset=Doctor.objects.select_related('user').order_by('id')),)
+
+    class Meta(DepartmentStatsSerializer.Meta):
+        fields = DepartmentStatsSerializer.Meta.fields + ['doctors']
+
+
 
 
 
@@ -188,26 +246,9 @@ class LoginSerializer(serializers.Serializer):
     password = serializers.CharField(write_only=True)  # Make password write-only
 
     def validate(self, data):
-        # Authenticate the user with the provided credentials
-        user = authenticate(username=data['username'], password=data['password'])
-        if user and user.is_active:
-            # Create or retrieve the user's token
-            token, created = Token.objects.get_or_create(user=user)
-
-            role_id = {}
-
-            for role in ['patient', 'doctor']:
-                if hasattr(user, role):
-                    role_id[f'{role}_id'] = getattr(user, role).id
-            response_data = {
-                'token': token.key,
-                'user': {
-                    'user_id': user.id,
-                    **role_id,
-                    'username': user.username,
-                    'groups': [group.name for group in user.groups.all()]
-                }
-            }
+        # Password check on the bounded hashing pool, payload (roles, groups, token) in one query
+        response_data = login(data['username'], data['password'], self.context.get('request'))
+        if response_data is not None:
             return response_data
         # Raise validation error if credentials are invalid
         raise serializers.ValidationError("Invalid credentials. Please try again.")
@@ -300,3 +341,25 @@ class RegisterSerializer(serializers.Serializer):
             user.groups.add(patient_group)
         
         return user
+
+
+class RegisterBulkItemSerializer(RegisterSerializer):
+    """
+    One row of a bulk registration: the field checks of RegisterSerializer only. Usernames,
+    departments and doctors are checked for the whole batch at once (medical/registration.py).
+    """
+
+    def validate(self, data):
+        return data
+
+
+class JobSerializer(serializers.ModelSerializer):
+    """A background job's status (medical/jobs.py), polled on jobs/<id>/."""
+    progress = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Job
+        fields = ['id', 'kind', 'status', 'attempts', 'max_attempts', 'progress', 'result', 'error', 'created_at', 'run_after', 'started_at', 'finished_at']
+
+    def get_progress(self, job):
+        return {'done': job.progress_done, 'total': job.progress_total}
@@ -0,0 +1,69 @@
+from django.contrib.auth.models import User
+from django.db import connections
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .authentication import token_cache
+from .changes import restore_change_triggers
+from .counters import restore_counter_triggers
+from .detail_cache import USER_FIELDS, detail_cache
+from .models import Department, Doctor, Patient
+from .rollups import restore_rollup_triggers
+from .search import restore_search_triggers
+
+
+@receiver(post_save, sender=User)
+def evict_user_tokens(sender, instance, update_fields=None, **kwargs):
+    # is_active / password changes must not be served from a stale cache entry, the
+    # last_login update of every login changes nothing a request reads
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    token_cache.invalidate_user(instance.pk)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def evict_user_details(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not USER_FIELDS & set(update_fields):
+        return  # e.g. last_login, the cached representations don't show it
+    detail_cache.invalidate_user(instance.pk)
+
+
+@receiver(post_save, sender=Patient)
+@receiver(post_delete, sender=Patient)
+def evict_patient_detail(sender, instance, **kwargs):
+    detail_cache.invalidate('patient', [instance.pk])
+
+
+@receiver(post_save, sender=Doctor)
+def evict_doctor_detail(sender, instance, **kwargs):
+    detail_cache.invalidate('doctor', [instance.pk])
+
+
+@receiver(post_delete, sender=Doctor)
+def evict_deleted_doctor_details(sender, **kwargs):
+    # the database nulls its patients' assigned_doctor without sending signals
+    detail_cache.invalidate_all()
+
+
+@receiver(post_delete, sender=Token)
+def evict_deleted_token(sender, instance, **kwargs):
+    # covers tokens removed by cascades (user deleted) or from the admin
+    token_cache.invalidate(instance.key)
+
+
+@receiver(post_save, sender=Department)
+@receiver(post_delete, sender=Department)
+def evict_department_details(sender, **kwargs):
+    # the catalogue is versioned by the table itself (medical/catalogue.py), but deleting one nulls department on its doctors and patients without signals
+    detail_cache.invalidate_all()
+
+
+@receiver(post_migrate)
+def ensure_triggers(sender, using, **kwargs):
+    if sender.name == 'medical':
+        restore_search_triggers(connections[using])
+        restore_counter_triggers(connections[using])
+        restore_rollup_triggers(connections[using])
+        restore_change_triggers(connections[using])
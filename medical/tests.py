@@ -1,3 +1,1132 @@
-from django.test import TestCase
+import datetime
+import decimal
+import gzip
+import io
+import json
+import tempfile
+import threading
+import time
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import msgpack
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group, User
+from django.contrib.auth.signals import user_login_failed
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, connections
+from django.db.models import F
+from django.test import LiveServerTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from .archive import archive_records
+from .authentication import TokenCache, token_cache
+from .cache import get_or_build
+from .checks import check_detail_cache, check_replicas, check_token_cache
+from .counters import reconcile_counters, restore_counter_triggers
+from .jobs import HANDLERS, claim_job, enqueue, export_path, requeue_stale_jobs, run_job
+from .login import LoginUnavailable, PasswordCheckPool
+from .metrics import registry
+from .management.commands.loadtest import WORKLOAD, percentile
+from .models import ArchivedPatientRecord, Department, Doctor, Job, Patient, PatientRecord, RecordChange, RecordRollup
+from .principal import ANONYMOUS, get_principal, resolve_principal
+from .projection import compile_projection
+from .registration import register_users
+from .renderers import MessagePackRenderer, ORJSONRenderer
+from .replicas import monitor
+from .rollups import backfill_rollups
+from .search import search_records
+from .serializers import DoctorSerializer, PatientRecordSerializer, PatientSerializer
+from .versioning import claim_record
+
+# a second database for the replica router tests, created and migrated by the test runner like
+# the default one, and left without the tests' rows: what a replica that lags looks like
+REPLICA = 'replica_test'
+connections.settings[REPLICA] = {
+    **connections.settings['default'],
+    'TEST': {**connections.settings['default']['TEST'], 'NAME': None, 'MIRROR': None},
+}
+
+
+class HospitalTestCase(TestCase):
+    """Two departments, two doctors in the first, a patient of dr_house and one without doctor or department, a record each."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.cardiology = Department.objects.create(name='Cardiology', diagnostics='', location='A', specialization='heart')
+        cls.neurology = Department.objects.create(name='Neurology', diagnostics='', location='B', specialization='brain')
+        cls.doctor = Doctor.objects.create(user=User.objects.create_user('dr_house', password='password', first_name='Greg'), department=cls.cardiology)
+        cls.other_doctor = Doctor.objects.create(user=User.objects.create_user('dr_wilson', password='password'), department=cls.cardiology)
+        doctors, _ = Group.objects.get_or_create(name='Doctor')
+        doctors.user_set.add(cls.doctor.user, cls.other_doctor.user)
+        cls.patient = Patient.objects.create(user=User.objects.create_user('patient_1', password='password'), department=cls.cardiology, assigned_doctor=cls.doctor)
+        cls.unassigned = Patient.objects.create(user=User.objects.create_user('patient_2', password='password'))
+        cls.record = PatientRecord.objects.create(
+            patient=cls.patient, department=cls.cardiology, diagnostics='Hypertension', observations='', treatments='Rest',
+        )
+        PatientRecord.objects.create(patient=cls.unassigned, diagnostics='Migraine', observations='none', treatments='', misc='x')
+
+    def setUp(self):
+        # local memory caches outlive the rolled back test data
+        caches[settings.DETAIL_CACHE_ALIAS].clear()
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+
+class ProjectionTests(HospitalTestCase):
+    def test_projection_renders_the_serializer_data(self):
+        for serializer_class, model in ((DoctorSerializer, Doctor), (PatientSerializer, Patient), (PatientRecordSerializer, PatientRecord)):
+            with self.subTest(serializer=serializer_class.__name__):
+                projection = compile_projection(serializer_class)
+                self.assertIsNotNone(projection)
+                queryset = model.objects.order_by('pk')
+                expected = serializer_class(serializer_class.setup_eager_loading(queryset), many=True, context={}).data
+                rendered = projection.render(projection.values(queryset))
+                # same keys in the same order: the JSON is the same bytes
+                self.assertEqual(json.dumps(rendered), json.dumps(expected))
+
+    def test_projection_fields(self):
+        projection = compile_projection(PatientSerializer).only('id,user.username,assigned_doctor_name')
+        rows = projection.render(projection.values(Patient.objects.order_by('pk')))
+        self.assertEqual(rows, [
+            {'id': self.patient.pk, 'user': {'username': 'patient_1'}, 'assigned_doctor_name': 'dr_house'},
+            {'id': self.unassigned.pk, 'user': {'username': 'patient_2'}},
+        ])
+
+
+class PaginationTests(HospitalTestCase):
+    def pages(self, client, url, between_pages=None):
+        seen = []
+        while url:
+            page = client.get(url).json()
+            self.assertNotIn('count', page)
+            seen.append([row.get('record_id', row.get('id')) for row in page['results']])
+            url = page['next']
+            if between_pages:
+                between_pages()
+        return seen
+
+    def test_record_pages_are_stable(self):
+        PatientRecord.objects.bulk_create([
+            PatientRecord(patient=self.patient, department=self.cardiology, diagnostics=f'Visit {number}', observations='', treatments='') for number in range(4)
+        ])
+        # all created in the same instant: only record_id orders them
+        PatientRecord.objects.filter(department=self.cardiology).update(created_date=timezone.now() - datetime.timedelta(days=1))
+        expected = list(PatientRecord.objects.filter(department=self.cardiology).order_by('-record_id').values_list('record_id', flat=True))
+
+        def new_record():
+            PatientRecord.objects.create(patient=self.patient, department=self.cardiology, diagnostics='Later', observations='', treatments='')
+
+        pages = self.pages(self.client_for(self.doctor.user), '/medical/patient_records/?page_size=2', between_pages=new_record)
+        self.assertEqual(pages, [expected[0:2], expected[2:4], [expected[4]]])
+
+    def test_previous_pages_and_ordering(self):
+        PatientRecord.objects.bulk_create([
+            PatientRecord(patient=self.patient, department=self.cardiology, diagnostics=f'Visit {number}', observations='', treatments='') for number in range(2)
+        ])
+        client = self.client_for(self.doctor.user)
+        oldest_first = list(PatientRecord.objects.filter(department=self.cardiology).order_by('created_date', 'record_id').values_list('record_id', flat=True))
+        self.assertEqual(sum(self.pages(client, '/medical/patient_records/?page_size=2&ordering=created_date'), []), oldest_first)
+        second = client.get(client.get('/medical/patient_records/?page_size=2').json()['next']).json()
+        first = client.get(second['previous']).json()
+        self.assertEqual([row['record_id'] for row in first['results']], oldest_first[:-3:-1])
+        self.assertIsNone(first['previous'])
+
+    def test_tampered_cursor(self):
+        response = self.client_for(self.doctor.user).get('/medical/patient_records/', {'cursor': 'cD1bIngiLCAiMSJd'})  # p=["x", "1"]
+        self.assertEqual(response.status_code, 404)
+
+    def test_list_pages(self):
+        admin = User.objects.create_superuser('admin', password='password')
+        pages = self.pages(self.client_for(admin), '/medical/patients/?page_size=1')
+        self.assertEqual(pages, [[self.patient.pk], [self.unassigned.pk]])
+
+
+class QueryPlanTests(HospitalTestCase):
+    def add_patients(self, count):
+        for _ in range(count):
+            patient = Patient.objects.create(user=User.objects.create_user(f'extra_{User.objects.count()}'), department=self.neurology, assigned_doctor=self.other_doctor)
+            PatientRecord.objects.create(patient=patient, diagnostics='Checkup', observations='', treatments='')
+
+    def test_serializers_read_their_relations_in_one_query(self):
+        self.add_patients(3)
+        for serializer_class, model in ((DoctorSerializer, Doctor), (PatientSerializer, Patient), (PatientRecordSerializer, PatientRecord)):
+            with self.subTest(serializer=serializer_class.__name__):
+                queryset = serializer_class.setup_eager_loading(model.objects.all())
+                with self.assertNumQueries(1):
+                    serializer_class(queryset, many=True, context={}).data
+
+    def test_list_queries_dont_grow_with_the_page(self):
+        client = self.client_for(User.objects.create_superuser('admin', password='password'))
+        counts = []
+        for _ in range(2):
+            for url in ('/medical/doctors/', '/medical/patients/', '/medical/patient_records/'):
+                with CaptureQueriesContext(connection) as queries:
+                    self.assertEqual(client.get(url).status_code, 200)
+                counts.append(len(queries))
+            self.add_patients(5)
+        self.assertEqual(counts[:3], counts[3:])
+
+
+class PrincipalTests(HospitalTestCase):
+    def test_roles_and_departments_in_one_query(self):
+        with self.assertNumQueries(1):
+            doctor = resolve_principal(self.doctor.user)
+        self.assertEqual((doctor.role, doctor.doctor_id, doctor.department_name, doctor.groups), ('doctor', self.doctor.pk, 'Cardiology', frozenset({'Doctor'})))
+        self.assertTrue(doctor.is_assigned_doctor_of(self.patient))
+        self.assertFalse(doctor.is_assigned_doctor_of(self.unassigned))
+
+        patient = resolve_principal(self.unassigned.user)
+        self.assertEqual((patient.role, patient.patient_id, patient.department_id, patient.groups), ('patient', self.unassigned.pk, None, frozenset()))
+        self.assertEqual(resolve_principal(User.objects.create_superuser('admin', password='password')).role, 'superuser')
+        self.assertIs(resolve_principal(None), ANONYMOUS)
+
+    def test_resolved_once_per_request(self):
+        request = mock.Mock(user=self.doctor.user, _request=mock.Mock(_principal=None))
+        principal = get_principal(request)
+        with self.assertNumQueries(0):
+            self.assertIs(get_principal(request), principal)
+        request.user = self.patient.user  # e.g. a test client switching users: resolved again
+        self.assertEqual(get_principal(request).patient_id, self.patient.pk)
+
+        with mock.patch('medical.principal.resolve_principal', wraps=resolve_principal) as resolve:
+            self.assertEqual(self.client_for(self.doctor.user).get(f'/medical/patient_records/{self.record.pk}/').status_code, 200)
+        self.assertEqual(resolve.call_count, 1)
+
+
+class CatalogueTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        caches['default'].clear()
+
+    def test_served_from_cache_with_etag(self):
+        client = APIClient()
+        response = client.get('/medical/departments/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([department['name'] for department in response.json()], ['Cardiology', 'Neurology'])
+        etag = response['ETag']
+
+        with self.assertNumQueries(1):  # the version, not the departments
+            self.assertEqual(client.get('/medical/departments/').content, response.content)
+        self.assertEqual(client.get('/medical/departments/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_a_change_is_a_new_version(self):
+        client = APIClient()
+        etag = client.get('/medical/departments/')['ETag']
+        Department.objects.filter(pk=self.neurology.pk).update(location='C', updated_at=timezone.now() + datetime.timedelta(seconds=1))
+        response = client.get('/medical/departments/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()[1]['location'], 'C')
+
+        self.neurology.delete()
+        self.assertEqual(len(client.get('/medical/departments/').json()), 1)
+
+    def test_concurrent_misses_build_once(self):
+        builds = []
+
+        def build():
+            builds.append(1)
+            time.sleep(0.2)
+            return 'catalogue'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(get_or_build('test:single-flight', build))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((results, len(builds)), (['catalogue'] * 4, 1))
+
+        # another worker holds the lock: wait for what it stores instead of building
+        caches['default'].add('test:other-worker:lock', 1, 5)
+        threading.Timer(0.1, caches['default'].set, ('test:other-worker', 'theirs')).start()
+        self.assertEqual(get_or_build('test:other-worker', build), 'theirs')
+        self.assertEqual(len(builds), 1)
+
+
+class BulkIngestTests(HospitalTestCase):
+    def test_results_per_item(self):
+        other_department = Patient.objects.create(user=User.objects.create_user('patient_3'), department=self.neurology)
+        items = [
+            {'patient': self.patient.pk, 'diagnostics': 'Flu', 'observations': 'Fever', 'treatments': 'Rest'},
+            {'patient': self.patient.pk, 'observations': 'no diagnostics'},
+            {'patient': 0, 'diagnostics': 'Flu', 'observations': 'Fever', 'treatments': 'Rest'},
+            {'patient': other_department.pk, 'diagnostics': 'Flu', 'observations': 'Fever', 'treatments': 'Rest'},
+        ]
+        response = self.client_for(self.doctor.user).post('/medical/patient_records/bulk/', items, format='json')
+        self.assertEqual(response.status_code, 201)
+        body = response.json()
+        self.assertEqual((body['created'], body['failed']), (1, 3))
+        self.assertEqual([result['status'] for result in body['results']], ['created', 'error', 'error', 'error'])
+        self.assertIn('diagnostics', body['results'][1]['errors'])
+        self.assertEqual(body['results'][2]['errors'], {'patient': ['Invalid patient ID.']})
+        self.assertEqual(body['results'][3]['errors'], {'patient': ['Patient does not belong to your department.']})
+        record = PatientRecord.objects.get(pk=body['results'][0]['record_id'])
+        self.assertEqual((record.patient_id, record.department_id, record.diagnostics), (self.patient.pk, self.cardiology.pk, 'Flu'))
+
+    def test_ndjson_and_rejected_batches(self):
+        client = self.client_for(self.doctor.user)
+        lines = b'{"patient": %d, "diagnostics": "Flu", "observations": "Fever", "treatments": "Rest"}\n\n{"patient": 0}\n' % self.patient.pk
+        response = client.post('/medical/patient_records/bulk/', lines, content_type='application/x-ndjson')
+        self.assertEqual((response.status_code, response.json()['created'], response.json()['failed']), (201, 1, 1))
+
+        # nothing created: 400, still with the results
+        response = client.post('/medical/patient_records/bulk/', [{'patient': 0}], format='json')
+        self.assertEqual((response.status_code, response.json()['failed']), (400, 1))
+        self.assertEqual(client.post('/medical/patient_records/bulk/', {'patient': self.patient.pk}, format='json').status_code, 400)
+        with self.settings(BULK_RECORDS_MAX_ITEMS=1):
+            self.assertEqual(client.post('/medical/patient_records/bulk/', [{}, {}], format='json').status_code, 400)
+        self.assertEqual(self.client_for(self.patient.user).post('/medical/patient_records/bulk/', [], format='json').status_code, 403)
+
+    def test_async_upload_is_ingested_by_a_job(self):
+        items = [{'patient': self.patient.pk, 'diagnostics': 'Flu', 'observations': 'Fever', 'treatments': 'Rest'}]
+        response = self.client_for(self.doctor.user).post('/medical/patient_records/bulk/', items, format='json', HTTP_PREFER='respond-async')
+        self.assertEqual(response.status_code, 202)
+        self.assertFalse(PatientRecord.objects.filter(diagnostics='Flu').exists())
+        job = claim_job('test-worker')
+        run_job(job)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.result['created']), ('succeeded', 1))
+        self.assertTrue(PatientRecord.objects.filter(pk=job.result['results'][0]['record_id'], department=self.cardiology).exists())
+
+
+class ExportTests(HospitalTestCase):
+    def export(self, user, **params):
+        response = self.client_for(user).get('/medical/patient_records/export/', params)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content)
+
+    def test_doctor_exports_their_department_as_ndjson(self):
+        response, body = self.export(self.doctor.user)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertIn('filename="patient_records.ndjson"', response['Content-Disposition'])
+        rows = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual([(row['record_id'], row['patient_name'], row['department_name']) for row in rows], [(self.record.pk, 'patient_1', 'Cardiology')])
+        # dates as the API writes them
+        self.assertEqual(rows[0]['created_date'], PatientRecordSerializer(self.record).data['created_date'])
+
+    def test_csv_gzip_and_department_filter(self):
+        admin = User.objects.create_superuser('admin', password='password')
+        _, body = self.export(admin, output='csv')
+        self.assertEqual(len(body.decode().splitlines()), 3)  # header and both records
+        _, body = self.export(admin, output='csv', department=self.cardiology.pk)
+        header, row = body.decode().splitlines()
+        self.assertTrue(header.startswith('record_id,patient,patient_name'))
+        self.assertTrue(row.startswith(f'{self.record.pk},{self.patient.pk},patient_1'))
+
+        response, compressed = self.export(admin, output='csv', department=self.cardiology.pk, gzip=1)
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertIn('filename="patient_records.csv.gz"', response['Content-Disposition'])
+        self.assertEqual(gzip.decompress(compressed), body)
+
+    def test_bad_parameters(self):
+        admin = self.client_for(User.objects.create_superuser('admin', password='password'))
+        self.assertEqual(admin.get('/medical/patient_records/export/', {'output': 'xml'}).status_code, 400)
+        self.assertEqual(admin.get('/medical/patient_records/export/', {'department': 'x'}).status_code, 400)
+        self.assertEqual(self.client_for(self.patient.user).get('/medical/patient_records/export/').status_code, 403)
+
+
+class RecordRangeTests(HospitalTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.days = []
+        for moment in ('2024-01-01T10:00:00Z', '2024-01-02T23:00:00Z', '2024-01-03T08:00:00Z'):
+            record = PatientRecord.objects.create(patient=cls.patient, department=cls.cardiology, diagnostics='Checkup', observations='ok', treatments='none')
+            PatientRecord.objects.filter(pk=record.pk).update(created_date=datetime.datetime.fromisoformat(moment))
+            cls.days.append(record.pk)
+
+    def ids(self, url, **params):
+        response = self.client_for(self.doctor.user).get(url, params)
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        return [row['record_id'] for row in (body['results'] if isinstance(body, dict) else body)]
+
+    def test_list_range_and_ordering(self):
+        url = '/medical/patient_records/'
+        self.assertEqual(self.ids(url, created_after='2024-01-02', created_before='2024-01-02'), [self.days[1]])  # a bare date is the whole day
+        self.assertEqual(self.ids(url, created_after='2024-01-01T10:00:00Z', created_before='2024-01-03T08:00:00Z'), self.days[::-1])
+        self.assertEqual(self.ids(url, created_before='2024-01-03', ordering='created_date'), self.days)
+        client = self.client_for(self.doctor.user)
+        self.assertEqual(client.get(url, {'created_after': 'yesterday'}).status_code, 400)
+        self.assertEqual(client.get(url, {'ordering': 'diagnostics'}).status_code, 400)
+
+    def test_patient_history_range_and_ordering(self):
+        url = f'/medical/patient_records/{self.patient.pk}/'
+        self.assertEqual(self.ids(url, created_after='2024-01-02', created_before='2024-01-03T00:00:00Z'), [self.days[1]])
+        self.assertEqual(self.ids(url, created_before='2024-01-03', ordering='created_date'), self.days)
+
+    @skipUnless(connection.vendor == 'sqlite', 'SQLite query plans')
+    def test_range_queries_use_the_composite_indexes(self):
+        after = timezone.now() - datetime.timedelta(days=7)
+        by_department = PatientRecord.objects.filter(department=self.cardiology, created_date__gte=after).order_by('-created_date')
+        by_patient = PatientRecord.objects.filter(patient=self.patient, created_date__gte=after).order_by('-created_date')
+        self.assertIn('record_dept_created_idx', by_department.explain())
+        self.assertIn('record_patient_created_idx', by_patient.explain())
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class PopulateDatabaseTests(TestCase):
+    def populate(self, **options):
+        call_command('populate_database', departments=2, doctors=3, patients=7, records_per_patient=2, batch_size=3, stdout=io.StringIO(), **options)
+        return (
+            list(Patient.objects.order_by('user__username').values_list('user__username', 'user__first_name', 'department__name', 'assigned_doctor__user__username')),
+            list(PatientRecord.objects.order_by('patient__user__username', 'created_date').values_list('patient__user__username', 'diagnostics')),
+        )
+
+    def test_sizes_and_consistency(self):
+        self.populate()
+        self.assertEqual((Department.objects.count(), Doctor.objects.count(), Patient.objects.count(), PatientRecord.objects.count()), (2, 3, 7, 14))
+        self.assertEqual(User.objects.filter(groups__name='Doctor').count(), 3)
+        self.assertEqual(User.objects.filter(groups__name='Patient').count(), 7)
+        self.assertTrue(User.objects.get(username='patient_7').check_password('password'))
+        self.assertFalse(PatientRecord.objects.exclude(department=F('patient__department')).exists())
+        self.assertFalse(Patient.objects.exclude(assigned_doctor__department=F('department')).exists())
+        self.assertFalse(PatientRecord.objects.filter(created_date__lt=timezone.now() - datetime.timedelta(days=365)).exists())
+
+    def test_same_seed_same_data(self):
+        first = self.populate(seed=7)
+        with self.assertRaises(CommandError):
+            self.populate(seed=7)  # the users exist already
+        User.objects.all().delete()
+        Department.objects.all().delete()
+        self.assertEqual(self.populate(seed=7), first)
+        User.objects.all().delete()
+        Department.objects.all().delete()
+        self.assertNotEqual(self.populate(seed=8), first)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class LoadTestTests(LiveServerTestCase):
+    def setUp(self):
+        cardiology = Department.objects.create(name='Cardiology', diagnostics='', location='A', specialization='heart')
+        for number in (1, 2):
+            doctor = Doctor.objects.create(user=User.objects.create_user(f'dr_{number}', password='password'), department=cardiology)
+            Group.objects.get_or_create(name='Doctor')[0].user_set.add(doctor.user)
+            Patient.objects.create(user=User.objects.create_user(f'patient_{number}', password='password'), department=cardiology, assigned_doctor=doctor)
+
+    def test_mixed_workload_against_a_server(self):
+        output = self.enterContext(tempfile.NamedTemporaryFile(suffix='.json'))
+        call_command('loadtest', url=self.live_server_url, concurrency=2, duration=0.5, output=output.name, stdout=io.StringIO())
+        results = json.load(output)
+        self.assertEqual(set(results['endpoints']), set(WORKLOAD))
+        self.assertGreater(results['total_requests'], 0)
+        self.assertEqual({name: row['errors'] for name, row in results['endpoints'].items() if row['errors']}, {})
+
+        stdout = io.StringIO()
+        call_command('loadtest', url=self.live_server_url, concurrency=1, duration=0.2, baseline=output.name, stdout=stdout)
+        self.assertIn('p95 vs baseline', stdout.getvalue())
+
+    def test_refuses_users_it_cant_work_as(self):
+        with self.assertRaisesMessage(CommandError, 'Could not log in as dr_1'):
+            call_command('loadtest', url=self.live_server_url, concurrency=1, duration=0.1, username=['dr_1'], password='wrong', stdout=io.StringIO())
+        with self.assertRaisesMessage(CommandError, 'patient_1 is not a doctor'):
+            call_command('loadtest', url=self.live_server_url, concurrency=1, duration=0.1, username=['patient_1'], stdout=io.StringIO())
+
+    def test_percentile(self):
+        self.assertEqual([percentile(list(range(1, 101)), pct) for pct in (50, 95, 99, 100)], [50, 95, 99, 100])
+        self.assertEqual(percentile([7], 99), 7)
+        self.assertIsNone(percentile([], 50))
+
+
+class MetricsTests(HospitalTestCase):
+    def requests(self, view, method='GET', status=200):
+        return registry.snapshot()['requests'].get(f'{view}|{method}|{status}', 0)
+
+    def test_requests_are_observed_per_url_name(self):
+        before = self.requests('department-list-create')
+        queries_before = registry.snapshot()['sql_queries'].get('department-list-create', {'count': 0})['count']
+        APIClient().get('/medical/departments/')
+        self.assertEqual(self.requests('department-list-create'), before + 1)
+        self.assertEqual(registry.snapshot()['sql_queries']['department-list-create']['count'], queries_before + 1)
+
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('medical_http_requests_total{view="department-list-create",method="GET",status="200"}', body)
+        self.assertIn('medical_http_request_duration_seconds_bucket{view="department-list-create",le="+Inf"}', body)
+        self.assertIn('medical_token_cache_hits_total', body)
+
+    def test_streaming_responses_are_observed_once_sent(self):
+        before = registry.snapshot()
+        response = self.client_for(self.doctor.user).get('/medical/patient_records/export/')
+        self.assertEqual(self.requests('patient-record-export'), before['requests'].get('patient-record-export|GET|200', 0))
+        body = b''.join(response.streaming_content)
+        after = registry.snapshot()
+        self.assertEqual(self.requests('patient-record-export'), before['requests'].get('patient-record-export|GET|200', 0) + 1)
+        self.assertEqual(after['response_bytes']['patient-record-export'] - before['response_bytes'].get('patient-record-export', 0), len(body))
+        self.assertGreater(after['sql_queries']['patient-record-export']['sum'], before['sql_queries'].get('patient-record-export', {'sum': 0})['sum'])
+
+    def test_metrics_token(self):
+        with self.settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+
+    def test_workers_counters_are_added_up(self):
+        directory = self.enterContext(tempfile.TemporaryDirectory())
+        with open(f'{directory}/metrics_1.json', 'w') as other_worker:
+            json.dump({'requests': {'department-list-create|GET|200': 1000}, 'collectors': {'token_cache': {'hits': 5}}}, other_worker)
+        with self.settings(METRICS_MULTIPROC_DIR=directory):
+            ours = self.requests('department-list-create')
+            body = self.client.get('/metrics').content.decode()
+        self.assertIn(f'medical_http_requests_total{{view="department-list-create",method="GET",status="200"}} {ours + 1000}', body)
+
+
+class RendererTests(HospitalTestCase):
+    def test_orjson_writes_the_bytes_of_json_renderer(self):
+        data = {
+            'name': 'Zoë \u2028 \u2029 "quoted"', 'when': datetime.datetime(2024, 1, 31, 12, 0, 0, 500, tzinfo=datetime.timezone.utc),
+            'day': datetime.date(2024, 1, 31), 'amount': decimal.Decimal('1.50'), 'big': 2 ** 70, 'items': [1, 2.5, None, True],
+        }
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(ORJSONRenderer().render({1: 'non-string key'}), JSONRenderer().render({1: 'non-string key'}))
+        indented = ORJSONRenderer().render(data, 'application/json; indent=2')
+        self.assertEqual(indented, JSONRenderer().render(data, 'application/json; indent=2'))
+
+    def test_nan_is_null_with_orjson(self):
+        self.assertEqual(ORJSONRenderer().render({'ratio': float('nan'), 'max': float('inf')}), b'{"ratio":null,"max":null}')
+        with self.assertRaises(ValueError):
+            JSONRenderer().render({'ratio': float('nan')})
+
+    def test_negotiated_formats_round_trip(self):
+        client = self.client_for(self.doctor.user)
+        url = f'/medical/patients/{self.patient.pk}/'
+        as_json = client.get(url, HTTP_ACCEPT='application/json')
+        as_msgpack = client.get(url, HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(as_msgpack['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(as_msgpack.content), as_json.json())
+        self.assertEqual(msgpack.unpackb(client.get(url, {'format': 'msgpack'}).content), as_json.json())
+        self.assertEqual(MessagePackRenderer().render({'when': datetime.datetime(2024, 1, 31, tzinfo=datetime.timezone.utc)}), msgpack.packb({'when': '2024-01-31T00:00:00Z'}))
+
+        items = [{'patient': self.patient.pk, 'diagnostics': 'Flu', 'observations': 'Fever', 'treatments': 'Rest'}]
+        response = client.post('/medical/patient_records/bulk/', msgpack.packb(items), content_type='application/msgpack', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual((response.status_code, msgpack.unpackb(response.content)['created']), (201, 1))
+
+    def test_parsers_refuse_what_json_parser_refuses(self):
+        client = self.client_for(self.doctor.user)
+        self.assertEqual(client.post('/medical/patient_records/bulk/', b'[{"patient": NaN}]', content_type='application/json').status_code, 400)
+        self.assertEqual(client.post('/medical/patient_records/bulk/', b'[{', content_type='application/json').status_code, 400)
+        response = client.post('/medical/patient_records/bulk/', b'\xc1', content_type='application/msgpack')
+        self.assertEqual((response.status_code, response.json()['details']['detail']), (400, 'MessagePack parse error - FormatError'))
+
+
+class PatientDetailAccessTests(HospitalTestCase):
+    def test_doctor_access_follows_the_assignment_not_the_cached_entry(self):
+        url = f'/medical/patients/{self.patient.pk}/'
+        self.assertEqual(self.client_for(self.doctor.user).get(url).status_code, 200)  # cached now
+        # no signal: the cached entry still names the old doctor
+        Patient.objects.filter(pk=self.patient.pk).update(assigned_doctor=self.other_doctor)
+        self.assertEqual(self.client_for(self.doctor.user).get(url).status_code, 403)
+        self.assertEqual(self.client_for(self.other_doctor.user).get(url).status_code, 200)
+
+    def test_patient_reads_their_own_profile(self):
+        client = self.client_for(self.patient.user)
+        self.assertEqual(client.get(f'/medical/patients/{self.patient.pk}/').status_code, 200)
+        self.assertEqual(client.get(f'/medical/patients/{self.unassigned.pk}/').status_code, 403)
+
+
+class DetailCacheCheckTests(TestCase):
+    def test_warns_about_per_worker_caches_with_several_workers(self):
+        with mock.patch.dict('os.environ', {'WEB_CONCURRENCY': '4'}):
+            self.assertEqual([warning.id for warning in check_detail_cache(None)], ['medical.W001'])
+            with self.settings(CACHES={**settings.CACHES, 'shared': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': '/tmp'}}, DETAIL_CACHE_ALIAS='shared'):
+                self.assertEqual(check_detail_cache(None), [])
+        with mock.patch.dict('os.environ', {'WEB_CONCURRENCY': '1'}):
+            self.assertEqual(check_detail_cache(None), [])
+
+
+class TokenCacheTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        token_cache.clear()
+
+    def token_client(self, user):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=user).key)
+        return client
+
+    def test_lookups_are_counted(self):
+        client = self.token_client(self.doctor.user)
+        before = token_cache.stats()
+        self.assertEqual(client.get(f'/medical/patients/{self.patient.pk}/').status_code, 200)
+        self.assertEqual(client.get(f'/medical/patients/{self.patient.pk}/').status_code, 200)
+        after = token_cache.stats()
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['hits'] - before['hits'], 1)
+
+    def test_logout_evicts_the_token(self):
+        client = self.token_client(self.doctor.user)
+        self.assertEqual(client.get(f'/medical/patients/{self.patient.pk}/').status_code, 200)
+        self.assertEqual(client.post('/medical/logout/').status_code, 204)
+        self.assertEqual(client.get(f'/medical/patients/{self.patient.pk}/').status_code, 401)
+
+    def test_deleting_a_profile_evicts_its_token(self):
+        client = self.token_client(self.other_doctor.user)
+        self.assertEqual(client.get(f'/medical/doctors/{self.other_doctor.pk}/').status_code, 200)
+        self.assertEqual(client.delete(f'/medical/doctors/{self.other_doctor.pk}/').status_code, 204)
+        self.assertEqual(client.get('/medical/doctors/').status_code, 401)
+
+        patient_client = self.token_client(self.patient.user)
+        self.assertEqual(patient_client.get(f'/medical/patients/{self.patient.pk}/').status_code, 200)
+        self.assertEqual(self.client_for(self.doctor.user).delete(f'/medical/patients/{self.patient.pk}/').status_code, 204)
+        self.assertEqual(patient_client.get('/medical/doctors/').status_code, 401)
+
+    @override_settings(
+        CACHES={**settings.CACHES, 'tokens': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tokens'}},
+        TOKEN_CACHE_ALIAS='tokens',
+    )
+    def test_a_token_revoked_on_one_worker_stops_working_on_the_others(self):
+        token = Token.objects.create(user=self.doctor.user)
+        worker, other_worker = TokenCache(), TokenCache()
+        self.assertIsNone(worker.get(token.key))
+        worker.set(token.key, self.doctor.user, token)
+        self.assertEqual(worker.get(token.key)[1], token)
+        self.assertEqual(other_worker.get(token.key)[1], token)
+        self.assertEqual((worker.stats()['shared_hits'], worker.stats()['shared_misses']), (1, 1))
+
+        other_worker.invalidate(token.key)
+        self.assertIsNone(worker.get(token.key))
+
+    def test_warns_about_per_worker_caches_with_several_workers(self):
+        with mock.patch.dict('os.environ', {'WEB_CONCURRENCY': '4'}):
+            self.assertEqual([warning.id for warning in check_token_cache(None)], ['medical.W002'])
+            with self.settings(CACHES={**settings.CACHES, 'shared': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': '/tmp'}}, TOKEN_CACHE_ALIAS='shared'):
+                self.assertEqual(check_token_cache(None), [])
+        with mock.patch.dict('os.environ', {'WEB_CONCURRENCY': '1'}):
+            self.assertEqual(check_token_cache(None), [])
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class LoginTests(HospitalTestCase):
+    def login(self, username, password):
+        return APIClient().post('/medical/login/', {'username': username, 'password': password}, format='json')
+
+    def test_returns_token_roles_and_groups(self):
+        response = self.login('dr_house', 'password')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['token'], Token.objects.get(user=self.doctor.user).key)
+        self.assertEqual(response.json()['user'], {'user_id': self.doctor.user.pk, 'doctor_id': self.doctor.pk, 'username': 'dr_house', 'groups': ['Doctor']})
+
+    def test_wrong_credentials_send_user_login_failed(self):
+        User.objects.filter(username='patient_2').update(is_active=False)
+        failures = []
+        receiver = lambda sender, credentials, request, **kwargs: failures.append((credentials, request is not None))
+        user_login_failed.connect(receiver)
+        self.addCleanup(user_login_failed.disconnect, receiver)
+
+        self.assertEqual(self.login('dr_house', 'wrong').status_code, 400)
+        self.assertEqual(self.login('nobody', 'password').status_code, 400)
+        self.assertEqual(self.login('patient_2', 'password').status_code, 400)
+        self.assertEqual(self.login('dr_house', 'password').status_code, 200)
+        self.assertEqual([credentials['username'] for credentials, _ in failures], ['dr_house', 'nobody', 'patient_2'])
+        self.assertTrue(all(credentials['password'] != 'wrong' and has_request for credentials, has_request in failures))
+
+    @override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.PBKDF2PasswordHasher', 'django.contrib.auth.hashers.MD5PasswordHasher'])
+    def test_outdated_hash_is_upgraded(self):
+        User.objects.filter(username='dr_house').update(password=make_password('password', hasher='md5'))
+        self.assertEqual(self.login('dr_house', 'password').status_code, 200)
+        self.assertTrue(User.objects.get(username='dr_house').password.startswith('pbkdf2_sha256$'))
+
+    @override_settings(LOGIN_HASH_WORKERS=1, LOGIN_HASH_QUEUE=0, LOGIN_RETRY_AFTER=7)
+    def test_saturated_pool_answers_503_with_retry_after(self):
+        pool = PasswordCheckPool()
+        release = threading.Event()
+        self.addCleanup(release.set)
+        with mock.patch('medical.login.password_pool', pool), self.settings(LOGIN_HASH_TIMEOUT=0):
+            # a hash that doesn't finish in time gives up its caller, not its slot
+            with self.assertRaises(LoginUnavailable):
+                pool.run(release.wait)
+            response = self.login('dr_house', 'password')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '7')
+        self.assertEqual(pool.stats(), {'admitted': 1, 'rejected': 1, 'timeouts': 1})
+
+        release.set()
+        with mock.patch('medical.login.password_pool', pool):
+            for _ in range(100):  # the slot is released by the finished hash, on the pool thread
+                if self.login('dr_house', 'password').status_code == 200:
+                    break
+                time.sleep(0.01)
+            else:
+                self.fail('the pool never freed its slot')
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class RegisterBulkTests(HospitalTestCase):
+    def row(self, username, user_type='patient', **fields):
+        return {'username': username, 'password': 'Secret123!x', 'first_name': 'A', 'last_name': 'B', 'user_type': user_type, 'department': self.cardiology.pk, **fields}
+
+    def test_rules_are_checked_per_row(self):
+        results = register_users([
+            self.row('new_1', assigned_doctor=self.doctor.pk),
+            self.row('house', 'doctor'),  # dr_house exists
+            self.row('new_1'),
+            self.row('new_2', department=0),
+            self.row('new_3', department=self.neurology.pk, assigned_doctor=self.doctor.pk),
+            self.row('new_4', assigned_doctor=self.doctor.pk + 100),
+            self.row('new_5', 'nurse'),
+            self.row('new_6', 'doctor', department=self.neurology.pk),
+            self.row('new_7', assigned_doctor=0),  # like None, as in RegisterSerializer
+        ])
+        self.assertEqual([result['status'] for result in results], ['created'] + ['error'] * 6 + ['created'] * 2)
+        messages = [result['errors'].get('non_field_errors', [''])[0] for result in results[1:6]]
+        self.assertEqual(messages, [
+            'This username is already taken for a doctor. Please choose another.',
+            'This username appears more than once in the upload.',
+            'The specified department does not exist.',
+            'The assigned doctor does not belong to the same department as the patient.',
+            'The specified assigned doctor does not exist.',
+        ])
+        self.assertIn('user_type', results[6]['errors'])
+        patient = Patient.objects.get(pk=results[0]['patient_id'])
+        self.assertEqual((patient.user.username, patient.assigned_doctor_id, patient.user.groups.get().name), ('new_1', self.doctor.pk, 'Patient'))
+        self.assertTrue(patient.user.check_password('Secret123!x'))
+        self.assertEqual(Doctor.objects.get(pk=results[7]['doctor_id']).user.username, 'dr_new_6')
+        self.assertIsNone(Patient.objects.get(pk=results[8]['patient_id']).assigned_doctor_id)
+
+    def test_a_username_taken_meanwhile_fails_alone(self):
+        original = User.objects.bulk_create
+
+        def taken_meanwhile(users, *args, **kwargs):
+            # what the unique index says once a concurrent registration of new_2 committed
+            if any(user.username == 'new_2' for user in users):
+                raise IntegrityError('UNIQUE constraint failed: auth_user.username')
+            return original(users, *args, **kwargs)
+
+        with mock.patch.object(User.objects, 'bulk_create', side_effect=taken_meanwhile):
+            results = register_users([self.row('new_1'), self.row('new_2'), self.row('new_3')], batch_size=3)
+        self.assertEqual([result['status'] for result in results], ['created', 'error', 'created'])
+
+    def test_csv_upload_and_command(self):
+        admin = self.client_for(User.objects.create_superuser('admin', password='password'))
+        upload = 'username,password,first_name,last_name,user_type,department\n' + f'csv_1,Secret123!x,A,B,patient,{self.cardiology.pk}\n'
+        response = admin.post('/medical/register/bulk/', upload, content_type='text/csv')
+        self.assertEqual((response.status_code, response.json()['created']), (201, 1))
+        self.assertEqual(self.client_for(self.doctor.user).post('/medical/register/bulk/', [], format='json').status_code, 403)
+
+        directory = self.enterContext(tempfile.TemporaryDirectory())
+        with open(f'{directory}/users.ndjson', 'w') as source:
+            source.write(json.dumps(self.row('cmd_1')) + '\n' + json.dumps(self.row('csv_1')) + '\n')
+        stderr = io.StringIO()
+        call_command('register_users', f'{directory}/users.ndjson', workers=1, report=f'{directory}/report.json', stdout=io.StringIO(), stderr=stderr)
+        with open(f'{directory}/report.json') as report:
+            self.assertEqual([result['status'] for result in json.load(report)], ['created', 'error'])
+        self.assertIn('row 1:', stderr.getvalue())
+        self.assertTrue(User.objects.filter(username='cmd_1').exists())
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'], BULK_REGISTER_SYNC_MAX_ITEMS=2)
+class RegisterJobTests(HospitalTestCase):
+    def test_large_upload_is_registered_by_a_job(self):
+        admin = User.objects.create_superuser('admin', password='password')
+        client = self.client_for(admin)
+        rows = [
+            {'username': 'new_1', 'password': 'Secret123!x', 'first_name': 'A', 'last_name': 'B', 'user_type': 'patient', 'department': self.cardiology.pk},
+            {'username': 'new_2', 'password': 'Secret123!x', 'first_name': 'C', 'last_name': 'D', 'user_type': 'doctor', 'department': self.neurology.pk},
+            {'username': 'new_3', 'password': 'Secret123!x', 'first_name': 'E', 'last_name': 'F', 'user_type': 'patient', 'department': 0},
+        ]
+        response = client.post('/medical/register/bulk/', rows, format='json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['status'], 'queued')
+        self.assertFalse(User.objects.filter(username='new_1').exists())
+
+        job = claim_job('test-worker')
+        self.assertEqual(job.pk, response.json()['id'])
+        # inline hashing: the job's transaction (here, the test's) survives it
+        self.assertIsNone(run_job(job))
+
+        status = client.get(f"/medical/jobs/{job.pk}/").json()
+        self.assertEqual(status['status'], 'succeeded')
+        self.assertEqual(status['progress'], {'done': 3, 'total': 3})
+        self.assertEqual((status['result']['created'], status['result']['failed']), (2, 1))
+        self.assertEqual(status['result']['results'][2]['status'], 'error')
+        self.assertTrue(User.objects.get(username='new_1').check_password('Secret123!x'))
+        self.assertTrue(Doctor.objects.filter(user__username='dr_new_2', department=self.neurology).exists())
+        self.assertIsNone(claim_job('test-worker'))
+
+    def test_job_result_file_name(self):
+        admin = User.objects.create_superuser('admin', password='password')
+        job = Job.objects.create(kind='export_patient_records', params={'export_format': 'csv', 'gzip': True}, status='succeeded', created_by=admin, run_after=timezone.now())
+        with self.settings(JOB_FILES_DIR=self.enterContext(tempfile.TemporaryDirectory(suffix='.d'))):
+            with open(export_path(job), 'wb') as out:
+                out.write(b'data')
+            response = self.client_for(admin).get(f'/medical/jobs/{job.pk}/result/')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('filename="patient_records.csv.gz"', response['Content-Disposition'])
+            response.close()
+
+
+class RecordVersionTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = f'/medical/patient_records/{self.patient.pk}/'
+        self.client = self.client_for(self.doctor.user)
+
+    def test_concurrent_saves_both_bump_the_version(self):
+        first = PatientRecord.objects.get(pk=self.record.pk)
+        second = PatientRecord.objects.get(pk=self.record.pk)
+        first.treatments = 'Beta blockers'
+        first.save()
+        second.observations = 'Tired'
+        second.save()
+        self.assertEqual((first.version, second.version), (2, 3))
+        self.assertEqual(PatientRecord.objects.get(pk=self.record.pk).version, 3)
+
+    def test_claim_record(self):
+        self.assertTrue(claim_record(self.record, 1))
+        self.assertEqual(PatientRecord.objects.get(pk=self.record.pk).version, 1)  # the claim changes nothing
+        PatientRecord.objects.get(pk=self.record.pk).save()
+        self.assertFalse(claim_record(self.record, 1))
+
+    def test_patch_with_if_match(self):
+        response = self.client.patch(self.url, {'record_id': self.record.pk, 'treatments': 'Rest'}, format='json', HTTP_IF_MATCH=f'"{self.record.pk}.1"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], f'"{self.record.pk}.2"')
+        # a client that still holds version 1 loses
+        response = self.client.patch(self.url, {'record_id': self.record.pk, 'treatments': 'Surgery'}, format='json', HTTP_IF_MATCH=f'"{self.record.pk}.1"')
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(response['ETag'], f'"{self.record.pk}.2"')
+        self.assertEqual(PatientRecord.objects.get(pk=self.record.pk).treatments, 'Rest')
+
+    def test_delete_with_stale_if_match(self):
+        PatientRecord.objects.get(pk=self.record.pk).save()
+        response = self.client.delete(self.url, {'record_id': self.record.pk}, format='json', HTTP_IF_MATCH=f'"{self.record.pk}.1"')
+        self.assertEqual(response.status_code, 412)
+        self.assertTrue(PatientRecord.objects.filter(pk=self.record.pk).exists())
+        response = self.client.delete(self.url, {'record_id': self.record.pk}, format='json', HTTP_IF_MATCH=f'"{self.record.pk}.2"')
+        self.assertEqual(response.status_code, 204)
+
+
+class ETagTests(HospitalTestCase):
+    def test_patient_detail(self):
+        client = self.client_for(self.patient.user)
+        url = f'/medical/patients/{self.patient.pk}/'
+        etag = client.get(url)['ETag']
+        self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.patient.user.first_name = 'Renamed'
+            self.patient.user.save()
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['user']['first_name'], 'Renamed')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_record_history(self):
+        client = self.client_for(self.doctor.user)
+        url = f'/medical/patient_records/{self.patient.pk}/'
+        etag = client.get(url)['ETag']
+        self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # not through save(): the change log still sees it
+        PatientRecord.objects.filter(pk=self.record.pk).update(treatments='Surgery')
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]['treatments'], 'Surgery')
+        self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_record_history_if_modified_since(self):
+        client = self.client_for(self.doctor.user)
+        url = f'/medical/patient_records/{self.patient.pk}/'
+        RecordChange.objects.filter(patient_id=self.patient.pk).update(changed_at=timezone.now() - datetime.timedelta(hours=1))
+        last_modified = client.get(url)['Last-Modified']
+        self.assertEqual(client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        # If-None-Match wins over it
+        self.assertEqual(client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+        PatientRecord.objects.filter(pk=self.record.pk).update(treatments='Surgery')
+        RecordChange.objects.filter(seq=RecordChange.objects.latest('seq').seq).update(changed_at=timezone.now() - datetime.timedelta(minutes=1))
+        response = client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['Last-Modified'], last_modified)
+
+    def test_patient_detail_if_modified_since(self):
+        client = self.client_for(self.patient.user)
+        url = f'/medical/patients/{self.patient.pk}/'
+        with mock.patch('medical.detail_cache.timezone.now', return_value=timezone.now() - datetime.timedelta(hours=1)):
+            last_modified = client.get(url)['Last-Modified']
+        self.assertEqual(client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.patient.user.first_name = 'Renamed'
+            self.patient.user.save()
+        self.assertEqual(client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 200)
+
+
+class SearchTests(HospitalTestCase):
+    url = '/medical/patient_records/search/'
+
+    def test_index_follows_writes(self):
+        self.assertEqual([record_id for record_id, _ in search_records('hypertension')], [self.record.pk])
+        PatientRecord.objects.filter(pk=self.record.pk).update(diagnostics='Arrhythmia')
+        self.assertEqual(search_records('hypertension'), [])
+        self.assertEqual([record_id for record_id, _ in search_records('arrhythmias')], [self.record.pk])  # stemmed
+
+    def test_doctors_search_their_department(self):
+        self.assertEqual(search_records('migraine', department_id=self.cardiology.pk), [])
+        client = self.client_for(self.doctor.user)
+        self.assertEqual([hit['record_id'] for hit in client.get(self.url, {'q': 'hypertension'}).json()['results']], [self.record.pk])
+        self.assertEqual(client.get(self.url, {'q': 'migraine'}).json()['results'], [])
+        admin = User.objects.create_superuser('admin', password='password')
+        self.assertEqual(len(self.client_for(admin).get(self.url, {'q': 'migraine'}).json()['results']), 1)
+
+    @override_settings(SEARCH_MAX_LIMIT=5)
+    def test_limit_is_clamped(self):
+        client = self.client_for(self.doctor.user)
+        self.assertEqual(client.get(self.url, {'q': 'rest', 'limit': 1000}).json()['limit'], 5)
+        self.assertEqual(client.get(self.url, {'q': 'rest', 'limit': 0}).json()['limit'], 1)
+        self.assertEqual(client.get(self.url, {'q': 'rest', 'limit': 'all'}).status_code, 400)
+        self.assertEqual(client.get(self.url).status_code, 400)
+
+
+class CounterTests(HospitalTestCase):
+    def counts(self):
+        cardiology = Department.objects.get(pk=self.cardiology.pk)
+        return (cardiology.doctor_count, cardiology.patient_count, cardiology.record_count, Doctor.objects.get(pk=self.doctor.pk).patient_count)
+
+    def test_counters_follow_writes_that_skip_signals(self):
+        self.assertEqual(self.counts(), (2, 1, 1, 1))
+        PatientRecord.objects.bulk_create([
+            PatientRecord(patient=self.patient, department=self.cardiology, diagnostics='x', observations='', treatments='') for _ in range(3)
+        ])
+        Patient.objects.filter(pk=self.unassigned.pk).update(department=self.cardiology, assigned_doctor=self.doctor)
+        Patient.objects.filter(pk=self.patient.pk).update(assigned_doctor=self.other_doctor)
+        self.assertEqual(self.counts(), (2, 2, 4, 1))
+        PatientRecord.objects.filter(patient=self.patient).delete()
+        self.other_doctor.delete()  # SET_NULL on its patients, by Django without signals per row
+        self.assertEqual(self.counts(), (1, 2, 0, 1))
+        self.assertEqual(set(reconcile_counters().values()), {0})
+
+    def test_save_does_not_write_counters_back(self):
+        stale = Department.objects.get(pk=self.cardiology.pk)
+        PatientRecord.objects.create(patient=self.patient, department=self.cardiology, diagnostics='x', observations='', treatments='')
+        stale.location = 'C'
+        stale.save()
+        self.assertEqual(Department.objects.get(pk=self.cardiology.pk).record_count, 2)
+        self.assertEqual(Department.objects.get(pk=self.cardiology.pk).location, 'C')
+
+    @skipUnless(connection.vendor == 'sqlite', 'restoring is for the tables SQLite rebuilds')
+    def test_restore_reinstalls_dropped_triggers(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE '%\\_count\\_%' ESCAPE '\\'")
+            names = [name for name, in cursor.fetchall()]
+            self.assertEqual(len(names), 15)
+            for name in names:
+                cursor.execute(f'DROP TRIGGER {name}')
+        restore_counter_triggers(connection)
+        PatientRecord.objects.create(patient=self.patient, department=self.cardiology, diagnostics='x', observations='', treatments='')
+        self.assertEqual(self.counts(), (2, 1, 2, 1))
+
+
+class RollupTests(HospitalTestCase):
+    def buckets(self):
+        return set(
+            RecordRollup.objects.filter(department=self.cardiology, record_count__gt=0)
+            .values_list('kind', 'value', 'record_count')
+        )
+
+    def test_rollups_follow_inserts_updates_and_deletes(self):
+        self.assertEqual(self.buckets(), {('total', '', 1), ('diagnosis', 'hypertension', 1), ('treatment', 'rest', 1)})
+        extra = PatientRecord.objects.create(patient=self.patient, department=self.cardiology, diagnostics=' HYPERTENSION ', observations='', treatments='Diet')
+        self.assertEqual(self.buckets(), {('total', '', 2), ('diagnosis', 'hypertension', 2), ('treatment', 'rest', 1), ('treatment', 'diet', 1)})
+        PatientRecord.objects.filter(pk=extra.pk).update(diagnostics='Arrhythmia')
+        self.assertIn(('diagnosis', 'arrhythmia', 1), self.buckets())
+        self.assertIn(('diagnosis', 'hypertension', 1), self.buckets())
+        extra.delete()
+        self.assertEqual(self.buckets(), {('total', '', 1), ('diagnosis', 'hypertension', 1), ('treatment', 'rest', 1)})
+
+    def test_backfill_matches_the_triggers(self):
+        PatientRecord.objects.create(patient=self.patient, department=self.neurology, diagnostics='Migraine', observations='', treatments='Rest')
+        maintained = set(RecordRollup.objects.filter(record_count__gt=0).values_list('department_id', 'kind', 'month', 'value', 'record_count'))
+        self.assertEqual(backfill_rollups(), 3)  # the record without a department is read, not counted
+        self.assertEqual(set(RecordRollup.objects.values_list('department_id', 'kind', 'month', 'value', 'record_count')), maintained)
+
+
+class ChangeFeedTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = self.client_for(self.patient.user)
+        self.url = f'/medical/patient_records/{self.patient.pk}/changes/'
+
+    def new_record(self, diagnostics):
+        return PatientRecord.objects.create(patient=self.patient, department=self.cardiology, diagnostics=diagnostics, observations='', treatments='')
+
+    def test_snapshot(self):
+        snapshot = self.client.get(self.url).json()
+        self.assertEqual([change['record_id'] for change in snapshot['changes']], [self.record.pk])
+        self.assertEqual(self.client.get(self.url, {'cursor': snapshot['cursor']}).json()['changes'], [])
+
+    def test_changes_are_folded_per_record(self):
+        cursor = self.client.get(self.url).json()['cursor']
+        created = self.new_record('Flu')
+        created.diagnostics = 'Cold'
+        created.save()
+        short_lived = self.new_record('Typo').pk
+        PatientRecord.objects.filter(pk=short_lived).delete()
+        PatientRecord.objects.filter(pk=self.record.pk).update(treatments='Surgery')
+        PatientRecord.objects.filter(patient=self.unassigned).update(treatments='elsewhere')  # another patient's
+
+        page = self.client.get(self.url, {'cursor': cursor}).json()
+        self.assertFalse(page['has_more'])
+        self.assertEqual(
+            [(change['record_id'], change['operation']) for change in page['changes']],
+            [(created.pk, 'created'), (short_lived, 'deleted'), (self.record.pk, 'updated')],
+        )
+        self.assertEqual(page['changes'][0]['record']['diagnostics'], 'Cold')
+        self.assertNotIn('record', page['changes'][1])
+        self.assertEqual(self.client.get(self.url, {'cursor': page['cursor']}).json()['changes'], [])
+
+    def test_pages(self):
+        cursor = self.client.get(self.url).json()['cursor']
+        records = [self.new_record(f'Visit {number}') for number in range(3)]
+        seen = []
+        while True:
+            page = self.client.get(self.url, {'cursor': cursor, 'limit': 2}).json()
+            seen += [change['record_id'] for change in page['changes']]
+            cursor = page['cursor']
+            if not page['has_more']:
+                break
+        self.assertEqual(seen, [record.pk for record in records])
+
+    def test_archival_is_not_a_change(self):
+        cursor = self.client.get(self.url).json()['cursor']
+        PatientRecord.objects.filter(pk=self.record.pk).update(created_date=timezone.now() - datetime.timedelta(days=800))
+        archive_records(older_than=timezone.now() - datetime.timedelta(days=365))
+        page = self.client.get(self.url, {'cursor': cursor}).json()
+        # the created_date update is a change, the move isn't a deletion
+        self.assertEqual([(change['record_id'], change['operation']) for change in page['changes']], [(self.record.pk, 'updated')])
+        self.assertEqual(page['changes'][0]['record']['record_id'], self.record.pk)
+
+
+class ArchiveTests(HospitalTestCase):
+    def test_move_keeps_counters_and_rollups(self):
+        PatientRecord.objects.filter(pk=self.record.pk).update(created_date=timezone.now() - datetime.timedelta(days=800))
+        rollups = set(RecordRollup.objects.values_list('department_id', 'kind', 'month', 'value', 'record_count'))
+        self.assertEqual(archive_records(older_than=timezone.now() - datetime.timedelta(days=365)), 1)
+
+        self.assertFalse(PatientRecord.objects.filter(pk=self.record.pk).exists())
+        self.assertEqual(ArchivedPatientRecord.objects.get(pk=self.record.pk).diagnostics, 'Hypertension')
+        self.assertEqual(Department.objects.get(pk=self.cardiology.pk).record_count, 1)
+        self.assertEqual(set(RecordRollup.objects.values_list('department_id', 'kind', 'month', 'value', 'record_count')), rollups)
+        self.assertEqual(set(reconcile_counters().values()), {0})
+        self.assertEqual(RecordChange.objects.filter(record_id=self.record.pk).latest('seq').operation, 'archived')
+
+        client = self.client_for(self.doctor.user)
+        url = f'/medical/patient_records/{self.patient.pk}/'
+        self.assertEqual(client.get(url).status_code, 404)
+        self.assertEqual([record['record_id'] for record in client.get(url, {'include_archived': 1}).json()], [self.record.pk])
+
+    def test_deleting_archived_records_updates_the_counters(self):
+        PatientRecord.objects.update(created_date=timezone.now() - datetime.timedelta(days=800))
+        archive_records(older_than=timezone.now() - datetime.timedelta(days=365))
+        ArchivedPatientRecord.objects.filter(patient=self.patient).delete()
+        self.assertEqual(Department.objects.get(pk=self.cardiology.pk).record_count, 0)
+        self.assertFalse(RecordRollup.objects.filter(department=self.cardiology, record_count__gt=0).exists())
+
+
+def failing(job):
+    raise RuntimeError('boom')
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        HANDLERS['test_failing'] = (failing, False)
+        self.addCleanup(HANDLERS.pop, 'test_failing')
+
+    def test_claim_order_and_exclusivity(self):
+        later = enqueue('reconcile_counters')
+        Job.objects.filter(pk=later.pk).update(run_after=timezone.now() + datetime.timedelta(hours=1))
+        first = enqueue('reconcile_counters')
+        second = enqueue('reconcile_counters')
+        self.assertEqual(claim_job('a').pk, first.pk)
+        self.assertEqual(claim_job('b').pk, second.pk)
+        self.assertIsNone(claim_job('c'))  # the last one isn't due
+        self.assertEqual(Job.objects.get(pk=first.pk).worker, 'a')
+        self.assertIsNone(run_job(Job.objects.get(pk=first.pk)))
+        self.assertEqual(Job.objects.get(pk=first.pk).status, 'succeeded')
+
+    @override_settings(JOB_RETRY_BACKOFF_SECONDS=30)
+    def test_failed_job_is_retried_with_backoff_then_failed(self):
+        job = enqueue('test_failing', max_attempts=2)
+        self.assertIn('RuntimeError: boom', run_job(claim_job('a')))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.error), ('queued', 1, 'RuntimeError: boom'))
+        self.assertGreater(job.run_after, timezone.now() + datetime.timedelta(seconds=25))
+        self.assertIsNone(claim_job('a'))  # backing off
+
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        run_job(claim_job('a'))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+
+    def test_stale_job_is_requeued(self):
+        job = enqueue('reconcile_counters')
+        claim_job('lost')
+        Job.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - datetime.timedelta(seconds=settings.JOB_STALE_SECONDS + 1))
+        self.assertEqual(requeue_stale_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker), ('queued', ''))
+        self.assertEqual(claim_job('b').pk, job.pk)
+
+
+@override_settings(DATABASE_REPLICAS=[REPLICA])
+class ReplicaRouterTests(HospitalTestCase):
+    databases = {'default', REPLICA}
+
+    def setUp(self):
+        super().setUp()
+        monitor.__init__()
+        self.addCleanup(monitor.__init__)
+        caches[settings.REPLICA_PIN_CACHE_ALIAS].clear()
+        admin = User.objects.create_superuser('admin', password='password')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=admin).key}')
+
+    def records(self):
+        return [record['record_id'] for record in self.client.get('/medical/patient_records/').json()['results']]
+
+    def decisions(self):
+        return {name: count for name, count in monitor.stats().items() if not name.endswith('_lag_seconds')}
+
+    def test_reads_go_to_the_replica(self):
+        self.assertEqual(self.records(), [])  # the replica has no records yet
+        self.assertEqual(self.decisions(), {f'read_{REPLICA}': 1})
+
+    def test_a_write_pins_the_client_to_the_primary(self):
+        response = self.client.post('/medical/patient_records/', {
+            'patient': self.patient.pk, 'diagnostics': 'Flu', 'observations': 'Fever', 'treatments': 'Rest', 'misc': '',
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.records()[0], response.json()['record_id'])
+        self.assertEqual(self.decisions(), {'read_write_method': 1, 'pins': 1, 'read_pinned': 1})
+        # another client isn't pinned
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=self.doctor.user).key}')
+        self.client.get('/medical/departments/')
+        self.assertEqual(self.decisions()[f'read_{REPLICA}'], 1)
+
+    def test_a_lagging_replica_is_skipped(self):
+        # the replica misses changes the primary logged an hour ago
+        RecordChange.objects.update(changed_at=timezone.now() - datetime.timedelta(hours=1))
+        self.assertEqual(len(self.records()), 2)
+        self.assertEqual(self.decisions(), {'read_replicas_behind': 1})
+        self.assertGreater(monitor.stats()[f'{REPLICA}_lag_seconds'], 3000)
+
+        metrics = self.client.get('/metrics').content.decode()
+        self.assertIn('read_replicas_behind', metrics)
+        self.assertIn(f'{REPLICA}_lag_seconds', metrics)
+
+    def test_checks(self):
+        shared = {**settings.CACHES, 'shared': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': '/tmp'}}
+        with self.settings(CACHES=shared, REPLICA_PIN_CACHE_ALIAS='shared', REPLICA_MAX_LAG_SECONDS=30, REPLICA_LAG_CHECK_SECONDS=5):
+            self.assertEqual(check_replicas(None), [])
+            with self.settings(REPLICA_PIN_SECONDS=10):
+                self.assertEqual([error.id for error in check_replicas(None)], ['medical.E001'])
+        with self.settings(REPLICA_PIN_CACHE_ALIAS='default'):
+            self.assertEqual([error.id for error in check_replicas(None)], ['medical.E002'])
@@ -7,11 +7,22 @@ urlpatterns = [
     path('patients/', views.PatientListView.as_view(), name='patient-list-create'),
     path('patients/<int:pk>/', views.patient_detail, name='patient-detail'),
     path('patient_records/', views.PatientRecordListCreateView.as_view(), name='patient-record-list-create'),
+    path('patient_records/bulk/', views.PatientRecordBulkCreateView.as_view(), name='patient-record-bulk-create'),
+    path('patient_records/export/', views.PatientRecordExportView.as_view(), name='patient-record-export'),
+    path('patient_records/search/', views.PatientRecordSearchView.as_view(), name='patient-record-search'),
     path('patient_records/<int:pk>/', views.patient_record_detail, name='patient-record-detail'),
+    path('patient_records/<int:pk>/changes/', views.PatientRecordChangesView.as_view(), name='patient-record-changes'),
     path('departments/', views.DepartmentListView.as_view(), name='department-list-create'),
+    path('departments/stats/', views.DepartmentStatsListView.as_view(), name='department-stats-list'),
     path('department/<int:pk>/doctors/', views.DepartmentDoctorsListView.as_view(), name='department-doctors'),
     path('department/<int:pk>/patients/', views.DepartmentPatientsListView.as_view(), name='department-patients'),
+    path('department/<int:pk>/stats/', views.DepartmentStatsView.as_view(), name='department-stats'),
+    path('department/<int:pk>/analytics/', views.DepartmentAnalyticsView.as_view(), name='department-analytics'),
     path('register/', views.RegisterView.as_view(), name='register'),
+    path('register/bulk/', views.RegisterBulkView.as_view(), name='register-bulk'),
     path('login/', views.LoginView.as_view(), name='login'),
     path('logout/', views.LogoutView.as_view(), name='logout'),
+    path('jobs/', views.JobListView.as_view(), name='job-list-create'),
+    path('jobs/<int:pk>/', views.JobDetailView.as_view(), name='job-detail'),
+    path('jobs/<int:pk>/result/', views.JobResultView.as_view(), name='job-result'),
 ]
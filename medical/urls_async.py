@@ -0,0 +1,15 @@
+"""
+medical.urls for the ASGI entry point: the same routes and names, GET on the views with an
+aget() is served on the event loop (medical/async_views.py). Their other methods, and every
+other view, still reach the sync views.
+"""
+from django.urls import path
+
+from .async_views import async_view
+from .urls import urlpatterns as sync_urlpatterns
+
+urlpatterns = [
+    path(str(pattern.pattern), async_view(pattern.callback), name=pattern.name)
+    if hasattr(getattr(pattern.callback, 'cls', None), 'aget') else pattern
+    for pattern in sync_urlpatterns
+]
@@ -1,4 +1,11 @@
+import hashlib
+import time
+from contextlib import contextmanager
+from django.utils.http import http_date, parse_http_date_safe
 from  rest_framework.views import exception_handler
+
+from .renderers import ORJSONRenderer
+
 def custom_exception_handler(exc, context):
     response = exception_handler(exc, context)
 
@@ -18,3 +25,82 @@ def custom_exception_handler(exc, context):
             }
  
     return response
+
+
+def make_etag(content):
+    """Strong ETag for a rendered payload (bytes)."""
+    return '"%s"' % hashlib.sha256(content).hexdigest()[:32]
+
+
+def prefers_async(request):
+    """True if the client sent Prefer: respond-async (RFC 7240): the view may answer 202 with a job."""
+    preferences = request.META.get('HTTP_PREFER', '').split(',')
+    return any(preference.split(';')[0].strip().lower() == 'respond-async' for preference in preferences)
+
+
+def etag_matches(request, etag):
+    """True if the request's If-None-Match header already holds this ETag."""
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    candidates = [tag.strip() for tag in header.split(',')]
+    return '*' in candidates or etag in candidates
+
+
+def _past_second(modified):
+    """modified (an aware datetime) in whole seconds, or None while that second isn't over."""
+    if modified is None or int(modified.timestamp()) >= int(time.time()):
+        return None
+    return int(modified.timestamp())
+
+
+def last_modified_header(modified):
+    """
+    {'Last-Modified': ...} for a representation last changed at modified. HTTP dates are whole
+    seconds, so it is only sent once that second is over: a second change in the same second
+    couldn't be told apart by If-Modified-Since.
+    """
+    seconds = _past_second(modified)
+    return {} if seconds is None else {'Last-Modified': http_date(seconds)}
+
+
+def not_modified(request, etag, modified=None):
+    """
+    True if a GET can be answered 304: If-None-Match holds the ETag or, for a request without
+    If-None-Match (it takes precedence), If-Modified-Since is no earlier than modified.
+    """
+    if request.META.get('HTTP_IF_NONE_MATCH'):
+        return etag_matches(request, etag)
+    seconds = _past_second(modified)
+    since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE'))
+    return seconds is not None and since is not None and seconds <= since
+
+
+def if_match_failed(request, etag):
+    """True if the request has an If-Match header holding neither this ETag nor *: answer 412."""
+    header = request.META.get('HTTP_IF_MATCH')
+    if not header:
+        return False
+    candidates = [tag.strip() for tag in header.split(',')]
+    return '*' not in candidates and etag not in candidates
+
+
+def representation_etag(data, renderer):
+    """Strong ETag for data before it is rendered: its JSON and the negotiated format (msgpack bytes differ)."""
+    return make_etag(ORJSONRenderer().render(data) + renderer.format.encode())
+
+
+@contextmanager
+def explicit_created_dates():
+    """
+    PatientRecord.created_date is auto_now_add, which overwrites any value given on insert.
+    Bulk loaders (seeding, benchmarks, imports of old data) wrap their inserts in this to keep theirs.
+    """
+    from .models import PatientRecord
+
+    field = PatientRecord._meta.get_field('created_date')
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = True
@@ -0,0 +1,44 @@
+"""
+ETags, conditional requests and optimistic concurrency for patient records.
+
+A record's ETag is its version ("<record_id>.<version>"), which every save() bumps. PATCH and
+DELETE on patient_records/<pk>/ honor If-Match with it: the write only happens if the
+record is still at that version, a lost update becomes a 412. claim_record() makes that check
+and the write atomic: it locks the record's row at the expected version until the transaction
+ends, so of two writers holding the same ETag only the first one writes.
+
+A patient's record history gets an ETag from the seq of the patient's latest record change
+(medical/changes.py) instead of from the rendered list, so a poll that hasn't missed anything
+costs a single index lookup and an empty 304. The change log sees every insert, update and
+delete, including the ones that skip save() (queryset.update(), the SET_NULL when a department
+is deleted) and so don't bump versions. Its Last-Modified is the time of that change, the
+record's own updated_at after a PATCH, and If-Modified-Since is answered from it when the
+request has no If-None-Match. Renaming the patient's user changes the ETag but isn't a record
+change: If-Modified-Since clients see the new patient_name with the next record write.
+"""
+from django.db.models import F
+
+from .models import PatientRecord
+from .utils import make_etag
+
+def record_etag(record):
+    return f'"{record.record_id}.{record.version}"'
+
+
+def history_etag(request, patient, seq, renderer):
+    """
+    ETag of a history list, from the seq of the patient's latest record change, plus what else
+    the rendered list depends on: the query string (range, ordering), the patient's username
+    and the negotiated format.
+    """
+    key = f"{seq}|{patient.user.username}|{request.META.get('QUERY_STRING', '')}|{renderer.format}"
+    return make_etag(key.encode())
+
+
+def claim_record(record, expected_version):
+    """
+    Inside a transaction: True if the record is still at expected_version, and holds its row
+    lock (a no-op UPDATE) until the transaction ends, so a concurrent writer that read the
+    same version waits here and then gets False.
+    """
+    return PatientRecord.objects.filter(pk=record.pk, version=expected_version).update(version=F('version')) == 1
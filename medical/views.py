@@ -1,36 +1,133 @@
+import datetime
+import os
 
-
-from rest_framework.authtoken.models import Token
 from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework import generics
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
 from rest_framework.response import Response
-from rest_framework.exceptions import PermissionDenied, NotFound
+from rest_framework.exceptions import NotFound
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.http import FileResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils import timezone
 
 
 from .permissions import IsDoctor, IsRelevantPatientOrDoctor, IsDoctorInSameDepartment, IsRelevantPatientOrDoctorForRcords, IsDoctorInDepartment
-from .models import Doctor, Patient, PatientRecord, Department
-from .serializers import DoctorSerializer, LoginSerializer, PatientSerializer, PatientRecordSerializer, DepartmentSerializer, RegisterSerializer
-
-
+from .models import Doctor, Job, Patient, PatientRecord, Department
+from .serializers import DoctorSerializer, LoginSerializer, PatientSerializer, PatientRecordSerializer, DepartmentSerializer, RegisterSerializer, DepartmentStatsSerializer, DepartmentDoctorStatsSerializer, JobSerializer
+from .pagination import PatientRecordCursorPagination
+from .principal import get_principal
+from .authentication import revoke_token
+from .async_views import async_get
+from .catalogue import aget_department_catalogue, get_department_catalogue
+from .detail_cache import detail_cache
+from .utils import etag_matches, if_match_failed, last_modified_header, not_modified, prefers_async, representation_etag
+from .versioning import claim_record, history_etag, record_etag
+from .parsers import CSVParser, MessagePackParser, NDJSONParser, ORJSONParser
+from .bulk import ingest_patient_records
+from .changes import alatest_change, latest_change, record_changes, record_snapshot
+from .archive import include_archived, merge_history, patient_history
+from .jobs import MAINTENANCE_KINDS, enqueue, export_path
+from .registration import register_users
+from .export import EXPORT_FORMATS, stream_export
+from .filters import CreatedDateRangeFilter, RecordOrderingFilter
+from .search import search_records
+from .projection import compile_projection
+from .rollups import add_months, department_analytics, month_start
+
+
+
+
+class EagerLoadingViewMixin:
+    """
+    Applies the serializer's declared query plan (select_related/prefetch_related)
+    to the list queryset, so the number of queries doesn't grow with the page size.
+    """
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        return self.get_serializer_class().setup_eager_loading(queryset)
+
+
+class ProjectedListViewMixin:
+    """
+    Serves list GETs from values_list() rows through the serializer's compiled projection
+    (medical/projection.py) instead of model instances, with the same JSON.
+    ?fields=id,user.username returns only those fields.
+
+    alist() / aget() are the same for ASGI (medical/async_views.py); DRF's paginator is
+    synchronous, the page is fetched in a sync_to_async hop.
+    """
+
+    def list_rows(self, request):
+        """The filtered rows to page through, and the function rendering a page of them."""
+        queryset = self.filter_queryset(self.get_queryset())
+        projection = compile_projection(self.get_serializer_class())
+        if projection is None:
+            return queryset, lambda rows: self.get_serializer(rows, many=True).data
+        projection = projection.only(request.query_params.get('fields'))
+        # the cursor is read from the last row, its ordering columns are selected even if not rendered
+        ordering = self.paginator.get_ordering(request, queryset, self) if self.paginator else ()
+        return projection.values(queryset, extra=[field.lstrip('-') for field in ordering]), projection.render
 
+    def list(self, request, *args, **kwargs):
+        rows, render = self.list_rows(request)
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(render(page))
+        return Response(render(rows))
+
+    async def alist(self, request, *args, **kwargs):
+        rows, render = self.list_rows(request)
+        page = await sync_to_async(self.paginate_queryset)(rows)
+        if page is not None:
+            return self.get_paginated_response(render(page))
+        return Response(render([row async for row in rows]))
+
+    async def aget(self, request, *args, **kwargs):
+        return await self.alist(request, *args, **kwargs)
+
+
+class DepartmentMembersListMixin:
+    """
+    GET on a department's doctors / patients: a 404 when the department doesn't exist or has
+    none, else the list. missing_department and no_members are the 404 messages.
+    """
+    missing_department = "Department with ID {department_id} does not exist."
+    no_members = None
+
+    def not_found(self, message):
+        return Response({"error": message.format(department_id=self.kwargs['pk'])}, status=status.HTTP_404_NOT_FOUND)
 
+    def get(self, request, *args, **kwargs):
+        if not Department.objects.filter(pk=self.kwargs['pk']).exists():
+            return self.not_found(self.missing_department)
+        if not self.get_queryset().exists():
+            return self.not_found(self.no_members)
+        return self.list(request, *args, **kwargs)
 
+    async def aget(self, request, *args, **kwargs):
+        if not await Department.objects.filter(pk=self.kwargs['pk']).aexists():
+            return self.not_found(self.missing_department)
+        if not await self.get_queryset().aexists():
+            return self.not_found(self.no_members)
+        return await self.alist(request, *args, **kwargs)
 
 
 # Doctor Views
-class DoctorListView(generics.ListAPIView):
+class DoctorListView(ProjectedListViewMixin, EagerLoadingViewMixin, generics.ListAPIView):
     #queryset = Doctor.objects.all()
     serializer_class = DoctorSerializer
     permission_classes = [IsAuthenticated, IsDoctor]
 
     def get_queryset(self):
-        user = self.request.user
-        print(f"User: {user.username}, Is Superuser: {user.is_superuser}, Groups: {user.groups.all()}")
-        if user.is_superuser or user.groups.filter(name='Doctor').exists():
-            return Doctor.objects.all().only('id', 'user', 'department')
+        principal = get_principal(self.request)
+        if principal.is_superuser or principal.in_group('Doctor'):
+            return Doctor.objects.all()
         # If the user doesn't have the correct permissions, return an empty queryset
         return Doctor.objects.none()
 
@@ -40,8 +137,15 @@ def doctor_detail(request, pk):
     
     print("Entering doctor_detail view")
 
+    if request.method == 'GET':
+        # served from the detail cache, see medical/detail_cache.py
+        doctor = detail_cache.get('doctor', pk)
+        if doctor is None:
+            return Response({'detail': 'Doctor not found.'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(doctor.data)
+
     try:
-        doctor = Doctor.objects.get(pk=pk)
+        doctor = DoctorSerializer.setup_eager_loading(Doctor.objects.all()).get(pk=pk)
     except Doctor.DoesNotExist:
         print("Doctor not found")
         return Response({'detail': 'Doctor not found.'}, status=status.HTTP_404_NOT_FOUND)
@@ -51,11 +155,7 @@ def doctor_detail(request, pk):
 
     # print(f"Request user: {request_user_username}, Doctor user: {doctor_user_username}")
 
-    if request.method == 'GET':
-        serializer = DoctorSerializer(doctor)
-        return Response(serializer.data)
-
-    elif request.method == 'PATCH':
+    if request.method == 'PATCH':
         print("PUT request received")
         if request.user == doctor.user or request.user.is_superuser:
             serializer = DoctorSerializer(doctor, data=request.data, partial=True)
@@ -70,10 +170,7 @@ def doctor_detail(request, pk):
             user = doctor.user
 
             # Delete the token associated with the user
-            try:
-                token = Token.objects.get(user=user)
-                token.delete()
-            except Token.DoesNotExist:
+            if not revoke_token(user):
                 print("Token not found for the user")
 
             doctor.delete()
@@ -86,16 +183,15 @@ def doctor_detail(request, pk):
     return Response({'detail': 'you can only change your data only so please send your id if you want to update your records.'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
 # Patient Views
-class PatientListView(generics.ListAPIView):
+class PatientListView(ProjectedListViewMixin, EagerLoadingViewMixin, generics.ListAPIView):
     #queryset = Patient.objects.all()
     serializer_class = PatientSerializer
     permission_classes = [IsAuthenticated, IsDoctor]
 
     def get_queryset(self):
-        user = self.request.user
-        print(f"User: {user.username}, Is Superuser: {user.is_superuser}, Groups: {user.groups.all()}")
-        if user.is_superuser or user.groups.filter(name='Doctor').exists():
-            return Patient.objects.all().only('id', 'user')
+        principal = get_principal(self.request)
+        if principal.is_superuser or principal.in_group('Doctor'):
+            return Patient.objects.all()
         # If the user doesn't have the correct permissions, return an empty queryset
         return Patient.objects.none()
 
@@ -103,22 +199,22 @@ class PatientListView(generics.ListAPIView):
 @api_view(['GET', 'PATCH', 'DELETE'])
 @permission_classes([IsAuthenticated,IsRelevantPatientOrDoctor])
 def patient_detail(request, pk):
-    try:
-        patient = Patient.objects.get(pk=pk)
-    except Patient.DoesNotExist:
-        return Response({"error": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
-
-    # Check permissions for the specific object
-    if not IsRelevantPatientOrDoctor().has_object_permission(request, None, patient):
-        return Response({"error": "You do not have permission to perform this action.OR It may be not your patient IF YOU ARE DOCTOR OR YOU ARE PATIENT and trying to get another patient record"}, status=status.HTTP_403_FORBIDDEN)
-
     # GET request: Return patient details
     if request.method == 'GET':
-        serializer = PatientSerializer(patient)
-        return Response(serializer.data)
-    
+        # served from the detail cache (medical/detail_cache.py), it has the ids the permission check reads
+        patient = detail_cache.get('patient', pk)
+        assignment = current_assignment(request, patient)
+        if assignment is not None:
+            patient.assigned_doctor_id = assignment.first()
+        return patient_detail_response(request, patient)
+
+    patient = PatientSerializer.setup_eager_loading(Patient.objects.all()).filter(pk=pk).first()
+    denied = patient_access_denied(request, patient)
+    if denied:
+        return denied
+
     # PUT request: Update patient details
-    elif request.method == 'PATCH':
+    if request.method == 'PATCH':
         serializer = PatientSerializer(patient, data=request.data, partial=True, context={'request': request})
         if serializer.is_valid():
             serializer.save()
@@ -128,27 +224,29 @@ def patient_detail(request, pk):
     # DELETE request: Delete patient
     elif request.method == 'DELETE':
         user = patient.user
+        principal = get_principal(request)
         
         # Check if the requesting user is authorized to delete this patient
-        if request.user.is_superuser:
+        if principal.is_superuser:
             # Superusers can delete any patient
             pass
-        elif request.user.groups.filter(name='Patient').exists():
+        elif principal.in_group('Patient'):
             # Patients can only delete their own profile
-            if request.user != user:
+            if principal.user_id != user.pk:
                 return Response({"error": "You do not have permission to delete this profile."}, status=status.HTTP_403_FORBIDDEN)
-        elif request.user.groups.filter(name='Doctor').exists():
+        elif principal.in_group('Doctor'):
             # Doctors can only delete their assigned patients
-            if request.user != patient.assigned_doctor.user:
+            if not principal.is_assigned_doctor_of(patient):
                 return Response({"error": "You do not have permission to delete this patient."}, status=status.HTTP_403_FORBIDDEN)
         else:
             return Response({"error": "Permission denied."}, status=status.HTTP_403_FORBIDDEN)
 
+        if prefers_async(request):
+            # a long history is deleted in batches by a worker
+            return job_accepted_response(request, enqueue('delete_patient', {'patient_id': patient.pk}, user=request.user))
+
         # Delete associated token
-        try:
-            token = Token.objects.get(user=user)
-            token.delete()
-        except Token.DoesNotExist:
+        if not revoke_token(user):
             print("Token not found for the user")
         
         # Delete the user and patient
@@ -156,23 +254,169 @@ def patient_detail(request, pk):
         patient.delete()
         return Response({"message": "Patient deleted successfully"}, status=status.HTTP_204_NO_CONTENT)
 
+
+@async_get(patient_detail)
+async def apatient_detail(request, pk):
+    patient = await detail_cache.aget('patient', pk)
+    assignment = current_assignment(request, patient)
+    if assignment is not None:
+        patient.assigned_doctor_id = await assignment.afirst()
+    return patient_detail_response(request, patient)
+
+
+def current_assignment(request, patient):
+    """
+    For a cached patient, the query of its current assigned_doctor_id when the caller's access
+    depends on it (a doctor other than the patient), else None. The entry's can predate a
+    reassignment: its invalidation may not have reached this worker's cache yet.
+    """
+    principal = get_principal(request)
+    if patient is None or principal.is_superuser or patient.user_id == principal.user_id or not principal.in_group('Doctor'):
+        return None
+    return Patient.objects.filter(pk=patient.pk).values_list('assigned_doctor_id', flat=True)
+
+
+def patient_access_denied(request, patient):
+    """The 404 / 403 Response when the caller may not see this patient, else None."""
+    if patient is None:
+        return Response({"error": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
+    # Check permissions for the specific object
+    if not IsRelevantPatientOrDoctor().has_object_permission(request, None, patient):
+        return Response({"error": "You do not have permission to perform this action.OR It may be not your patient IF YOU ARE DOCTOR OR YOU ARE PATIENT and trying to get another patient record"}, status=status.HTTP_403_FORBIDDEN)
+    return None
+
+
+def patient_detail_response(request, patient):
+    """
+    A patient's cached representation (or None), or a 304 when If-None-Match holds its ETag or
+    If-Modified-Since is no earlier than the representation.
+    """
+    denied = patient_access_denied(request, patient)
+    if denied:
+        return denied
+    headers = {'ETag': representation_etag(patient.data, request.accepted_renderer), 'Cache-Control': 'no-cache', **last_modified_header(patient.modified)}
+    if not_modified(request, headers['ETag'], patient.modified):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(patient.data, headers=headers)
+
 # PatientRecord Views
 
 
-class PatientRecordListCreateView(generics.ListCreateAPIView):
+class PatientRecordListCreateView(ProjectedListViewMixin, EagerLoadingViewMixin, generics.ListCreateAPIView):
     queryset = PatientRecord.objects.all()
     serializer_class = PatientRecordSerializer
     permission_classes = [IsAuthenticated, IsDoctorInSameDepartment]
+    pagination_class = PatientRecordCursorPagination
+    filter_backends = [CreatedDateRangeFilter, RecordOrderingFilter]
 
     def get_queryset(self):
         # Filter records by the doctor's department
-        user = self.request.user
-        return PatientRecord.objects.filter(department=user.doctor.department)
+        principal = get_principal(self.request)
+        if principal.is_doctor:
+            return PatientRecord.objects.filter(department_id=principal.department_id)
+        return PatientRecord.objects.all()  # superuser without a doctor profile
 
     def perform_create(self, serializer):
-        user = self.request.user
         # Automatically assign the department based on the doctor's department
-        serializer.save(department=user.doctor.department)
+        serializer.save(department_id=get_principal(self.request).department_id)
+
+
+
+class PatientRecordBulkCreateView(APIView):
+    """
+    Creates many records in one request. Accepts a JSON array, NDJSON (application/x-ndjson) or
+    a MessagePack array, returns one result per item so a bad item doesn't reject the whole batch.
+    With Prefer: respond-async, a 202 and a job whose result holds the same.
+    """
+    permission_classes = [IsAuthenticated, IsDoctorInSameDepartment]
+    parser_classes = [ORJSONParser, MessagePackParser, NDJSONParser]
+
+    def post(self, request, *args, **kwargs):
+        items = request.data
+        if not isinstance(items, list):
+            return Response({"error": "Expected a list of records."}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > settings.BULK_RECORDS_MAX_ITEMS:
+            return Response({"error": f"Too many records, send at most {settings.BULK_RECORDS_MAX_ITEMS} per request."}, status=status.HTTP_400_BAD_REQUEST)
+        if prefers_async(request):
+            return job_accepted_response(request, enqueue('ingest_patient_records', {'user_id': request.user.pk, 'items': items}, user=request.user))
+
+        results = ingest_patient_records(items, get_principal(request))
+        created = sum(1 for result in results if result['status'] == 'created')
+        return Response({
+            'created': created,
+            'failed': len(results) - created,
+            'results': results,
+        }, status=status.HTTP_201_CREATED if created else status.HTTP_400_BAD_REQUEST)
+
+
+
+class PatientRecordExportView(APIView):
+    """
+    Streams every record of the caller's department as NDJSON (default) or CSV.
+    ?output=csv picks CSV, ?gzip=1 compresses the stream. Superusers export all departments
+    or one with ?department=<id>. With Prefer: respond-async a job writes the file instead,
+    downloaded from jobs/<id>/result/.
+    """
+    permission_classes = [IsAuthenticated, IsDoctorInSameDepartment]
+
+    def get(self, request, *args, **kwargs):
+        export_format = request.query_params.get('output', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            return Response({"error": f"Unknown output format, use one of {list(EXPORT_FORMATS)}."}, status=status.HTTP_400_BAD_REQUEST)
+        gzip = request.query_params.get('gzip') in ('1', 'true')
+
+        principal = get_principal(request)
+        if principal.is_doctor:
+            department_id = principal.department_id
+        else:
+            department_id = request.query_params.get('department')
+            if department_id is not None:
+                try:
+                    department_id = int(department_id)
+                except ValueError:
+                    return Response({"error": "department must be a department id."}, status=status.HTTP_400_BAD_REQUEST)
+        if prefers_async(request):
+            params = {'export_format': export_format, 'department_id': department_id, 'gzip': gzip}
+            return job_accepted_response(request, enqueue('export_patient_records', params, user=request.user))
+
+        # a .gz file, not a Content-Encoding: clients would decompress it and keep the .gz name
+        response = StreamingHttpResponse(
+            stream_export(export_format, department_id=department_id, gzip=gzip, chunk_size=settings.EXPORT_CHUNK_SIZE),
+            content_type='application/gzip' if gzip else 'text/csv' if export_format == 'csv' else 'application/x-ndjson',
+        )
+        filename = f'patient_records.{export_format}' + ('.gz' if gzip else '')
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+
+
+class PatientRecordSearchView(APIView):
+    """
+    Ranked full-text search over diagnostics, observations and treatments (?q=arrhythmia).
+    Doctors only search their own department, like the record list. Paged with ?limit= / ?offset=.
+    """
+    permission_classes = [IsAuthenticated, IsDoctorInSameDepartment]
+
+    def get(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({"error": "The q parameter is required."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = min(max(int(request.query_params.get('limit', 20)), 1), settings.SEARCH_MAX_LIMIT)
+            offset = max(int(request.query_params.get('offset', 0)), 0)
+        except ValueError:
+            return Response({"error": "limit and offset must be integers."}, status=status.HTTP_400_BAD_REQUEST)
+
+        principal = get_principal(request)
+        department_id = principal.department_id if principal.is_doctor else None
+        hits = search_records(query, department_id=department_id, limit=limit, offset=offset)
+
+        records = PatientRecordSerializer.setup_eager_loading(PatientRecord.objects.all()).in_bulk([record_id for record_id, _ in hits])
+        hits = [(records[record_id], rank) for record_id, rank in hits if record_id in records]
+        data = PatientRecordSerializer([record for record, _ in hits], many=True).data
+        for item, (_, rank) in zip(data, hits):
+            item['rank'] = round(rank, 6)
+        return Response({'query': query, 'limit': limit, 'offset': offset, 'results': data})
 
 
 
@@ -182,64 +426,45 @@ def patient_record_detail(request, pk):
     try:
         print("in patient_record_detail")
         # Fetch the patient
-        patient = Patient.objects.get(pk=pk)
-        user = request.user
+        patient = Patient.objects.select_related('user').get(pk=pk)
+        principal = get_principal(request)
+        # Superusers can work on any patient, doctors only on their own patients
+        doctor_filter = {} if principal.is_superuser else {'patient__assigned_doctor_id': principal.doctor_id}
         
         if request.method == 'GET':
-            #print("in get req")
-            # Fetch all records for the specific patient
-            if request.user.is_superuser or hasattr(user, 'patient'):
-                #print("i ama patient")
-                if request.user.patient == patient or request.user.is_superuser:
-                    #print("i ama patient who is logged in")
-                    records = PatientRecord.objects.filter(patient=patient)
-                    if records.exists():
-                        print("here id records if patient", records)
-                        serializer = PatientRecordSerializer(records, many=True)
-                        return Response(serializer.data)
-                    else:
-                        return Response({"error": "Record not found."}, status=status.HTTP_404_NOT_FOUND)
-                else:
-                    return Response({"error": "Record not found because you are sending others id."}, status=status.HTTP_404_NOT_FOUND)
-                    
-            
-            elif request.user.is_superuser or hasattr(user, 'doctor'):
-                if patient.assigned_doctor == request.user.doctor or request.user.is_superuser:
-                    doctor = request.user.doctor
-                    records = PatientRecord.objects.filter(patient=patient, patient__assigned_doctor=doctor)
-                    if records.exists():
-                        print("here id records if patient", records)
-                        serializer = PatientRecordSerializer(records, many=True)
-                        return Response(serializer.data)
-                    else:
-                        return Response({"error": "Record not found ."}, status=status.HTTP_404_NOT_FOUND)
-                    
-                else:
-                    return Response({"error": "Record not found because you are sending others id who is not you patient."}, status=status.HTTP_404_NOT_FOUND)
-            else:
-                 return Response({"error": "You do not have permission to view this record."}, status=status.HTTP_403_FORBIDDEN)
-            
+            # ?created_after= / ?created_before= / ?ordering= narrow the history
+            access = record_history_access(principal, patient)
+            if isinstance(access, Response):
+                return access
+            filters, not_found = access
+            return record_history_response(request, patient, patient_history(patient, request.query_params, **filters), not_found)
 
 
         elif request.method == 'PATCH':
-            if patient.assigned_doctor == request.user.doctor or request.user.is_superuser:
-                doctor = request.user.doctor
+            if principal.is_assigned_doctor_of(patient) or principal.is_superuser:
                 print("in patch")
             # Extract record ID from the request data
                 record_id = request.data.get('record_id')
                 try:
                     # Fetch the specific record for the patient
-                    record = PatientRecord.objects.get(pk=record_id, patient=patient, patient__assigned_doctor=doctor)
+                    record = PatientRecordSerializer.setup_eager_loading(PatientRecord.objects.all()).get(pk=record_id, patient=patient, **doctor_filter)
                 except PatientRecord.DoesNotExist:
                     return Response({"error": "Record not found or does not belong to this patient or you are not his/her doctor."}, status=status.HTTP_404_NOT_FOUND)
 
+                if if_match_failed(request, record_etag(record)):
+                    return record_changed_response(record)
+
                 # Update the record
                 serializer = PatientRecordSerializer(record, data=request.data, partial=True, context={'request': request})
                 print("serializer created")
                 if serializer.is_valid(raise_exception=True):
                     print("validated data")
-                    serializer.save()
-                    return Response(serializer.data)
+                    with transaction.atomic():
+                        # If-Match: nobody may save the record between our read and our write
+                        if request.META.get('HTTP_IF_MATCH') and not claim_record(record, record.version):
+                            return record_changed_response(record)
+                        serializer.save()
+                    return Response(serializer.data, headers={'ETag': record_etag(record), **last_modified_header(record.updated_at)})
                 return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
             else:
                     return Response({"error": "Record not found because you are sending others id who is not you patient."}, status=status.HTTP_404_NOT_FOUND)
@@ -247,20 +472,25 @@ def patient_record_detail(request, pk):
 
         elif request.method == 'DELETE':
             print("in delete")
-            if patient.assigned_doctor == request.user.doctor or request.user.is_superuser:
+            if principal.is_assigned_doctor_of(patient) or principal.is_superuser:
                 print("i am valid doctor")
-                doctor = request.user.doctor
             # Extract record ID from the request data
                 record_id = request.data.get('record_id')
                 try:
                     # Fetch the specific record for the patient
                     print("inside delete try")
-                    record = PatientRecord.objects.get(pk=record_id, patient=patient, patient__assigned_doctor=doctor)
+                    record = PatientRecord.objects.get(pk=record_id, patient=patient, **doctor_filter)
                 except PatientRecord.DoesNotExist:
                     return Response({"error": "Record not found or does not belong to this patient or you are not his/her doctor."}, status=status.HTTP_404_NOT_FOUND)
 
+                if if_match_failed(request, record_etag(record)):
+                    return record_changed_response(record)
+
                 # Delete the record
-                record.delete()
+                with transaction.atomic():
+                    if request.META.get('HTTP_IF_MATCH') and not claim_record(record, record.version):
+                        return record_changed_response(record)
+                    record.delete()
                 return Response({
                 'success': True,
                 'message': 'Patient record successfully deleted.'
@@ -272,6 +502,107 @@ def patient_record_detail(request, pk):
         return Response({"error": "Patient not found."}, status=status.HTTP_404_NOT_FOUND)
 
 
+@async_get(patient_record_detail)
+async def apatient_record_detail(request, pk):
+    patient = await Patient.objects.select_related('user').filter(pk=pk).afirst()
+    if patient is None:
+        return Response({"error": "Patient not found."}, status=status.HTTP_404_NOT_FOUND)
+    access = record_history_access(get_principal(request), patient)
+    if isinstance(access, Response):
+        return access
+    filters, not_found = access
+    history = patient_history(patient, request.query_params, **filters)
+    latest = await alatest_change(patient.pk)
+    headers = record_history_headers(request, patient, latest)
+    if not_modified(request, headers['ETag'], latest[1]):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return record_history_list_response(request, [[record async for record in queryset] for queryset in history], not_found, headers)
+
+
+def record_history_access(principal, patient):
+    """
+    What the caller may read of a patient's history: (the filters narrowing it, the message of
+    the 404 for an empty one), or the error Response if nothing.
+    """
+    if principal.is_superuser or principal.is_patient:
+        if principal.patient_id == patient.pk or principal.is_superuser:
+            return {}, "Record not found."
+        return Response({"error": "Record not found because you are sending others id."}, status=status.HTTP_404_NOT_FOUND)
+    if principal.is_doctor:
+        if principal.is_assigned_doctor_of(patient):
+            return {'patient__assigned_doctor_id': principal.doctor_id}, "Record not found ."
+        return Response({"error": "Record not found because you are sending others id who is not you patient."}, status=status.HTTP_404_NOT_FOUND)
+    return Response({"error": "You do not have permission to view this record."}, status=status.HTTP_403_FORBIDDEN)
+
+
+def record_history_headers(request, patient, latest):
+    """The history's ETag and Last-Modified, from the patient's latest record change (see medical/versioning.py)."""
+    seq, changed_at = latest
+    return {'ETag': history_etag(request, patient, seq, request.accepted_renderer), 'Cache-Control': 'no-cache', **last_modified_header(changed_at)}
+
+
+def record_history_response(request, patient, history, not_found):
+    """
+    The history list (the querysets of archive.patient_history()), or a 304 when If-None-Match
+    holds its ETag or If-Modified-Since is no earlier than the latest change.
+    """
+    latest = latest_change(patient.pk)
+    headers = record_history_headers(request, patient, latest)
+    if not_modified(request, headers['ETag'], latest[1]):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return record_history_list_response(request, [list(queryset) for queryset in history], not_found, headers)
+
+
+def record_history_list_response(request, results, not_found, headers):
+    # one query per table instead of exists() + the list
+    records = merge_history(results, request.query_params)
+    if not records:
+        return Response({"error": not_found}, status=status.HTTP_404_NOT_FOUND)
+    return Response(PatientRecordSerializer(records, many=True).data, headers=headers)
+
+
+def record_changed_response(record):
+    """412 for an If-Match that no longer holds, with the record's current ETag."""
+    record = PatientRecord.objects.filter(pk=record.pk).only('version').first()
+    if record is None:
+        return Response({"error": "The record was deleted since you read it."}, status=status.HTTP_412_PRECONDITION_FAILED)
+    return Response(
+        {"error": "The record was changed since you read it, fetch it again.", "version": record.version},
+        status=status.HTTP_412_PRECONDITION_FAILED,
+        headers={'ETag': record_etag(record)},
+    )
+
+
+class PatientRecordChangesView(APIView):
+    """
+    What changed in a patient's records since ?cursor= (see medical/changes.py): created and
+    updated records with their data, deleted ones as tombstones. Without a cursor, every record
+    and the cursor to poll from. Same access as the history: the patient, their doctor, superusers.
+    """
+    permission_classes = [IsAuthenticated, IsRelevantPatientOrDoctorForRcords]
+
+    def get(self, request, pk):
+        try:
+            cursor = request.query_params.get('cursor')
+            cursor = None if cursor in (None, '') else int(cursor)
+            limit = int(request.query_params.get('limit', settings.RECORD_CHANGES_PAGE_SIZE))
+        except ValueError:
+            return Response({"error": "cursor and limit must be integers."}, status=status.HTTP_400_BAD_REQUEST)
+        if not 1 <= limit <= settings.RECORD_CHANGES_MAX_PAGE_SIZE:
+            return Response({"error": f"limit must be between 1 and {settings.RECORD_CHANGES_MAX_PAGE_SIZE}."}, status=status.HTTP_400_BAD_REQUEST)
+
+        patient = Patient.objects.filter(pk=pk).first()
+        if patient is None:
+            return Response({"error": "Patient not found."}, status=status.HTTP_404_NOT_FOUND)
+        principal = get_principal(request)
+        if not (principal.is_superuser or principal.patient_id == patient.pk or principal.is_assigned_doctor_of(patient)):
+            return Response({"error": "Record not found because you are sending others id who is not you patient."}, status=status.HTTP_404_NOT_FOUND)
+
+        if cursor is None:
+            return Response(record_snapshot(patient.pk, include_archived(request.query_params)))
+        return Response(record_changes(patient.pk, cursor, limit))
+
+
 # Department Views
 from rest_framework.response import Response
 
@@ -279,75 +610,102 @@ class DepartmentListView(generics.ListAPIView):
     queryset = Department.objects.all()
     serializer_class = DepartmentSerializer
     permission_classes = [AllowAny]
+    pagination_class = None  # small catalogue, the landing page expects a plain list
 
     def list(self, request, *args, **kwargs):
         try:
-            return super().list(request, *args, **kwargs)
+            return self.catalogue_response(request, get_department_catalogue())
+        except Exception as e:
+            return self.failed_response(e)
+
+    async def aget(self, request, *args, **kwargs):
+        try:
+            return self.catalogue_response(request, await aget_department_catalogue())
         except Exception as e:
-            return Response({'error': 'An error occurred while fetching departments.', 'details': str(e)}, status=500)
+            return self.failed_response(e)
+
+    @staticmethod
+    def catalogue_response(request, catalogue):
+        headers = {'ETag': catalogue['etag'], 'Cache-Control': 'no-cache'}
+        if etag_matches(request, catalogue['etag']):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(catalogue['data'], headers=headers)
 
+    @staticmethod
+    def failed_response(e):
+        return Response({'error': 'An error occurred while fetching departments.', 'details': str(e)}, status=500)
 
 
 
-class DepartmentDoctorsListView(generics.ListAPIView):
+
+class DepartmentDoctorsListView(DepartmentMembersListMixin, ProjectedListViewMixin, EagerLoadingViewMixin, generics.ListAPIView):
     serializer_class = DoctorSerializer
     permission_classes = [IsAuthenticated, IsDoctorInDepartment]
+    missing_department = "Department with the specified ID {department_id} does not exist."
+    no_members = "No doctors found in department with ID {department_id}."
 
     def get_queryset(self):
         department_id = self.kwargs['pk']  # Get department ID from the URL
         return Doctor.objects.filter(department=department_id)
 
-    def get(self, request, *args, **kwargs):
-        department_id = self.kwargs['pk']
-        if not Department.objects.filter(pk=department_id).exists():
-            return Response(
-                {"error": "Department with the specified ID {department_id}does not exist."},
-                status=status.HTTP_404_NOT_FOUND
-            )
-
-        try:
-            # Try to get the doctors (this will trigger permission checks)
-            queryset = self.get_queryset()
-            if not queryset.exists():
-                return Response(
-                    {"error": f"No doctors found in department with ID {department_id}."},
-                    status=status.HTTP_404_NOT_FOUND
-                )
-            return super().get(request, *args, **kwargs)
-        except PermissionDenied as e:
-            return Response(
-                {"error": str(e)},
-                status=status.HTTP_403_FORBIDDEN
-            )
-    
 
-class DepartmentPatientsListView(generics.ListAPIView):
+class DepartmentPatientsListView(DepartmentMembersListMixin, ProjectedListViewMixin, EagerLoadingViewMixin, generics.ListAPIView):
     serializer_class = PatientSerializer
     permission_classes = [IsAuthenticated, IsDoctorInDepartment]
+    no_members = "No patients found in department with ID {department_id}."
 
     def get_queryset(self):
         department_id = self.kwargs['pk']  # Get department ID from the URL
         return Patient.objects.filter(department_id=department_id)
 
-    def get(self, request, *args, **kwargs):
-        department_id = self.kwargs['pk']
-        if not Department.objects.filter(pk=department_id).exists():
-            return Response(
-                {"error": f"Department with ID {department_id} does not exist."},
-                status=status.HTTP_404_NOT_FOUND
-            )
 
-        queryset = self.get_queryset()
-        if not queryset.exists():
-            return Response(
-                {"error": f"No patients found in department with ID {department_id}."},
-                status=status.HTTP_404_NOT_FOUND
-            )
-        return super().get(request, *args, **kwargs)
 
 
 
 
+class DepartmentStatsListView(EagerLoadingViewMixin, generics.ListAPIView):
+    """Doctors, patients and records per department, read from the maintained counters."""
+    queryset = Department.objects.order_by('id')
+    serializer_class = DepartmentStatsSerializer
+    permission_classes = [IsAuthenticated, IsDoctor]
+    pagination_class = None  # one row per department
+
+
+class DepartmentStatsView(EagerLoadingViewMixin, generics.RetrieveAPIView):
+    """One department's counters plus the number of patients of each of its doctors."""
+    queryset = Department.objects.all()
+    serializer_class = DepartmentDoctorStatsSerializer
+    permission_classes = [IsAuthenticated, IsDoctorInDepartment]
+
+
+class DepartmentAnalyticsView(APIView):
+    """
+    Monthly record volume, top diagnoses per month and treatment mix of one department, read
+    from the rollups only. ?from=2025-01&to=2025-12 (default: the last 12 months), ?top=10.
+    """
+    permission_classes = [IsAuthenticated, IsDoctorInDepartment]
+
+    def get(self, request, pk):
+        try:
+            end = self._month(request.query_params.get('to')) or month_start(timezone.now().date())
+            start = self._month(request.query_params.get('from')) or add_months(end, -11)
+            top = int(request.query_params.get('top', 10))
+        except ValueError:
+            return Response({"error": "from and to must be months (YYYY-MM) and top an integer."}, status=status.HTTP_400_BAD_REQUEST)
+        if start > end:
+            return Response({"error": "from must not be after to."}, status=status.HTTP_400_BAD_REQUEST)
+        if add_months(start, settings.ANALYTICS_MAX_MONTHS) <= end:
+            return Response({"error": f"At most {settings.ANALYTICS_MAX_MONTHS} months at a time."}, status=status.HTTP_400_BAD_REQUEST)
+        if not 1 <= top <= settings.ANALYTICS_MAX_TOP:
+            return Response({"error": f"top must be between 1 and {settings.ANALYTICS_MAX_TOP}."}, status=status.HTTP_400_BAD_REQUEST)
+        if not Department.objects.filter(pk=pk).exists():
+            raise NotFound("Department not found.")
+        return Response(department_analytics(pk, start, end, top=top))
+
+    @staticmethod
+    def _month(value):
+        return datetime.datetime.strptime(value, '%Y-%m').date() if value else None
+
 
 class RegisterView(APIView):
     permission_classes = [AllowAny]
@@ -359,11 +717,40 @@ class RegisterView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class RegisterBulkView(APIView):
+    """
+    Registers many doctors and patients in one request (staff only). Accepts a JSON array,
+    MessagePack array, NDJSON or CSV with the fields of RegisterView, returns one result per row.
+    Hashing a password takes a good fraction of a second: uploads of more than
+    BULK_REGISTER_SYNC_MAX_ITEMS rows, or sent with Prefer: respond-async, get a 202 and a job
+    whose result holds the same.
+    """
+    permission_classes = [IsAuthenticated, IsAdminUser]
+    parser_classes = [ORJSONParser, MessagePackParser, NDJSONParser, CSVParser]
+
+    def post(self, request, *args, **kwargs):
+        items = request.data
+        if not isinstance(items, list):
+            return Response({"error": "Expected a list of users."}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > settings.BULK_REGISTER_MAX_ITEMS:
+            return Response({"error": f"Too many users, send at most {settings.BULK_REGISTER_MAX_ITEMS} per request."}, status=status.HTTP_400_BAD_REQUEST)
+        if prefers_async(request) or len(items) > settings.BULK_REGISTER_SYNC_MAX_ITEMS:
+            return job_accepted_response(request, enqueue('register_users', {'items': items}, user=request.user))
+
+        results = register_users(items)
+        created = sum(1 for result in results if result['status'] == 'created')
+        return Response({
+            'created': created,
+            'failed': len(results) - created,
+            'results': results,
+        }, status=status.HTTP_201_CREATED if created else status.HTTP_400_BAD_REQUEST)
+
+
 class LoginView(APIView):
     permission_classes = [AllowAny]
 
     def post(self, request, *args, **kwargs):
-        serializer = LoginSerializer(data=request.data)
+        serializer = LoginSerializer(data=request.data, context={'request': request})
         if serializer.is_valid(raise_exception=True):
             return Response(serializer.validated_data)
 
@@ -414,11 +801,8 @@ class LogoutView(APIView):
 
     def post(self, request, *args, **kwargs):
         user = request.user
-        try:
-            # Delete the user's auth token
-            token = Token.objects.get(user=user)
-            token.delete()
-            
+        # Delete the user's auth token
+        if revoke_token(user):
             # return the user information and a success message
             return Response({
                 'message': 'Successfully logged out.',
@@ -426,11 +810,85 @@ class LogoutView(APIView):
                     'username': user.username
                 }
             }, status=status.HTTP_204_NO_CONTENT)
-        except Token.DoesNotExist:
+        else:
             return Response({
                 'message': 'No token found for this user.',
                 'user': {
                     'id': user.id,
                     'username': user.username
                 }
-            }, status=status.HTTP_404_NOT_FOUND)
\ No newline at end of file
+            }, status=status.HTTP_404_NOT_FOUND)
+
+
+# Background jobs (medical/jobs.py)
+
+def job_accepted_response(request, job):
+    """202 for a job started instead of answering right away, pointing to its status."""
+    return Response(
+        JobSerializer(job).data,
+        status=status.HTTP_202_ACCEPTED,
+        headers={'Location': request.build_absolute_uri(reverse('job-detail', args=[job.pk])), 'Preference-Applied': 'respond-async'},
+    )
+
+
+def visible_jobs(request):
+    """Superusers see every job, the others the ones they started."""
+    if request.user.is_superuser:
+        return Job.objects.all()
+    return Job.objects.filter(created_by=request.user)
+
+
+class JobListView(APIView):
+    """
+    The caller's latest jobs (superusers: everybody's). Superusers POST {"kind": ...} to start a
+    maintenance job: backfill_rollups, reconcile_counters, or archive_records (optional
+    "older_than_days").
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        jobs = visible_jobs(request).order_by('-created_at', '-pk')[:settings.JOB_LIST_LIMIT]
+        return Response(JobSerializer(jobs, many=True).data)
+
+    def post(self, request, *args, **kwargs):
+        if not request.user.is_superuser:
+            return Response({"error": "Only superusers can start maintenance jobs."}, status=status.HTTP_403_FORBIDDEN)
+        kind = request.data.get('kind')
+        if kind not in MAINTENANCE_KINDS:
+            return Response({"error": f"Unknown kind, use one of {list(MAINTENANCE_KINDS)}."}, status=status.HTTP_400_BAD_REQUEST)
+        params = {}
+        if kind == 'archive_records' and request.data.get('older_than_days') is not None:
+            try:
+                params['older_than_days'] = int(request.data['older_than_days'])
+            except (TypeError, ValueError):
+                return Response({"error": "older_than_days must be an integer."}, status=status.HTTP_400_BAD_REQUEST)
+        return job_accepted_response(request, enqueue(kind, params, user=request.user))
+
+
+class JobDetailView(APIView):
+    """A job's status, progress and, once finished, result or error."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        job = visible_jobs(request).filter(pk=pk).first()
+        if job is None:
+            return Response({"error": "Job not found."}, status=status.HTTP_404_NOT_FOUND)
+        return Response(JobSerializer(job).data)
+
+
+class JobResultView(APIView):
+    """The file an export job wrote."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        job = visible_jobs(request).filter(pk=pk, kind='export_patient_records').first()
+        if job is None:
+            return Response({"error": "Job not found."}, status=status.HTTP_404_NOT_FOUND)
+        if job.status != 'succeeded':
+            return Response({"error": f"The export is {job.status}.", "status": job.status}, status=status.HTTP_409_CONFLICT)
+        path = export_path(job)
+        extension = os.path.basename(path).split('.', 1)[1]  # csv, ndjson, csv.gz, ...
+        try:
+            return FileResponse(open(path, 'rb'), as_attachment=True, filename=f"patient_records.{extension}")
+        except FileNotFoundError:
+            return Response({"error": "The export file is gone, start a new export."}, status=status.HTTP_410_GONE)